@@ -4,25 +4,25 @@ import os
 import random
 import time
 import pathlib
-import sqlite3
-from collections import defaultdict
 
-from PIL import Image
-import io
-
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, abort, send_from_directory
 from slack_bolt import App
 from slack_bolt.adapter.flask import SlackRequestHandler
-from slack_sdk import WebClient
 
-from poker.structures import leagues, card_image_name
+from poker.structures import leagues, static_dir, card_file_name, card_image_name, card_digest, card_for_image_name
 
 dev_mode = os.environ.get("DEV_MODE", None)
 
-# Always use SQLite (removed PostgreSQL dependency)
-from poker.local_db import Connection
+# SQLite unless STORAGE_BACKEND says otherwise, see poker/storage.py
+import poker.storage as storage
 
 import poker.engine as engine
+import poker.scoring as scoring
+import poker.outbox as outbox
+import poker.slack_http as slack_http
+import poker.game_cache as game_cache
+from poker.scheduler import scheduler
+import poker.images as images
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -31,11 +31,39 @@ secret = os.environ.get("SLACK_BOT_SECRET")
 channel = os.environ.get("SLACK_CHANNEL")
 game_command = os.environ.get("GAME_COMMAND") or "game"
 
+# e.g. /internal-static/ mapped by an nginx `internal` location onto ./static,
+# so card files are sent by nginx rather than read by gunicorn
+static_accel_prefix = os.environ.get("STATIC_ACCEL_PREFIX")
+
+# Under `python app.py` the render and equity processes, which are spawned,
+# import this file again as __mp_main__. They only need poker's modules, so
+# none of the startup below runs there.
+pool_process = __name__ == '__mp_main__'
+
 app = Flask(__name__, static_url_path='/static')
-bolt = App(token=token, signing_secret=secret)
+bolt = App(token=token, signing_secret=secret, token_verification_enabled=not pool_process)
 handler = SlackRequestHandler(bolt)
 
-slack = WebClient(token=token)
+# Keeps connections to Slack open between calls, see poker/slack_http.py
+slack = slack_http.PooledWebClient(token=token)
+
+def start():
+    images.load_atlas()
+    images.prune_disk_cache()
+
+    # Build the evaluator's tables now rather than in the first showdown's transaction
+    scoring.evaluate7([0, 1, 2, 3, 4, 5, 6])
+
+    storage.migrate()
+
+    # Delivers anything left in the outbox by a previous run
+    outbox.wake(slack)
+
+    # The archive job, for SQLite
+    storage.start()
+
+if not pool_process:
+    start()
 
 @app.route("/bolt", methods=["POST"])
 def slack_events():
@@ -47,21 +75,69 @@ def index():
 
 @app.route("/combined-cards.png")
 def card_image():
-    # Only allow up to 7 cards to be combined
-    card_ids = [int(c) for c in request.args.get('cards').split(',')][:7]
-    card_paths = [f'./static/{card_image_name(i)}' for i in card_ids]
-    card_images = [Image.open(p) for p in card_paths]
-    new_width = sum([i.size[0] for i in card_images])
-    combined_img = Image.new('RGB', (new_width, card_images[0].size[1]))
-    for idx, img in enumerate(card_images):
-        combined_img.paste(img, (idx*img.size[0], 0))
-
-    imgbytes = io.BytesIO()
-    combined_img.save(imgbytes, format='png')
-
-    resp = make_response(imgbytes.getvalue())
-    resp.headers['Content-Type'] = 'image/png'
-    return resp
+    card_ids = images.parse_card_ids(request.args.get('cards'))
+    scale = images.parse_scale(request.args.get('scale'))
+
+    if card_ids is None or scale is None:
+        abort(400)
+
+    fmt = images.negotiate_format([mime for mime, quality in request.accept_mimetypes if quality > 0])
+
+    try:
+        data, etag = images.render(card_ids, fmt, scale)
+    except images.RenderTimeout:
+        resp = make_response('', 503)
+        resp.headers['Retry-After'] = '1'
+        return resp
+
+    # A given set of card ids always renders the same bytes per format and scale
+    resp = make_response(data)
+    resp.headers['Content-Type'] = images.formats[fmt]['mime']
+    resp.headers['Vary'] = 'Accept'
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 31536000
+    resp.cache_control.immutable = True
+    return resp.make_conditional(request)
+
+@app.route("/combined-cards/stats")
+def card_image_stats():
+    return {'cache': images.cache.stats(), 'render': images.render_stats.stats()}
+
+@app.route("/db/stats")
+def db_stats():
+    return {'db': storage.stats(), 'outbox': outbox.stats(), 'games': game_cache.cache_stats.stats(), 'scheduler': scheduler.stats(), 'slack_http': slack_http.stats()}
+
+@app.route("/cards/<name>")
+def card_asset(name):
+    card = card_for_image_name(name)
+
+    if card is None:
+        abort(404)
+
+    # Only content hashed names are safe to cache forever
+    immutable = name == card_image_name(card) and name != card_file_name(card)
+    max_age = 31536000 if immutable else 300
+
+    if static_accel_prefix:
+        resp = make_response('')
+        resp.headers['X-Accel-Redirect'] = static_accel_prefix + card_file_name(card)
+        resp.headers['Content-Type'] = 'image/png'
+        resp.cache_control.max_age = max_age
+    else:
+        resp = send_from_directory(os.path.abspath(static_dir), card_file_name(card), mimetype='image/png', etag=False, max_age=max_age)
+
+    if card_digest(card):
+        resp.set_etag(card_digest(card))
+
+    if immutable:
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+
+    return resp.make_conditional(request)
+
+# When outbox.call() gives up on Slack, see SLACK_CALL_MAX_WAIT
+busy_text = "Slack is busy right now, try again in a moment"
 
 @bolt.command(f"/{game_command}")
 def poker_cmd(ack, respond, command, logger):
@@ -86,40 +162,28 @@ def poker_cmd(ack, respond, command, logger):
             try:
                 last_n = int(pieces[1])
             except ValueError:
-                respond(response_type="ephemeral", text=f"Usage: `/game stats [last N games]` — N must be a number")
+                respond(response_type="ephemeral", text=f"Usage: `/game stats [last N games] [league]` — N must be a number")
                 return
 
-        db_path = os.environ.get("DATABASE_URL") or 'poker.db'
-        con = sqlite3.connect(db_path)
-        rows = con.execute("SELECT state FROM game").fetchall()
-        con.close()
-
-        complete = [json.loads(r[0]) for r in rows if json.loads(r[0]).get('status') == 'complete']
-        complete = complete[-last_n:]
+        league = '*'
+        if len(pieces) >= 3:
+            league = None
+            for name, league_data in leagues.items():
+                if pieces[2].lower() == name or pieces[2].lower() in league_data['synonyms']:
+                    league = name
+                    break
 
-        stats = defaultdict(lambda: {'name': '', 'games': 0, 'wins': 0})
-
-        for state in complete:
-            players = state.get('players', [])
-            winners = state.get('winners', [])
-            labels = state.get('player_labels', {})
-            folded = state.get('folded', [])
-
-            # Fix for historical games where all-fold winner wasn't recorded
-            if not winners:
-                remaining = [p for p in players if p not in folded]
-                if remaining:
-                    winners = remaining
+            if league is None:
+                respond(response_type="ephemeral", text=f"Usage: `/game stats [last N games] [league]` — league is one of {', '.join(leagues)}")
+                return
 
-            for p in players:
-                stats[p]['name'] = labels.get(p, p) or p
-                stats[p]['games'] += 1
-                if p in winners:
-                    stats[p]['wins'] += 1
+        # Archived games only matter for N beyond the kept windows
+        with storage.transaction(write=False, archive=True) as conn:
+            totals = conn.player_stats(last_n, league)
 
         rows_out = sorted(
-            [(s['name'], s['games'], s['wins'])
-             for s in stats.values() if s['games'] >= 3],
+            [(label or player, games, wins, reps_owed)
+             for player, label, games, wins, reps_owed in totals if games >= 3],
             key=lambda x: -(x[2] / x[1] if x[1] else 0)
         )
 
@@ -127,17 +191,26 @@ def poker_cmd(ack, respond, command, logger):
             respond(response_type="ephemeral", text="No stats yet!")
             return
 
-        title = f"*Poker Stats — Last {last_n} Games* (min 3 games)"
+        if league == '*':
+            title = f"*Poker Stats — Last {last_n} Games* (min 3 games)"
+        else:
+            title = f"*Poker Stats — Last {last_n} {league} Games* (min 3 games, owed in {leagues[league]['units']})"
+
         lines = [title, "```"]
-        lines.append(f"{'Player':<22} {'G':>4} {'W':>4} {'L':>4} {'Win%':>6}")
-        lines.append("-" * 44)
-        for name, games, wins in rows_out:
+        lines.append(f"{'Player':<22} {'G':>4} {'W':>4} {'L':>4} {'Win%':>6}" + (f" {'Owed':>6}" if league != '*' else ''))
+        lines.append("-" * (44 if league == '*' else 51))
+        for name, games, wins, reps_owed in rows_out:
             losses = games - wins
             win_pct = wins / games * 100
-            lines.append(f"{name:<22} {games:>4} {wins:>4} {losses:>4} {win_pct:>5.1f}%")
+            lines.append(f"{name:<22} {games:>4} {wins:>4} {losses:>4} {win_pct:>5.1f}%" + (f" {reps_owed:>6}" if league != '*' else ''))
         lines.append("```")
 
-        slack.chat_postMessage(channel=channel, text="\n".join(lines))
+        try:
+            outbox.call(slack, 'chat_postMessage', channel=channel, text="\n".join(lines))
+        except outbox.Busy:
+            respond(response_type="ephemeral", text=busy_text)
+            return
+
         respond(response_type="ephemeral", text="Stats posted to #poker!")
         return
 
@@ -176,9 +249,15 @@ def poker_cmd(ack, respond, command, logger):
         emoji = "💎"
 
     if league_in.lower().strip() == 'random':
-        response = slack.chat_postMessage(channel=channel, text=f"<@{user}> rolled the 🎲 on a random game and the result is {league_label} poker {emoji}! The buy-in is {buyin} {units}. Who's in?")
+        text = f"<@{user}> rolled the 🎲 on a random game and the result is {league_label} poker {emoji}! The buy-in is {buyin} {units}. Who's in?"
     else:
-        response = slack.chat_postMessage(channel=channel, text=f"<@{user}> wants to play {league_label} poker {emoji} . The buy-in is {buyin} {units}. Who's in?")
+        text = f"<@{user}> wants to play {league_label} poker {emoji} . The buy-in is {buyin} {units}. Who's in?"
+
+    try:
+        response = outbox.call(slack, 'chat_postMessage', channel=channel, text=text)
+    except outbox.Busy:
+        respond(response_type="ephemeral", text=busy_text)
+        return
 
     game_id = f"{response['channel']}-{response['ts']}"
 
@@ -193,7 +272,7 @@ def poker_cmd(ack, respond, command, logger):
       'created_at': float(response['ts']),
     }
 
-    with Connection() as conn:
+    with storage.transaction() as conn:
         conn.save_game(game_id, state)
         conn.commit()
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Plays random games through poker.engine on each storage backend, SQLite on
+# a temporary file, and reports games and actions per second. Messages are
+# delivered to a fake Slack client inline, one by one and without the pauses
+# between them, so their storage cost is counted. Card images are left out,
+# and showdown odds unless --equity is given.
+# Each is run without and with the game cache (poker/game_cache.py).
+#
+#   python -m bench.engine [games] [--backend memory|sqlite] [--threads N ...] [--equity]
+
+import argparse
+import contextlib
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import poker.engine as engine
+import poker.game_cache as game_cache
+import poker.images as images
+import poker.local_db as local_db
+import poker.outbox as outbox
+import poker.ratelimit as ratelimit
+import poker.scoring as scoring
+import poker.storage as storage
+
+class FakeSlack():
+    def __init__(self):
+        self.messages = 0
+
+    def chat_postMessage(self, **kwargs):
+        self.messages += 1
+        return {'ok': True}
+
+    def chat_postEphemeral(self, **kwargs):
+        self.messages += 1
+        return {'ok': True}
+
+class Quiet():
+    def info(self, *args):
+        pass
+
+def play(slack, rng, game_no):
+    """Plays one game, returns each action's latency in ms"""
+    game_id = f"C0-{1700000000 + game_no}.000100"
+    state = {'host': 'U0', 'league': 'push-up', 'buyin': 5, 'status': 'pending', 'players': ['U0'], 'created_at': 1700000000.0 + game_no}
+    latencies = []
+
+    with storage.transaction() as conn:
+        conn.save_game(game_id, state)
+
+    for user in ['U1', 'U2', 'U3']:
+        start = time.perf_counter()
+        engine.maybe_add_player(slack, game_id, user, Quiet())
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    while True:
+        with storage.transaction(write=False) as conn:
+            state = engine.load_state(conn, game_id)
+
+        if state['status'] != 'in-progress':
+            return latencies
+
+        player = state['current_player']
+        payload = {'player': player, 'thread_ts': game_id.split('-')[1], 'game_id': game_id}
+        action = rng.choice(['check'] * 6 + ['fold', 'single', 'double'])
+
+        start = time.perf_counter()
+        engine.act(slack, action, player, payload, Quiet())
+        latencies.append((time.perf_counter() - start) * 1000)
+
+def play_many(slack, seed, game_nos, latencies):
+    rng = random.Random(seed)
+
+    for game_no in game_nos:
+        latencies.extend(play(slack, rng, game_no))
+
+def measure(name, games, threads, cache_size):
+    slack = FakeSlack()
+    random.seed(1234)
+    latencies = [[] for _ in range(threads)]
+    workers = [threading.Thread(target=play_many, args=(slack, 1234 + i, range(i, games, threads), latencies[i])) for i in range(threads)]
+    local_db.db_stats = local_db.DbStats()
+    game_cache.cache = game_cache.GameCache(cache_size)
+    game_cache.cache_stats = game_cache.CacheStats()
+
+    # The engine prints bet blocks
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        secs = time.perf_counter() - start
+
+    with storage.transaction(write=False) as conn:
+        assert len(conn.recent_games('*', games)) == games
+
+    latencies = sorted(ms for thread in latencies for ms in thread)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[len(latencies) * 99 // 100]
+    db = local_db.db_stats.stats()
+    lock_wait, lock_held = (db['begin_ms_avg'], db['held_ms_avg']) if name == 'sqlite' else (0.0, 0.0)
+    cached = game_cache.cache_stats.stats()
+    hit_rate = cached['hits'] / max(1, cached['hits'] + cached['misses'])
+
+    print(f"{name:<8} {threads:>7} {cache_size:>5} {games / secs:>8.0f} {len(latencies) / secs:>10.0f} {p50:>7.2f} {p99:>7.2f} {lock_wait:>9.3f} {lock_held:>9.3f} {cached['wait_ms_avg']:>9.3f} {cached['held_ms_avg']:>9.3f} {hit_rate:>5.0%}")
+
+def main(games, backends, threads, show_equity):
+    engine.show_equity = show_equity
+    images.prerender_formats = []
+    outbox.wake = lambda slack, due=(): outbox.deliver(slack, now=float('inf'))
+    outbox.concurrency = 1
+    # Slack's rate limits would set the pace, not what's measured
+    ratelimit.buckets = {}
+    logging.disable(logging.CRITICAL)
+
+    # Table construction is a one off per process, keep it out of the timings
+    scoring.evaluate7([0, 1, 2, 3, 4, 5, 6])
+
+    print(f"{games} games, action latency in ms" + (", with showdown odds" if show_equity else ""))
+    # lock wait/held: average wait for and hold of the SQLite write lock per
+    # transaction, game wait/held: the same for the game's own lock per action
+    print(f"{'backend':<8} {'threads':>7} {'cache':>5} {'games/s':>8} {'actions/s':>10} {'p50':>7} {'p99':>7} {'lock wait':>9} {'lock held':>9} {'game wait':>9} {'game held':>9} {'hits':>5}")
+
+    for name in backends:
+        for n in threads:
+            for cache_size in [0, game_cache.size or 256]:
+                with tempfile.TemporaryDirectory() as tmp:
+                    if name == 'sqlite':
+                        local_db.db_url = os.path.join(tmp, 'bench.db')
+                        local_db.archive_db_url = os.path.join(tmp, 'bench-archive.db')
+
+                    storage.use(storage.backends[name]())
+                    storage.migrate()
+                    measure(name, games, n, cache_size)
+                    local_db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('games', nargs='?', type=int, default=200)
+    parser.add_argument('--backend', choices=list(storage.backends), help="only this backend (default both)")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4], help="games played at once (default 1 4)")
+    parser.add_argument('--equity', action='store_true', help="work out showdown odds, as SHOW_EQUITY does by default")
+    args = parser.parse_args()
+
+    main(args.games, [args.backend] if args.backend else list(storage.backends), args.threads, args.equity)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Encode time and size of combined card images per output format and scale.
+#
+#   python -m bench.images [repeats]
+
+import sys
+import time
+
+import poker.images as images
+
+variants = [
+    ('png',  {'compress_level': 1}),
+    ('png',  {'compress_level': 6}),
+    ('png',  {'compress_level': 9}),
+    ('webp', {'quality': 80}),
+    ('webp', {'lossless': True}),
+    ('jpeg', {'quality': 85}),
+]
+
+strips = {
+    'hand (2)':  (12, 25),
+    'flop (3)':  (5, 19, 44),
+    'board (7)': (12, 25, 5, 19, 44, 30, 8),
+}
+
+def main(repeats):
+    print(f"{'cards':<10} {'format':<22} {'scale':>5} {'ms':>8} {'bytes':>8}")
+
+    for label, card_ids in strips.items():
+        img = images.compose(card_ids)
+
+        for fmt, options in variants:
+            if fmt not in images.formats:
+                continue
+
+            images.formats[fmt]['options'] = options
+            desc = fmt + ' ' + ','.join(f"{k}={v}" for k, v in options.items())
+
+            for scale in (1.0, 0.5):
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    data = images.encode(img, fmt, scale)
+                ms = (time.perf_counter() - start) / repeats * 1000
+
+                print(f"{label:<10} {desc:<22} {scale:>5} {ms:>8.2f} {len(data):>8}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
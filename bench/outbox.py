@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Starts games at once through poker.engine on the memory storage backend and
+# times dealing through the outbox dispatcher, against a fake Slack client
+# that takes --latency ms per call. The deal is done when every player has
+# their hand; start_game waits 0.1s between the announcement and the hands.
+#
+#   python -m bench.outbox [games] [--latency MS] [--concurrency N ...]
+
+import argparse
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import poker.engine as engine
+import poker.images as images
+import poker.outbox as outbox
+import poker.ratelimit as ratelimit
+import poker.storage as storage
+
+class SlowSlack():
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.hands = {}
+
+    def chat_postMessage(self, **kwargs):
+        time.sleep(self.latency)
+        return {'ok': True}
+
+    def chat_postEphemeral(self, **kwargs):
+        time.sleep(self.latency)
+
+        if 'cards=' in kwargs['blocks'][0].get('image_url', ''):
+            with self.lock:
+                self.hands.setdefault(kwargs['thread_ts'], []).append(time.time())
+
+        return {'ok': True}
+
+class Quiet():
+    def info(self, *args):
+        pass
+
+def measure(slack, games, concurrency):
+    storage.use(storage.MemoryStorage())
+    outbox.concurrency = concurrency
+    slack.hands = {}
+    started = {}
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(games):
+            game_id = f"C0-{1700000000 + i}.000100"
+
+            with storage.transaction() as conn:
+                conn.save_game(game_id, {'host': 'U0', 'league': 'push-up', 'buyin': 5, 'status': 'pending', 'players': ['U0'], 'created_at': 1700000000.0 + i})
+
+            for user in ['U1', 'U2']:
+                engine.maybe_add_player(slack, game_id, user, Quiet())
+
+        # The last join deals
+        for i in range(games):
+            game_id = f"C0-{1700000000 + i}.000100"
+            started[game_id.split('-')[1]] = time.time()
+            engine.maybe_add_player(slack, game_id, 'U3', Quiet())
+
+        while sum(len(hands) == 4 for hands in slack.hands.values()) < games:
+            time.sleep(0.01)
+
+    deals = sorted((max(hands) - started[thread]) * 1000 for thread, hands in slack.hands.items())
+    print(f"{concurrency:>11} {deals[len(deals) // 2]:>8.0f} {deals[-1]:>8.0f}")
+
+def main(games, latency, concurrencies):
+    engine.show_equity = False
+    images.prerender_formats = []
+    # Slack's rate limits would set the pace, not the sends at once
+    ratelimit.buckets = {}
+    logging.disable(logging.CRITICAL)
+
+    print(f"{games} games dealt at once, {latency:.0f} ms per Slack call, deal time in ms")
+    print(f"{'concurrency':>11} {'p50':>8} {'max':>8}")
+
+    # The dispatcher keeps the client it was started with
+    slack = SlowSlack(latency / 1000)
+
+    for concurrency in concurrencies:
+        measure(slack, games, concurrency)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('games', nargs='?', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=100.0)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, outbox.concurrency])
+    args = parser.parse_args()
+
+    main(args.games, args.latency, args.concurrency)
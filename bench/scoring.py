@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Compares the old 21 combination showdown against scoring.evaluate7 and
+# scoring.best_batch.
+#
+#   python -m bench.scoring [number of 7 card hands]
+
+import itertools
+import random
+import sys
+import time
+
+import poker.scoring as scoring
+
+def combinations_showdown(all_cards):
+    best = None
+
+    for hand in itertools.combinations(all_cards, 5):
+        b = scoring.best(hand)
+        s = ''.join([scoring.ord_lexico[i] for i in b])
+
+        if best is None or s > best:
+            best = s
+
+    return best
+
+def timed(fn, hands):
+    start = time.perf_counter()
+    results = [fn(h) for h in hands]
+    return results, time.perf_counter() - start
+
+def main(n):
+    random.seed(1234)
+    hands = [random.sample(range(52), 7) for _ in range(n)]
+
+    # Table construction is a one off per process, keep it out of the timings
+    scoring.evaluate7(hands[0])
+    scoring.best_batch(hands[:1])
+
+    old, old_secs = timed(combinations_showdown, hands)
+    new, new_secs = timed(scoring.evaluate7, hands)
+
+    batch_start = time.perf_counter()
+    batch = scoring.best_batch(hands).tolist()
+    batch_secs = time.perf_counter() - batch_start
+
+    assert batch == new
+
+    for hand, lex, strength in zip(hands, old, new):
+        assert scoring.unpack(strength) == [int(c, 16) for c in lex], hand
+
+    # Same ordering across every pair of hands means same winners at any table
+    order_old = sorted(range(n), key=lambda i: (old[i], i))
+    order_new = sorted(range(n), key=lambda i: (new[i], i))
+    assert order_old == order_new
+
+    print(f"{n} seven card hands")
+    print(f"combinations + best(): {old_secs:8.3f}s  {old_secs / n * 1e6:8.1f}us/hand")
+    print(f"evaluate7():           {new_secs:8.3f}s  {new_secs / n * 1e6:8.1f}us/hand")
+    print(f"best_batch():          {batch_secs:8.3f}s  {batch_secs / n * 1e6:8.1f}us/hand")
+    print(f"speedup:               {old_secs / new_secs:8.1f}x (evaluate7), {old_secs / batch_secs:.1f}x (best_batch)")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Times chat.postMessage calls through the SDK's WebClient and through
+# poker.slack_http.PooledWebClient, against a local HTTPS server with a
+# throwaway self-signed certificate (made with the openssl command). Both pay
+# the same TLS handshakes as against Slack, but none of the network round
+# trips, so the difference against Slack is larger.
+#
+#   python -m bench.slack_http [calls] [--threads N ...]
+
+import argparse
+import json
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from slack_sdk import WebClient
+
+import poker.slack_http as slack_http
+
+class FakeSlack(BaseHTTPRequestHandler):
+    # Keeps connections open like Slack does
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body = json.dumps({'ok': True, 'channel': 'C0', 'ts': '1700000000.000100'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(tmp):
+    cert = os.path.join(tmp, 'cert.pem')
+    key = os.path.join(tmp, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server = ThreadingHTTPServer(('localhost', 0), FakeSlack)
+    server.daemon_threads = True
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client_context = ssl.create_default_context(cafile=cert)
+    return f"https://localhost:{server.server_address[1]}/api/", client_context
+
+def call_many(client, calls, latencies):
+    for _ in range(calls):
+        start = time.perf_counter()
+        client.chat_postMessage(channel='C0', text="bench")
+        latencies.append((time.perf_counter() - start) * 1000)
+
+def measure(name, client, calls, threads):
+    slack_http.pool = slack_http.ConnectionPool(slack_http.pool_size, slack_http.connection_ttl)
+    latencies = [[] for _ in range(threads)]
+    workers = [threading.Thread(target=call_many, args=(client, calls // threads, latencies[i])) for i in range(threads)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    secs = time.perf_counter() - start
+
+    latencies = sorted(ms for thread in latencies for ms in thread)
+    opened = slack_http.stats()['opened'] if name == 'pooled' else len(latencies)
+    print(f"{name:<8} {threads:>7} {len(latencies) / secs:>8.0f} {latencies[len(latencies) // 2]:>7.2f} {latencies[len(latencies) * 99 // 100]:>7.2f} {opened:>11}")
+
+def main(calls, threads):
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_url, context = serve(tmp)
+        clients = {
+          'urllib': WebClient(token='xoxb-bench', base_url=base_url, ssl=context),
+          'pooled': slack_http.PooledWebClient(token='xoxb-bench', base_url=base_url, ssl=context),
+        }
+
+        print(f"{calls} calls, latency in ms")
+        print(f"{'client':<8} {'threads':>7} {'calls/s':>8} {'p50':>7} {'p99':>7} {'connections':>11}")
+
+        for n in threads:
+            for name, client in clients.items():
+                measure(name, client, calls, n)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('calls', nargs='?', type=int, default=500)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8], help="calls made at once (default 1 8)")
+    args = parser.parse_args()
+
+    main(args.calls, args.threads)
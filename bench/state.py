@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Stored size and load/save time of game states in each format, measured on a
+# copy of the given database (default DATABASE_URL or poker.db), which is
+# left untouched.
+#
+#   python -m bench.state [database]
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import poker.local_db as local_db
+
+def measure(fn, game_ids):
+    raw = sqlite3.connect(fn)
+    raw.execute('VACUUM;')
+    size = raw.execute("SELECT AVG(LENGTH(state)) FROM game;").fetchone()[0]
+    raw.close()
+
+    file_size = os.path.getsize(fn)
+
+    with local_db.Connection(write=False, fn=fn) as conn:
+        start = time.perf_counter()
+        states = [conn.load_game(game_id) for game_id in game_ids]
+        load_us = (time.perf_counter() - start) / len(game_ids) * 1e6
+
+    with local_db.Connection(fn=fn) as conn:
+        start = time.perf_counter()
+        for game_id, state in zip(game_ids, states):
+            conn.save_game(game_id, state)
+        save_us = (time.perf_counter() - start) / len(game_ids) * 1e6
+
+    return size, file_size, load_us, save_us
+
+def main(source):
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'copy.db')
+
+        src = sqlite3.connect(source)
+        dst = sqlite3.connect(fn)
+        src.backup(dst)
+        src.close()
+        dst.close()
+
+        local_db.migrate(fn)
+
+        game_ids = [row[0] for row in sqlite3.connect(fn).execute("SELECT game_id FROM game;")]
+        print(f"{len(game_ids)} games from {source}")
+        print(f"{'format':<8} {'bytes/game':>10} {'db bytes':>10} {'load us':>8} {'save us':>8}")
+
+        for fmt in local_db.formats:
+            local_db.convert_states(fn, fmt)
+            size, file_size, load_us, save_us = measure(fn, game_ids)
+            print(f"{fmt:<8} {size:>10.0f} {file_size:>10} {load_us:>8.1f} {save_us:>8.1f}")
+
+        local_db.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else local_db.db_url)
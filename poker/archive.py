@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Moves finished and abandoned games out of the live database into the archive
+# database, then checkpoints and, when enough pages are free, vacuums it.
+#
+#   python -m poker.archive [--db PATH] [--archive PATH] [--force]
+#
+# Workers also run it every ARCHIVE_INTERVAL seconds, whichever gets there
+# first does the work.
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import poker.local_db as local_db
+from poker.local_db import Connection
+
+# Completed games are archived this long after they finish, pending and
+# in-progress ones this long after they were posted
+archive_after = float(os.environ.get("ARCHIVE_AFTER_DAYS") or 30) * 86400
+abandoned_after = float(os.environ.get("ARCHIVE_ABANDONED_AFTER_DAYS") or 2) * 86400
+interval = float(os.environ.get("ARCHIVE_INTERVAL") or 86400)
+# VACUUM rewrites the whole file under the write lock, only worth it once
+# this fraction of the file is free pages
+vacuum_free_ratio = float(os.environ.get("ARCHIVE_VACUUM_FREE") or 0.25)
+
+batch_size = 200
+
+# Moved with explicit columns, a migrated game table has them in another order
+tables = {
+  'game': ['game_id', 'state'] + [name for name, type in local_db.game_columns],
+  'game_player': ['game_id', 'player', 'seat', 'label', 'bet', 'folded', 'won'],
+  'game_action': ['game_id', 'seq', 'action', 'player', 'name', 'created_at'],
+}
+
+def kept_games(conn):
+    """The newest completed games every player_stats window still counts.
+
+    complete_game() finds the game leaving a window in the live table, so
+    those stay put however old they are.
+    """
+    keep = max(local_db.stats_windows)
+    leagues = ['*'] + [row[0] for row in conn.conn.execute("SELECT DISTINCT league FROM main.game WHERE status = 'complete';")]
+
+    return {game_id for league in leagues for game_id, created_at in conn.recent_games(league, keep)}
+
+# Finished long enough ago, or abandoned: posted long enough ago with no
+# action since. Checked again inside each write, a game may be played on
+# between being picked and being moved.
+archivable_where = """
+  (status = 'complete' AND finished_at < ?) OR (status != 'complete' AND created_at < ?
+    AND NOT EXISTS (SELECT 1 FROM main.game_action a WHERE a.game_id = game.game_id AND a.created_at >= ?))
+"""
+
+def archivable_args(now):
+    return [now - archive_after, now - abandoned_after, now - abandoned_after]
+
+def archivable_games(conn, now):
+    kept = kept_games(conn)
+    rows = conn.conn.execute(f"SELECT game_id FROM main.game WHERE {archivable_where};", archivable_args(now)).fetchall()
+
+    return [game_id for game_id, in rows if game_id not in kept]
+
+def still_archivable(conn, game_ids, now):
+    marks = ','.join('?' * len(game_ids))
+    query = f"SELECT game_id FROM main.game WHERE game_id IN ({marks}) AND ({archivable_where});"
+
+    return [game_id for game_id, in conn.conn.execute(query, list(game_ids) + archivable_args(now))]
+
+def copy_games(conn, game_ids):
+    marks = ','.join('?' * len(game_ids))
+
+    for table, columns in tables.items():
+        names = ', '.join(columns)
+        # REPLACE so copies left by an interrupted run are overwritten
+        conn.conn.execute(f"INSERT OR REPLACE INTO archive.{table} ({names}) SELECT {names} FROM main.{table} WHERE game_id IN ({marks});", game_ids)
+
+def delete_games(conn, game_ids):
+    marks = ','.join('?' * len(game_ids))
+
+    for table in tables:
+        conn.conn.execute(f"DELETE FROM main.{table} WHERE game_id IN ({marks});", game_ids)
+
+def drop_live_copies(conn):
+    """Removes archive copies of games that are still live, left by a move cut short"""
+    for table in tables:
+        conn.conn.execute(f"DELETE FROM archive.{table} WHERE game_id IN (SELECT game_id FROM main.game);")
+
+def archive_games(now=None):
+    """Moves old games to the archive a batch at a time, returns how many.
+
+    A commit spanning both databases isn't atomic, so each transaction writes
+    to one of them: a batch is copied into the archive and committed before
+    it's deleted from main. A run cut short in between leaves copies, never
+    loses games, and the next run replaces or drops them.
+    """
+    now = now or time.time()
+    moved = 0
+
+    with Connection(write=False, archive=True) as conn:
+        game_ids = archivable_games(conn, now)
+
+    for start in range(0, len(game_ids), batch_size):
+        with Connection(archive=True) as conn:
+            batch = still_archivable(conn, game_ids[start:start + batch_size], now)
+
+            if batch:
+                copy_games(conn, batch)
+
+        if not batch:
+            continue
+
+        with Connection(archive=True) as conn:
+            ready = still_archivable(conn, batch, now)
+
+            if ready:
+                delete_games(conn, ready)
+
+        moved += len(ready)
+
+    # Copies of games played on since they were copied, or from an earlier run
+    with Connection(archive=True) as conn:
+        drop_live_copies(conn)
+
+    return moved
+
+def maintain(fn):
+    """Checkpoints the WAL into the database file, vacuuming first if it's mostly free pages"""
+    conn = sqlite3.connect(fn, timeout=local_db.busy_timeout_ms / 1000, isolation_level=None)
+
+    pages = conn.execute("PRAGMA page_count;").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+    vacuumed = pages > 0 and free / pages >= vacuum_free_ratio
+
+    if vacuumed:
+        conn.execute("VACUUM;")
+
+    busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+    conn.close()
+
+    return {'pages': pages, 'free_pages': free, 'vacuumed': vacuumed, 'checkpoint_busy': bool(busy)}
+
+def claim_run(now):
+    """True for the one worker that should run now, recorded in the setting table"""
+    with Connection() as conn:
+        row = conn.conn.execute("SELECT value FROM setting WHERE key = 'archive_last_run';").fetchone()
+
+        if row is not None and now - float(row[0]) < interval:
+            return False
+
+        conn.conn.execute("INSERT OR REPLACE INTO setting (key, value) VALUES ('archive_last_run', ?);", (str(now),))
+        return True
+
+def run(force=False):
+    now = time.time()
+
+    # Forced runs still count, so workers don't repeat them straight away
+    if not claim_run(now) and not force:
+        return None
+
+    start = time.perf_counter()
+    archived = archive_games(now)
+    live = maintain(local_db.db_url)
+    maintain(local_db.archive_db_url)
+
+    result = dict(live, archived=archived, seconds=round(time.perf_counter() - start, 3))
+    logging.info(f"Archive run: {result}")
+    return result
+
+_thread = None
+_thread_lock = threading.Lock()
+
+def _archive_loop():
+    while True:
+        try:
+            run()
+        except Exception:
+            logging.exception("Archive run failed")
+
+        # Every worker checks, claim_run() lets one of them through
+        time.sleep(min(interval, 3600))
+
+def start():
+    """Runs the archive job in the background of this worker, unless ARCHIVE_INTERVAL is 0"""
+    global _thread
+
+    if interval <= 0:
+        return
+
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_archive_loop, name='game-archive', daemon=True)
+            _thread.start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help="live database (default DATABASE_URL or poker.db)")
+    parser.add_argument('--archive', help="archive database (default ARCHIVE_DATABASE_URL or poker-archive.db)")
+    parser.add_argument('--force', action='store_true', help="run even if a worker ran within ARCHIVE_INTERVAL")
+    args = parser.parse_args()
+
+    local_db.db_url = args.db or local_db.db_url
+    local_db.archive_db_url = args.archive or local_db.archive_db_url
+
+    print(run(args.force))
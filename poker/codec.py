@@ -0,0 +1,184 @@
+import json
+import struct
+
+# Binary game state: MAGIC, a version byte, then one tagged value. Strings in
+# the version's static table are written as their index, other strings are
+# written once and then referred back to, so player ids repeated across
+# players, handles, bets, hands and labels cost a couple of bytes each.
+#
+# A version's table must never change once rows have been written with it,
+# add a new version instead.
+
+MAGIC = b'\x00PKS'
+
+# Tags from INT on are followed by a varint
+NONE, FALSE, TRUE, FLOAT, INT, NEG, STR, REF, CONST, LIST, DICT = range(11)
+
+_phases = ['opening', 'flop', 'turn', 'river']
+
+static_strings = {
+  1: ['host', 'league', 'buyin', 'status', 'players', 'created_at', 'finished_at', 'handles', 'dev_mode',
+      'flop', 'turn', 'river', 'hands', 'bets', 'current_bet', 'current_player', 'player_labels', 'folded',
+      'winners', 'strengths', 'action_seq', 'pending', 'in-progress', 'complete']
+     + [f'{phase}-bets-{field}' for phase in _phases for field in ['complete', 'idx', 'round-trip']]
+     + ['push-up', 'sit-up', 'burpee', 'squat', 'lunge', 'plank', 'knuckle-up', 'russian-twist', 'push-plank',
+        'rupee', 'chin-up'],
+}
+
+version = max(static_strings)
+
+_static_index = {v: {s: i for i, s in enumerate(strings)} for v, strings in static_strings.items()}
+
+_double = struct.Struct('<d')
+
+def _varint(out, n):
+    if n < 0x80:
+        out.append(n)
+        return
+
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _encode(out, value, static, seen):
+    # bool before int, it's a subclass
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif type(value) is str:
+        idx = static.get(value)
+        if idx is not None:
+            out.append(CONST)
+            _varint(out, idx)
+            return
+
+        idx = seen.get(value)
+        if idx is not None:
+            out.append(REF)
+            _varint(out, idx)
+            return
+
+        seen[value] = len(seen)
+        data = value.encode('utf-8')
+        out.append(STR)
+        _varint(out, len(data))
+        out += data
+    elif type(value) is int:
+        if value >= 0:
+            out.append(INT)
+            _varint(out, value)
+        else:
+            out.append(NEG)
+            _varint(out, -value)
+    elif type(value) is float:
+        out.append(FLOAT)
+        out += _double.pack(value)
+    elif type(value) in (list, tuple):
+        out.append(LIST)
+        _varint(out, len(value))
+        for item in value:
+            _encode(out, item, static, seen)
+    elif type(value) is dict:
+        out.append(DICT)
+        _varint(out, len(value))
+        for key, item in value.items():
+            if type(key) is not str:
+                raise TypeError(f"state keys must be str, not {type(key).__name__}")
+            _encode(out, key, static, seen)
+            _encode(out, item, static, seen)
+    else:
+        raise TypeError(f"can't encode {type(value).__name__} in a game state")
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _decode(data, pos, strings, seen):
+    tag = data[pos]
+
+    if tag < INT:
+        if tag == NONE:
+            return None, pos + 1
+        if tag == TRUE:
+            return True, pos + 1
+        if tag == FALSE:
+            return False, pos + 1
+        if tag == FLOAT:
+            return _double.unpack_from(data, pos + 1)[0], pos + 1 + _double.size
+
+    # Nearly every length, index and int fits in one varint byte
+    n = data[pos + 1]
+    if n < 0x80:
+        after = pos + 2
+    else:
+        n, after = _read_varint(data, pos + 1)
+
+    if tag == CONST:
+        return strings[n], after
+    if tag == REF:
+        return seen[n], after
+    if tag == INT:
+        return n, after
+    if tag == STR:
+        value = data[after:after + n].decode('utf-8')
+        seen.append(value)
+        return value, after + n
+    if tag == DICT:
+        items = {}
+        pos = after
+        for _ in range(n):
+            key, pos = _decode(data, pos, strings, seen)
+            items[key], pos = _decode(data, pos, strings, seen)
+        return items, pos
+    if tag == LIST:
+        items = []
+        pos = after
+        for _ in range(n):
+            item, pos = _decode(data, pos, strings, seen)
+            items.append(item)
+        return items, pos
+    if tag == NEG:
+        return -n, after
+
+    raise ValueError(f"bad tag {tag} at {pos}")
+
+def encode_binary(state):
+    out = bytearray(MAGIC)
+    out.append(version)
+    _encode(out, state, _static_index[version], {})
+    return bytes(out)
+
+def decode_binary(blob):
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a binary game state")
+
+    v = blob[len(MAGIC)]
+    if v not in static_strings:
+        raise ValueError(f"unknown game state version {v}")
+
+    value, pos = _decode(blob, len(MAGIC) + 1, static_strings[v], [])
+    return value
+
+formats = ['json', 'binary']
+
+def encode_state(state, fmt):
+    if fmt == 'binary':
+        return encode_binary(state)
+    return json.dumps(state)
+
+def decode_state(stored):
+    """A state saved in any format, JSON rows come back from sqlite as str"""
+    if isinstance(stored, bytes):
+        return decode_binary(stored)
+    return json.loads(stored)
@@ -2,45 +2,87 @@ import json
 import logging
 import os
 import random
-import itertools
 import time
 
 dev_mode = os.environ.get("DEV_MODE", None)
 site = os.environ.get("SITE_URL")
 channel = os.environ.get("SLACK_CHANNEL")
+show_equity = (os.environ.get("SHOW_EQUITY") or "true").lower() == "true"
 
 from poker.structures import leagues, cards, card_image_name, card_textual_rep
 
-# Always use SQLite (removed PostgreSQL dependency)
-from poker.local_db import Connection
-
+import poker.storage as storage
+import poker.game_cache as game_cache
 import poker.scoring as scoring
+import poker.equity as equity
+import poker.images as images
+import poker.outbox as outbox
 
 logging.basicConfig(level=logging.DEBUG)
 
 def get_player_hand_text(state, player):
     return "  ".join([card_textual_rep(c) for c in state['hands'][player]])
 
+def get_equity_text(state, players):
+    try:
+        streets = equity.by_street(state, players)
+    except Exception:
+        # The odds are a nicety, never let them hold up the result
+        logging.exception("Equity calculation failed")
+        return ''
+
+    text = "Odds by street (win / tie):"
+
+    for street, odds in streets:
+        parts = []
+        for player in players:
+            label = state['player_labels'][player] if player in state['player_labels'] else player
+            win, tie = odds[player]
+            parts.append(f"{label} {win:.0%}" + (f" / {tie:.0%}" if tie else ""))
+        text += f"\n • {street}: " + ", ".join(parts)
+
+    return text
+
+def post_equity(slack, payload, state, players):
+    """Posts the odds by street after a showdown.
+
+    Worked out once the showdown has committed, it takes too long to hold
+    the write lock and the game's lock for.
+    """
+    text = get_equity_text(state, players)
+
+    if not text:
+        return
+
+    with storage.transaction() as conn:
+        messages = outbox.Recorder(conn)
+        messages.chat_postMessage(channel=channel, text=text, thread_ts=payload['thread_ts'])
+
+    outbox.wake(slack, messages.due)
+
 def maybe_add_player(slack, game_id, user, logger):
-    with Connection() as conn:
+    with game_cache.cache.hold(game_id) as game, storage.transaction() as conn:
+        messages = outbox.Recorder(conn)
 
-        state = conn.load_game(game_id)
+        state = game.load(conn, load_state)
 
         if state:
             if state['status'] == 'pending':
                 if user not in state['players'] or dev_mode:
                     logger.info('Adding player ' + user)
                     state['players'].append(user)
+                    record_action(conn, game_id, state, 'join', user, None)
 
                     logger.info(state)
 
+                    # Snapshotted by start_game, the deal can't be replayed
                     if len(state['players']) > 3:
-                        start_game(slack, conn, game_id, state)
-                    else:
-                        conn.save_game(game_id, state)
+                        start_game(messages, conn, game_id, state)
 
         conn.commit()
 
+    outbox.wake(slack, messages.due)
+
 def start_game(slack, conn, game_id, state):
 
     if dev_mode:
@@ -91,7 +133,7 @@ def start_game(slack, conn, game_id, state):
 
     response = slack.chat_postMessage(channel=channel, text=text, blocks=public_blocks, thread_ts=thread_ts)
 
-    time.sleep(0.1)
+    slack.sleep(0.1)
 
     deck = list(range(0, 52))
 
@@ -106,6 +148,8 @@ def start_game(slack, conn, game_id, state):
         player_hands[player] = [card1, card2]
         player_bets[player] = state['buyin']
 
+        images.prerender(player_hands[player])
+
         card_ids = ','.join([str(c) for c in player_hands[player]])
         blocks = [
             {
@@ -118,9 +162,8 @@ def start_game(slack, conn, game_id, state):
                 "alt_text": "Poker cards"
             }
         ]
-        print(json.dumps(blocks, indent=2))
 
-        response = slack.chat_postEphemeral(channel=channel, thread_ts=thread_ts, blocks=blocks, user=state['handles'][player])
+        response = slack.chat_postEphemeral(channel=channel, thread_ts=thread_ts, blocks=blocks, user=state['handles'][player], own_chain=True)
 
     deck.pop(0) # for old time's sake
 
@@ -161,10 +204,12 @@ def start_game(slack, conn, game_id, state):
 
 def resend(slack, user_id, payload):
 
-    with Connection() as conn:
-        state = conn.load_game(payload['game_id'])
+    with game_cache.cache.hold(payload['game_id']) as game, storage.transaction() as conn:
+        messages = outbox.Recorder(conn)
+        state = game.load(conn, load_state)
 
-        print((state['handles'][state['current_player']], user_id))
+        if state is None:
+            return
 
         if state['handles'][state['current_player']] != user_id or state['status'] != 'in-progress':
             return
@@ -172,119 +217,132 @@ def resend(slack, user_id, payload):
         payload['player'] = state['current_player']
         blocks = get_bet_blocks(payload, state)
 
-        response = slack.chat_postEphemeral(channel=channel, thread_ts=payload['thread_ts'], blocks=blocks, user=state['handles'][state['current_player']])
-
-def fold(slack, user, name, payload):
-
-    with Connection() as conn:
-        state = conn.load_game(payload['game_id'])
-
-        if state['current_player'] != payload['player']:
-            return
+        response = messages.chat_postEphemeral(channel=channel, thread_ts=payload['thread_ts'], blocks=blocks, user=state['handles'][state['current_player']])
 
-        if payload['player'] not in state['player_labels']:
-            state['player_labels'][payload['player']] = name
+    outbox.wake(slack, messages.due)
 
-        state['folded'].append(payload['player'])
-
-        msg = f"{name} folds."
+raises = {'single': 1, 'double': 2, 'triple': 3}
 
-        advance_play(slack, conn, payload, state, msg)
+def current_street(state):
+    for phase in ['opening', 'flop', 'turn', 'river']:
+        if not state[f'{phase}-bets-complete']:
+            return phase
 
-        conn.save_game(payload['game_id'], state)
-        conn.commit()
+    return 'endgame'
 
-def check(slack, user, name, payload, logger):
+def apply_action(slack, conn, payload, state, action, name, logger=None):
+    """Applies a fold, check or raise to the state. False if it isn't the player's turn."""
+    if state['current_player'] != payload['player']:
+        return False
 
-    with Connection() as conn:
-        state = conn.load_game(payload['game_id'])
+    if payload['player'] not in state['player_labels']:
+        state['player_labels'][payload['player']] = name
 
-        if state['current_player'] != payload['player']:
-            return
+    if action == 'fold':
+        state['folded'].append(payload['player'])
 
-        if payload['player'] not in state['player_labels']:
-            state['player_labels'][payload['player']] = name
+        msg = f"{name} folds."
 
+    elif action == 'check':
         msg = "calls" if state['bets'][payload['player']] < state['current_bet'] else "checks"
         msg = f"{name} {msg}."
 
         state['bets'][payload['player']] = state['current_bet']
 
-        logger.info(state)
+        if logger:
+            logger.info(state)
 
-        advance_play(slack, conn, payload, state, msg)
-
-        conn.save_game(payload['game_id'], state)
-        conn.commit()
+    else:
+        raise_by = state['buyin'] * raises[action]
 
-def single(slack, user, name, payload):
+        state['current_bet'] = state['current_bet'] + raise_by
 
-    with Connection() as conn:
-        state = conn.load_game(payload['game_id'])
+        state['bets'][payload['player']] = state['current_bet']
+        units = leagues[state['league']]['units']
 
-        if state['current_player'] != payload['player']:
-            return
+        total = "the total bet" if action == 'single' else "the total"
+        msg = f"{name} raises {raise_by}, bringing {total} to {state['current_bet']} {units}."
 
-        if payload['player'] not in state['player_labels']:
-            state['player_labels'][payload['player']] = name
+    advance_play(slack, conn, payload, state, msg)
 
-        state['current_bet'] = state['current_bet'] + state['buyin']
+    return True
 
-        state['bets'][payload['player']] = state['current_bet']
-        units = leagues[state['league']]['units']
+def record_action(conn, game_id, state, action, player, name):
+    state['action_seq'] = state.get('action_seq', 0) + 1
+    conn.append_action(game_id, state['action_seq'], action, player, name)
 
-        msg = f"{name} raises {state['buyin']}, bringing the total bet to {state['current_bet']} {units}."
+def replay_action(state, game_id, action, player, name):
+    if action == 'join':
+        state['players'].append(player)
+    else:
+        payload = {'player': player, 'thread_ts': game_id.split("-")[1], 'game_id': game_id}
+        # Actions that finish a game are always snapshotted, so conn is never needed
+        applied = apply_action(outbox.Discard(), None, payload, state, action, name)
+        assert applied, (game_id, action, player)
 
-        advance_play(slack, conn, payload, state, msg)
+    state['action_seq'] = state.get('action_seq', 0) + 1
 
-        conn.save_game(payload['game_id'], state)
-        conn.commit()
+def load_state(conn, game_id):
+    """The game's latest snapshot with the actions taken since replayed onto it"""
+    state = conn.load_game(game_id)
 
-def double(slack, user, name, payload):
+    if state is None:
+        return None
 
-    with Connection() as conn:
-        state = conn.load_game(payload['game_id'])
+    for seq, action, player, name in conn.load_actions(game_id, state.get('action_seq', 0)):
+        replay_action(state, game_id, action, player, name)
 
-        if state['current_player'] != payload['player']:
-            return
+    return state
 
-        if payload['player'] not in state['player_labels']:
-            state['player_labels'][payload['player']] = name
+def act(slack, action, name, payload, logger=None):
+    # Players still in at a showdown this action caused
+    showdown = None
 
-        state['current_bet'] = state['current_bet'] + (state['buyin'] * 2)
+    # Actions on one game queue here rather than for the database, and the
+    # state is usually still cached from the last one
+    with game_cache.cache.hold(payload['game_id']) as game, storage.transaction() as conn:
+        messages = outbox.Recorder(conn)
+        state = game.load(conn, load_state)
 
-        state['bets'][payload['player']] = state['current_bet']
-        units = leagues[state['league']]['units']
+        # Archived, see poker.archive
+        if state is None:
+            return
 
-        msg = f"{name} raises {state['buyin'] * 2}, bringing the total to {state['current_bet']} {units}."
+        player = payload['player']
+        street = current_street(state)
+        status = state['status']
 
-        advance_play(slack, conn, payload, state, msg)
+        if not apply_action(messages, conn, payload, state, action, name, logger):
+            return
 
-        conn.save_game(payload['game_id'], state)
-        conn.commit()
+        record_action(conn, payload['game_id'], state, action, player, name)
 
-def triple(slack, user, name, payload):
+        # Snapshot when a betting round or the game ends, so replays stay short
+        if current_street(state) != street or state['status'] != 'in-progress':
+            conn.save_game(payload['game_id'], state)
 
-    with Connection() as conn:
-        state = conn.load_game(payload['game_id'])
+        if status != 'complete' and state['status'] == 'complete' and 'strengths' in state:
+            showdown = list(state['strengths'])
 
-        if state['current_player'] != payload['player']:
-            return
+    outbox.wake(slack, messages.due)
 
-        if payload['player'] not in state['player_labels']:
-            state['player_labels'][payload['player']] = name
+    if showdown and show_equity:
+        post_equity(slack, payload, state, showdown)
 
-        state['current_bet'] = state['current_bet'] + (state['buyin'] * 3)
+def fold(slack, user, name, payload):
+    act(slack, 'fold', name, payload)
 
-        state['bets'][payload['player']] = state['current_bet']
-        units = leagues[state['league']]['units']
+def check(slack, user, name, payload, logger):
+    act(slack, 'check', name, payload, logger)
 
-        msg = f"{name} raises {state['buyin'] * 3}, bringing the total to {state['current_bet']} {units}."
+def single(slack, user, name, payload):
+    act(slack, 'single', name, payload)
 
-        advance_play(slack, conn, payload, state, msg)
+def double(slack, user, name, payload):
+    act(slack, 'double', name, payload)
 
-        conn.save_game(payload['game_id'], state)
-        conn.commit()
+def triple(slack, user, name, payload):
+    act(slack, 'triple', name, payload)
 
 
 def get_bet_blocks(payload, state):
@@ -383,16 +441,7 @@ def advance_play(slack, conn, payload, state, msg):
         finish_game(slack, conn, payload, state)
         return
 
-    if not state['opening-bets-complete']:
-        phase = 'opening'
-    elif not state['flop-bets-complete']:
-        phase = 'flop'
-    elif not state['turn-bets-complete']:
-        phase = 'turn'
-    elif not state['river-bets-complete']:
-        phase = 'river'
-    else:
-        phase = 'endgame'
+    phase = current_street(state)
 
     if phase != 'endgame':
 
@@ -418,7 +467,7 @@ def advance_play(slack, conn, payload, state, msg):
             state['current_player']   = state['players'][next_player_idx]
             payload['player'] = state['current_player']
             blocks = get_bet_blocks(payload, state)
-            time.sleep(2)
+            slack.sleep(2)
 
             handle = state['handles'][state['current_player']]
 
@@ -445,6 +494,9 @@ def advance_play(slack, conn, payload, state, msg):
                 slack.chat_postMessage(channel=channel, text=msg, thread_ts=payload['thread_ts'])
 
             if phase == 'opening':
+                # Rendering starts now, the message is only sent after commit
+                images.prerender(state['flop'])
+
                 flop_card_ids = ','.join([str(c) for c in state['flop']])
                 blocks = [
                     {
@@ -468,7 +520,7 @@ def advance_play(slack, conn, payload, state, msg):
                           "text": f"The turn"
                         },
                         "type": "image",
-                        "image_url": f"https://{site}/static/" + card_image_name(state['turn']),
+                        "image_url": f"https://{site}/cards/" + card_image_name(state['turn']),
                         "alt_text": "A poker card"
                     }
                 ]
@@ -483,7 +535,7 @@ def advance_play(slack, conn, payload, state, msg):
                           "text": f"Last, but not least: The River"
                         },
                         "type": "image",
-                        "image_url": f"https://{site}/static/" + card_image_name(state['river']),
+                        "image_url": f"https://{site}/cards/" + card_image_name(state['river']),
                         "alt_text": "A poker card"
                     }
                 ]
@@ -499,6 +551,7 @@ def advance_play(slack, conn, payload, state, msg):
 
 def finish_game(slack, conn, payload, state):
     state['status'] = 'complete'
+    state['finished_at'] = time.time()
 
     folded = state['folded']
     active = [player for player in state['players'] if player not in state['folded']]
@@ -512,29 +565,25 @@ def finish_game(slack, conn, payload, state):
         response = slack.chat_postMessage(channel=channel, text=text, thread_ts=payload['thread_ts'], reply_broadcast=True)
     else:
 
-        results = []
+        strengths = {}
+        top = None
+        winners = []
 
         for player in active:
             all_cards = state['hands'][player] +  state['flop'] + [state['turn'], state['river']]
             assert len(all_cards) == 7
 
-            best = None
-
-            for hand in itertools.combinations(all_cards, 5):
-
-                b = scoring.best(hand)
-                s = ''.join([scoring.ord_lexico[i] for i in b])
+            strength = scoring.evaluate7(all_cards)
+            strengths[player] = strength
 
-                results.append({'lex': s, 'player': player})
+            if top is None or strength > top:
+                top = strength
+                winners = [player]
+            elif strength == top:
+                winners.append(player)
 
-        results = list(reversed(sorted(results, key=lambda d: d['lex'])))
-        winners = set([results[0]['player']])
-
-        for res in results[1:]:
-            if res['lex'] == results[0]['lex']:
-                winners.add(res['player'])
-            else:
-                break
+        # Packed ints, see scoring.unpack()
+        state['strengths'] = strengths
 
         community_cards = "  ".join([card_textual_rep(c) for c in state['flop'] + [state['turn']] + [state['river']]])
 
@@ -546,12 +595,12 @@ def finish_game(slack, conn, payload, state):
 
         response = slack.chat_postMessage(channel=channel, text=call_msg, thread_ts=payload['thread_ts'])
 
-        winning_hand = scoring.hands[int(results[0]['lex'][0])]['name']
+        winning_hand = scoring.hand_name(top)
 
-        state['winners'] = list(winners)
+        state['winners'] = winners
 
         if len(winners) == 1:
-            winner = list(winners)[0]
+            winner = winners[0]
             text = f"Go ahead and rest on your laurels <@{state['handles'][winner]}> - you won with a {winning_hand}"
             for player in [player for player in state['players'] if player != winner]:
                 text += f"\n • <@{state['handles'][player]}> owes {state['bets'][player]} {leagues[state['league']]['units']}"
@@ -562,3 +611,6 @@ def finish_game(slack, conn, payload, state):
                 text += f"\n • <@{state['handles'][player]}> owes {state['bets'][player]} {leagues[state['league']]['units']}"
             response = slack.chat_postMessage(channel=channel, text=text, thread_ts=payload['thread_ts'], reply_broadcast=True)
 
+    # Same transaction as the save that marks the game complete
+    conn.complete_game(payload['game_id'], state)
+
@@ -0,0 +1,121 @@
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+import poker.scoring as scoring
+
+# Runouts are enumerated exhaustively whenever there are no more of them than
+# the sample budget (always the case from the flop on), otherwise sampled.
+samples = int(os.environ.get("EQUITY_SAMPLES") or 20000)
+# Processes per gunicorn worker, keep it small, 1 works it out in the calling thread
+workers = int(os.environ.get("EQUITY_WORKERS") or min(2, os.cpu_count() or 1))
+
+streets = [
+  ('opening', 'Pre-flop', 0),
+  ('flop',    'Flop',     3),
+  ('turn',    'Turn',     4),
+  ('river',   'River',    5),
+]
+
+def community_cards(state, street):
+    """Community cards visible while betting on the given street"""
+    board = state['flop'] + [state['turn'], state['river']]
+
+    for name, label, visible in streets:
+        if name == street:
+            return board[:visible]
+
+    raise ValueError(street)
+
+def _tally(holes, board, runouts):
+    wins = [0] * len(holes)
+    ties = [0] * len(holes)
+    count = 0
+
+    for extra in runouts:
+        full = board + list(extra)
+        strengths = [scoring.evaluate7(hole + full) for hole in holes]
+        top = max(strengths)
+        winners = [idx for idx, s in enumerate(strengths) if s == top]
+
+        if len(winners) == 1:
+            wins[winners[0]] += 1
+        else:
+            for idx in winners:
+                ties[idx] += 1
+
+        count += 1
+
+    return wins, ties, count
+
+def _exhaustive(holes, board, deck, shard, shards):
+    runouts = itertools.combinations(deck, 5 - len(board))
+    return _tally(holes, board, itertools.islice(runouts, shard, None, shards))
+
+def _sampled(holes, board, deck, n, seed):
+    rng = random.Random(seed)
+    missing = 5 - len(board)
+    return _tally(holes, board, (rng.sample(deck, missing) for _ in range(n)))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork, the gunicorn worker has threads running.
+            # Each process builds the evaluator's tables on its first shard.
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+        return _pool
+
+def equity(hands, board, budget=None, seed=None):
+    """Win and tie fractions for each player's hole cards against the others.
+
+    hands maps player -> [card, card] for the players still in, board is the
+    0, 3, 4 or 5 community cards seen so far. Returns {player: (win, tie)}.
+    """
+    budget = budget or samples
+    players = list(hands)
+    holes = [list(hands[p]) for p in players]
+    board = list(board)
+
+    used = set(board).union(*holes)
+    deck = [c for c in range(52) if c not in used]
+
+    missing = 5 - len(board)
+    exhaustive = math.comb(len(deck), missing) <= budget
+    shards = workers if workers > 1 and missing > 0 else 1
+
+    if exhaustive:
+        jobs = [(_exhaustive, holes, board, deck, shard, shards) for shard in range(shards)]
+    else:
+        seed = random.randrange(1 << 30) if seed is None else seed
+        per_shard = -(-budget // shards)
+        jobs = [(_sampled, holes, board, deck, per_shard, seed + shard) for shard in range(shards)]
+
+    if shards > 1:
+        pool = _get_pool()
+        results = [f.result() for f in [pool.submit(*job) for job in jobs]]
+    else:
+        results = [job[0](*job[1:]) for job in jobs]
+
+    wins = [sum(r[0][idx] for r in results) for idx in range(len(players))]
+    ties = [sum(r[1][idx] for r in results) for idx in range(len(players))]
+    count = sum(r[2] for r in results)
+
+    return {p: (wins[idx] / count, ties[idx] / count) for idx, p in enumerate(players)}
+
+def by_street(state, players, budget=None):
+    """equity() on every street before the river, for the given players"""
+    hands = {p: state['hands'][p] for p in players}
+
+    return [(label, equity(hands, community_cards(state, name), budget))
+            for name, label, visible in streets if name != 'river']
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from poker.timing import Timing
+
+# States of the games being played in this worker, so an action doesn't load
+# the snapshot and replay the actions since. The database stays the source of
+# truth: writes still go through to it, and a cached state is only used if
+# the game's last action in the database is the one it was built from,
+# checked inside the action's own write transaction, so actions taken
+# through other workers are never lost.
+#
+# 0 turns the cache off, games are still locked one action at a time
+size = int(os.environ.get("GAME_CACHE_SIZE") or 256)
+
+class CacheStats():
+    """Game cache use and per-game lock waits in this worker"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.wait_ms = Timing()
+        self.held_ms = Timing()
+
+    def loaded(self, hit, stale):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.stale += stale
+
+    def released(self, wait_ms, held_ms):
+        with self.lock:
+            self.wait_ms.add(wait_ms)
+            self.held_ms.add(held_ms)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                # Misses because another worker moved the game on
+                'stale': self.stale,
+                **self.wait_ms.stats('wait_ms'),
+                **self.held_ms.stats('held_ms'),
+            }
+
+cache_stats = CacheStats()
+
+class Game():
+    """A game held by one thread at a time, see GameCache.hold()"""
+
+    def __init__(self, cache, game_id):
+        self.cache = cache
+        self.game_id = game_id
+        self.lock = threading.Lock()
+        self.state = None
+        # Threads holding or waiting for the lock, the entry stays while any are
+        self.users = 0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.wait_ms = (self.acquired - start) * 1000
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # The state may be half changed, or changed and then rolled back
+        if type is not None or self.cache.size <= 0:
+            self.state = None
+        elif self.state is not None and self.state.get('status') == 'complete':
+            self.state = None
+
+        held_ms = (time.perf_counter() - self.acquired) * 1000
+        self.lock.release()
+        self.cache.release(self)
+        cache_stats.released(self.wait_ms, held_ms)
+
+    def load(self, conn, loader):
+        """The game's current state, the cached one if no action was taken since.
+
+        loader(conn, game_id) reads it from storage otherwise. Changes to the
+        returned state are kept unless the `with` block raises.
+        """
+        stale = False
+
+        if self.state is not None:
+            if conn.game_version(self.game_id) == self.state.get('action_seq', 0):
+                cache_stats.loaded(True, False)
+                return self.state
+            stale = True
+
+        self.state = loader(conn, self.game_id)
+        cache_stats.loaded(False, stale)
+        return self.state
+
+class GameCache():
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.games = OrderedDict()
+
+    def hold(self, game_id):
+        """The game's entry, to use as a context manager holding its lock"""
+        with self.lock:
+            game = self.games.get(game_id)
+
+            if game is None:
+                game = self.games[game_id] = Game(self, game_id)
+
+            game.users += 1
+            self.games.move_to_end(game_id)
+            return game
+
+    def release(self, game):
+        with self.lock:
+            game.users -= 1
+
+            if game.users == 0 and game.state is None:
+                del self.games[game.game_id]
+
+            # Least recently used first, never one that's in use
+            excess = len(self.games) - max(self.size, 0)
+            if excess > 0:
+                for game_id in list(self.games)[:excess]:
+                    if self.games[game_id].users == 0:
+                        del self.games[game_id]
+
+    def clear(self):
+        with self.lock:
+            for game_id in [game_id for game_id, game in self.games.items() if game.users == 0]:
+                del self.games[game_id]
+
+cache = GameCache(size)
@@ -0,0 +1,506 @@
+import hashlib
+import io
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, features
+
+from poker.structures import cards, card_digest, card_file_name, static_dir
+from poker.timing import Timing
+
+cache_size = int(os.environ.get("IMAGE_CACHE_SIZE") or 512)
+
+# Shared by every gunicorn worker, so whichever one Slack's fetch lands on can
+# serve what another worker pre-rendered at deal time
+render_cache_dir = os.environ.get("RENDER_CACHE_DIR") or './render-cache'
+render_cache_ttl = int(os.environ.get("RENDER_CACHE_TTL") or 7 * 24 * 3600)
+
+# Composing and encoding happen in this many processes per gunicorn worker so
+# the worker's threads stay free for Slack interactions. 0 renders inline.
+render_workers = int(os.environ.get("RENDER_WORKERS") or 1)
+render_timeout = float(os.environ.get("RENDER_TIMEOUT") or 2.0)
+
+# Only allow up to 7 cards to be combined
+max_cards = 7
+
+png_compress_level = int(os.environ.get("PNG_COMPRESS_LEVEL") or 6)
+webp_quality = int(os.environ.get("WEBP_QUALITY") or 80)
+jpeg_quality = int(os.environ.get("JPEG_QUALITY") or 85)
+
+# First of these the client explicitly accepts wins, PNG otherwise
+format_preference = (os.environ.get("IMAGE_FORMATS") or 'webp,png').split(',')
+
+formats = {
+    'png':  {'mime': 'image/png',  'pil': 'PNG',  'options': {'compress_level': png_compress_level}},
+    'webp': {'mime': 'image/webp', 'pil': 'WEBP', 'options': {'quality': webp_quality}},
+    'jpeg': {'mime': 'image/jpeg', 'pil': 'JPEG', 'options': {'quality': jpeg_quality}},
+}
+
+if not features.check('webp'):
+    del formats['webp']
+
+# Whatever Slack's image proxy negotiates, which is plain PNG today
+prerender_formats = [f for f in (os.environ.get("PRERENDER_FORMATS") or 'png').split(',') if f in formats]
+
+class RenderCache():
+    """Bounded LRU of finished image bytes, safe to share between threads"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'capacity': self.size, 'hits': self.hits, 'misses': self.misses}
+
+cache = RenderCache(cache_size)
+
+####################### Card Atlas #######################
+
+# build_atlas() packs the 52 card PNGs into one atlas image plus a raw RGB
+# buffer (header, then each card's rows back to back in card id order).
+# Workers memory map the buffer, so the decoded pixels live once in the page
+# cache rather than as Pillow images in every worker. The header carries a
+# digest of the card files it was built from, so changed PNGs rebuild it.
+
+atlas_dir = os.environ.get("CARD_ATLAS_DIR") or './atlas'
+
+ATLAS_MAGIC = b'PKCA'
+ATLAS_VERSION = 2
+ATLAS_HEADER = struct.Struct('<4sIIII20s')
+
+def source_digest():
+    """sha1 over the digests of the card files in STATIC_DIR"""
+    return hashlib.sha1(','.join(card_digest(card) or '' for card in range(len(cards))).encode()).digest()
+
+class Atlas():
+    def __init__(self, buf, width, height):
+        # Slices of a memoryview don't copy
+        self.buf = memoryview(buf)
+        self.width = width
+        self.height = height
+        self.row_bytes = width * 3
+        self.card_bytes = self.row_bytes * height
+
+    def card_row(self, card, y):
+        start = ATLAS_HEADER.size + card * self.card_bytes + y * self.row_bytes
+        return self.buf[start:start + self.row_bytes]
+
+def build_atlas(out_dir=None):
+    """Writes cards.png and cards.rgb from the card images in STATIC_DIR"""
+    out_dir = out_dir or atlas_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+    bitmaps = []
+    for card in range(len(cards)):
+        with Image.open(os.path.join(static_dir, card_file_name(card))) as img:
+            bitmaps.append(img.convert('RGB'))
+
+    width, height = bitmaps[0].size
+    assert all(img.size == (width, height) for img in bitmaps)
+
+    atlas = Image.new('RGB', (width * len(bitmaps), height))
+    for idx, img in enumerate(bitmaps):
+        atlas.paste(img, (idx * width, 0))
+    atlas.save(os.path.join(out_dir, 'cards.png'))
+
+    raw_path = os.path.join(out_dir, 'cards.rgb')
+    tmp_path = f"{raw_path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(ATLAS_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, width, height, len(bitmaps), source_digest()))
+        for img in bitmaps:
+            f.write(img.tobytes())
+    os.replace(tmp_path, raw_path)
+
+    return raw_path
+
+def _map_atlas(path):
+    try:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if len(buf) < ATLAS_HEADER.size:
+        return None
+
+    magic, version, width, height, count, digest = ATLAS_HEADER.unpack_from(buf)
+
+    if (magic, version, count, digest) != (ATLAS_MAGIC, ATLAS_VERSION, len(cards), source_digest()):
+        return None
+
+    if len(buf) != ATLAS_HEADER.size + count * width * height * 3:
+        return None
+
+    return Atlas(buf, width, height)
+
+_atlas = None
+
+def load_atlas():
+    """Maps the raw card buffer, building it first if needed. Call at worker startup."""
+    global _atlas
+
+    if _atlas is None:
+        path = os.path.join(atlas_dir, 'cards.rgb')
+        _atlas = _map_atlas(path) or _map_atlas(build_atlas())
+
+    return _atlas
+
+def parse_card_ids(arg):
+    """Card ids from a `cards=1,2,3` query value, None if malformed"""
+    try:
+        card_ids = tuple(int(c) for c in arg.split(','))[:max_cards]
+    except (AttributeError, ValueError):
+        return None
+
+    if not card_ids or any(c < 0 or c >= len(cards) for c in card_ids):
+        return None
+
+    return card_ids
+
+def parse_scale(arg):
+    """Thumbnail scale from a `scale=0.5` query value, None if malformed.
+
+    Rounded to steps of 0.05 so there are a bounded number of variants to cache.
+    """
+    if arg is None:
+        return 1.0
+
+    try:
+        value = float(arg)
+    except ValueError:
+        return None
+
+    # inf can't be rounded and nan compares false with everything
+    if not math.isfinite(value):
+        return None
+
+    scale = round(value * 20) / 20
+
+    if scale < 0.1 or scale > 1.0:
+        return None
+
+    return scale
+
+def negotiate_format(accepted):
+    """Picks an output format given the mime types a client explicitly accepts.
+
+    Wildcards don't count, a bare */* still gets PNG.
+    """
+    for fmt in format_preference:
+        if fmt in formats and formats[fmt]['mime'] in accepted:
+            return fmt
+
+    return 'png'
+
+def compose(card_ids):
+    """The combined strip for a tuple of card ids as an RGB image"""
+    atlas = load_atlas()
+    row_bytes = atlas.row_bytes
+    stride = row_bytes * len(card_ids)
+
+    # Copy each card's rows straight into place in the combined strip
+    pixels = bytearray(stride * atlas.height)
+    for y in range(atlas.height):
+        offset = y * stride
+        for card in card_ids:
+            pixels[offset:offset + row_bytes] = atlas.card_row(card, y)
+            offset += row_bytes
+
+    return Image.frombuffer('RGB', (atlas.width * len(card_ids), atlas.height), pixels, 'raw', 'RGB', 0, 1)
+
+def encode(img, fmt='png', scale=1.0):
+    if scale != 1.0:
+        size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+        img = img.resize(size, Image.LANCZOS)
+
+    imgbytes = io.BytesIO()
+    img.save(imgbytes, format=formats[fmt]['pil'], **formats[fmt]['options'])
+    return imgbytes.getvalue()
+
+def _disk_path(key):
+    card_ids, fmt, scale = key
+    name = '-'.join(str(c) for c in card_ids)
+
+    if scale != 1.0:
+        name += f"@{scale:g}"
+
+    return os.path.join(render_cache_dir, f"{name}.{fmt}")
+
+def _read_disk(key):
+    try:
+        with open(_disk_path(key), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _write_disk(key, data):
+    path = _disk_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    os.makedirs(render_cache_dir, exist_ok=True)
+
+    # Readers in other workers only ever see a complete file
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def prune_disk_cache(max_age=None):
+    """Removes rendered files older than RENDER_CACHE_TTL seconds"""
+    cutoff = time.time() - (render_cache_ttl if max_age is None else max_age)
+
+    try:
+        names = os.listdir(render_cache_dir)
+    except FileNotFoundError:
+        return 0
+
+    removed = 0
+    for name in names:
+        path = os.path.join(render_cache_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+
+    return removed
+
+####################### Render Pool #######################
+
+class RenderTimeout(Exception):
+    """The pool didn't render in time, or crashed while rendering"""
+
+class RenderStats():
+    """Queue depth and latency of renders handed to the pool"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.render_ms = Timing()
+        self.wait_ms = Timing()
+
+    def submitted(self):
+        with self.lock:
+            self.queued += 1
+
+    def finished(self, render_ms):
+        with self.lock:
+            self.queued -= 1
+            if render_ms is None:
+                self.failed += 1
+            else:
+                self.render_ms.add(render_ms)
+
+    def waited(self, wait_ms):
+        with self.lock:
+            self.wait_ms.add(wait_ms)
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queued,
+                'rendered': self.render_ms.count,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+                **self.render_ms.stats('render_ms'),
+                **self.wait_ms.stats('wait_ms'),
+            }
+
+render_stats = RenderStats()
+
+def _compose_and_encode(card_ids, fmt, scale):
+    # Runs in a pool process, which maps the atlas itself on first use
+    start = time.perf_counter()
+    data = encode(compose(card_ids), fmt, scale)
+    return data, (time.perf_counter() - start) * 1000
+
+_pool = None
+_pool_lock = threading.RLock()
+
+# Requests for an image that is already being rendered wait on the same future
+_inflight = {}
+
+def _get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork, the gunicorn worker has threads running
+            _pool = ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _remember(key, data):
+    entry = (data, hashlib.sha1(data).hexdigest())
+    cache.put(key, entry)
+    return entry
+
+def _discard_pool(pool):
+    """Drops a pool a crashed process broke, the next render starts another"""
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+    pool.shutdown(wait=False)
+
+def _finished(key, pool, future):
+    with _pool_lock:
+        _inflight.pop(key, None)
+
+    try:
+        data, render_ms = future.result()
+    except BrokenProcessPool:
+        logging.exception(f"Rendering {key} failed, restarting the render pool")
+        render_stats.finished(None)
+        _discard_pool(pool)
+        return
+    except Exception:
+        logging.exception(f"Rendering {key} failed")
+        render_stats.finished(None)
+        return
+
+    render_stats.finished(render_ms)
+
+    # Even if whoever asked gave up waiting, the next fetch is a cache hit
+    _write_disk(key, data)
+    _remember(key, data)
+
+def _render_in_pool(key):
+    with _pool_lock:
+        future = _inflight.get(key)
+        submitting = future is None
+
+        if submitting:
+            pool = _get_pool()
+
+            try:
+                future = pool.submit(_compose_and_encode, *key)
+            except BrokenProcessPool:
+                _discard_pool(pool)
+                pool = _get_pool()
+                future = pool.submit(_compose_and_encode, *key)
+
+            _inflight[key] = future
+
+    if submitting:
+        render_stats.submitted()
+        future.add_done_callback(lambda f: _finished(key, pool, f))
+
+    start = time.perf_counter()
+
+    try:
+        data, render_ms = future.result(timeout=render_timeout)
+    except FutureTimeoutError:
+        render_stats.timed_out()
+        raise RenderTimeout(key)
+    except BrokenProcessPool:
+        # _finished starts a new pool for the next render, this one answers 503
+        raise RenderTimeout(key)
+    finally:
+        render_stats.waited((time.perf_counter() - start) * 1000)
+
+    return _remember(key, data)
+
+def render(card_ids, fmt='png', scale=1.0):
+    """(bytes, etag) for a tuple of card ids in one format and scale.
+
+    Every variant is cached on its own: LRU, then disk, then the render pool.
+    Raises RenderTimeout if the pool takes longer than RENDER_TIMEOUT seconds.
+    """
+    key = (card_ids, fmt, scale)
+    entry = cache.get(key)
+
+    if entry is not None:
+        return entry
+
+    data = _read_disk(key)
+
+    if data is not None:
+        return _remember(key, data)
+
+    if render_workers < 1:
+        data = _compose_and_encode(*key)[0]
+        _write_disk(key, data)
+        return _remember(key, data)
+
+    return _render_in_pool(key)
+
+####################### Background Pre-rendering #######################
+
+_render_queue = queue.Queue()
+_render_thread = None
+_render_lock = threading.Lock()
+
+def _render_loop():
+    while True:
+        card_ids = _render_queue.get()
+        try:
+            for fmt in prerender_formats:
+                render(card_ids, fmt)
+        except RenderTimeout:
+            # Still cached once the pool gets to it
+            pass
+        except Exception:
+            logging.exception(f"Pre-rendering {card_ids} failed")
+        finally:
+            _render_queue.task_done()
+
+def prerender(*card_id_lists):
+    """Queues images for rendering so they're cached before Slack asks for them"""
+    global _render_thread
+
+    # Started lazily so the thread belongs to the gunicorn worker, not the
+    # pre-fork master
+    with _render_lock:
+        if _render_thread is None:
+            _render_thread = threading.Thread(target=_render_loop, name='card-prerender', daemon=True)
+            _render_thread.start()
+
+    for card_ids in card_id_lists:
+        _render_queue.put(tuple(card_ids))
+
+if __name__ == '__main__':
+    print(f"Wrote {build_atlas()}")
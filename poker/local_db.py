@@ -1,60 +1,634 @@
 #!/usr/bin/env python3
+# SQLite storage for games, stats and the outbox. Run as a module from the
+# repository root, it imports the rest of the poker package:
+#
+#   python -m poker.local_db [bootstrap] [--db PATH]
+#   python -m poker.local_db rebuild-stats [--db PATH]
+#   python -m poker.local_db convert-state {json,binary} [--db PATH]
+
+import argparse
 import json
 import os
 import sqlite3
+import threading
+import time
+
+from poker.codec import encode_state, decode_state, formats
+from poker.timing import Timing
 
 game_table_ddl = """
   CREATE TABLE IF NOT EXISTS game (
     game_id TEXT PRIMARY KEY,
-    state TEXT
+    state TEXT,
+    status TEXT,
+    league TEXT,
+    created_at REAL,
+    finished_at REAL,
+    winners TEXT
+  );
+"""
+
+# One row per player per game, kept in step with the state blob by save_game
+game_player_table_ddl = """
+  CREATE TABLE IF NOT EXISTS game_player (
+    game_id TEXT NOT NULL,
+    player TEXT NOT NULL,
+    seat INTEGER NOT NULL,
+    label TEXT,
+    bet INTEGER,
+    folded INTEGER NOT NULL DEFAULT 0,
+    won INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (game_id, player)
+  );
+"""
+
+# Per database settings, e.g. state_format
+setting_table_ddl = """
+  CREATE TABLE IF NOT EXISTS setting (
+    key TEXT PRIMARY KEY,
+    value TEXT
+  );
+"""
+
+# Every join and bet in order. The game's state blob is a snapshot taken after
+# action number state['action_seq'], later actions are replayed onto it.
+game_action_table_ddl = """
+  CREATE TABLE IF NOT EXISTS game_action (
+    game_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    player TEXT,
+    name TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (game_id, seq)
+  );
+"""
+
+# Running totals per player, league ('*' for every league) and window, where
+# last_n is the number of most recent completed games counted (0 for all time)
+player_stats_table_ddl = """
+  CREATE TABLE IF NOT EXISTS player_stats (
+    player TEXT NOT NULL,
+    league TEXT NOT NULL,
+    last_n INTEGER NOT NULL,
+    label TEXT,
+    games INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0,
+    reps_owed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (league, last_n, player)
+  );
+"""
+
+# Slack calls recorded by the engine inside its transaction, sent after commit
+# by poker.outbox in id order within each Slack thread
+outbox_table_ddl = """
+  CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread TEXT NOT NULL,
+    method TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    not_before REAL NOT NULL,
+    claimed_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    sent_at REAL,
+    error TEXT
   );
 """
 
+# Columns added to game after the original (game_id, state) schema
+game_columns = [
+  ('status',      'TEXT'),
+  ('league',      'TEXT'),
+  ('created_at',  'REAL'),
+  ('finished_at', 'REAL'),
+  ('winners',     'TEXT'),
+]
+
+game_index_ddl = [
+  "CREATE INDEX IF NOT EXISTS game_status_created ON game (status, created_at, game_id);",
+  "CREATE INDEX IF NOT EXISTS game_league_created ON game (league, status, created_at, game_id);",
+  "CREATE INDEX IF NOT EXISTS game_player_player ON game_player (player, game_id);",
+]
+
+index_ddl = game_index_ddl + [
+  "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (thread, id) WHERE status = 'pending';",
+  "CREATE INDEX IF NOT EXISTS outbox_done ON outbox (status, sent_at);",
+]
+
 db_url = os.environ.get("DATABASE_URL") or 'poker.db'
 
-class Connection():
+# How game states are stored, 'json' or 'binary' (see poker.codec), for a
+# database that has no setting yet. Switch an existing database, converting
+# its rows, with `python -m poker.local_db convert-state binary`.
+default_state_format = os.environ.get("STATE_FORMAT") or 'json'
+
+# Applied once per connection, see connect()
+synchronous = os.environ.get("SQLITE_SYNCHRONOUS") or 'NORMAL'
+cache_size_kb = int(os.environ.get("SQLITE_CACHE_KB") or 16384)
+mmap_size_mb = int(os.environ.get("SQLITE_MMAP_MB") or 256)
+busy_timeout_ms = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS") or 30000)
+
+# Games moved out of the live database by poker.archive
+archive_db_url = os.environ.get("ARCHIVE_DATABASE_URL") or 'poker-archive.db'
+
+# Windows kept in player_stats, other sizes are computed from game_player.
+# Run `python -m poker.local_db rebuild-stats` after changing this.
+stats_windows = [int(n) for n in (os.environ.get("STATS_WINDOWS") or '50,100,500').split(',')]
+
+# Rows backfilled per transaction by migrate(), small enough that live games
+# only ever wait a moment for the write lock
+migrate_batch_size = 200
+
+def game_winners(state):
+    if state.get('status') != 'complete':
+        return []
+
+    winners = state.get('winners') or []
+
+    # Fix for historical games where all-fold winner wasn't recorded
+    if not winners:
+        winners = [p for p in state.get('players', []) if p not in state.get('folded', [])]
+
+    return winners
+
+def game_row(state):
+    """Indexed column values for a state, in game_columns order"""
+    complete = state.get('status') == 'complete'
+
+    return (
+        state.get('status'),
+        state.get('league'),
+        state.get('created_at'),
+        state.get('finished_at', state.get('created_at')) if complete else None,
+        json.dumps(game_winners(state)) if complete else None,
+    )
+
+def player_rows(game_id, state):
+    labels = state.get('player_labels', {})
+    bets = state.get('bets', {})
+    folded = state.get('folded', [])
+    winners = game_winners(state)
+
+    return [(game_id, player, seat, labels.get(player), bets.get(player), player in folded, player in winners)
+            for seat, player in enumerate(state.get('players', []))]
+
+# Live and archived games together, see Connection(archive=True)
+all_games = """
+  (SELECT game_id, league, status, created_at FROM main.game
+   UNION ALL SELECT game_id, league, status, created_at FROM archive.game)
+"""
+
+def recent_games_query(league, limit, offset=0, archived=False):
+    source = all_games if archived else "game"
+
+    if league == '*':
+        query = f"SELECT game_id, created_at FROM {source} WHERE status = 'complete' ORDER BY created_at DESC, game_id DESC LIMIT ? OFFSET ?"
+        return query, (limit, offset)
+
+    query = f"SELECT game_id, created_at FROM {source} WHERE league = ? AND status = 'complete' ORDER BY created_at DESC, game_id DESC LIMIT ? OFFSET ?"
+    return query, (league, limit, offset)
+
+def tally_results(results):
+    """recent_results() rows summed to (player, label, games, wins, reps_owed)"""
+    totals = {}
+
+    for game_id, player, label, won, bet in results:
+        entry = totals.setdefault(player, [player, None, 0, 0, 0])
+        entry[1] = label or player
+        entry[2] += 1
+        entry[3] += won
+        entry[4] += 0 if won else bet
+
+    return [tuple(entry) for entry in totals.values()]
+
+class DbStats():
+    """Connection opens and transaction timings for this worker"""
+
     def __init__(self):
-        pass
+        self.lock = threading.Lock()
+        self.open_ms = Timing()
+        self.rollbacks = 0
+        self.begin_ms = Timing()
+        self.held_ms = Timing()
+
+    def opened(self, open_ms):
+        with self.lock:
+            self.open_ms.add(open_ms)
+
+    def finished(self, begin_ms, held_ms, committed):
+        with self.lock:
+            self.rollbacks += 0 if committed else 1
+            self.begin_ms.add(begin_ms)
+            self.held_ms.add(held_ms)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'opens': self.open_ms.count,
+                'open_ms_avg': self.open_ms.avg,
+                'transactions': self.begin_ms.count,
+                'rollbacks': self.rollbacks,
+                **self.begin_ms.stats('begin_ms'),
+                **self.held_ms.stats('held_ms'),
+            }
+
+db_stats = DbStats()
+
+_local = threading.local()
+
+_migrated_archives = set()
+
+def connect(fn, archive_fn=None):
+    """This thread's connection to fn, opened and configured on first use.
+
+    Connections are never shared between threads, and are dropped after a
+    fork so gunicorn workers don't inherit the master's. With archive_fn the
+    archive database is attached as `archive`, on a connection of its own.
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+
+    conn = _local.connections.get((fn, archive_fn))
+
+    if conn is None:
+        start = time.perf_counter()
+        # Transactions are begun and ended explicitly by Connection
+        conn = sqlite3.connect(fn, timeout=busy_timeout_ms / 1000, isolation_level=None, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute(f'PRAGMA synchronous={synchronous};')
+        conn.execute(f'PRAGMA cache_size=-{cache_size_kb};')
+        conn.execute(f'PRAGMA mmap_size={mmap_size_mb * 1024 * 1024};')
+        conn.execute(f'PRAGMA busy_timeout={busy_timeout_ms};')
+
+        if archive_fn:
+            if archive_fn not in _migrated_archives:
+                migrate(archive_fn, archive=True)
+                _migrated_archives.add(archive_fn)
+            conn.execute("ATTACH DATABASE ? AS archive;", (archive_fn,))
+
+        _local.connections[(fn, archive_fn)] = conn
+        db_stats.opened((time.perf_counter() - start) * 1000)
+
+    return conn
+
+def close():
+    """Closes this thread's connections"""
+    for conn in getattr(_local, 'connections', {}).values():
+        conn.close()
+    _local.connections = {}
+
+# Constant SQL so sqlite3's per connection statement cache keeps them prepared
+load_game_sql = "SELECT state FROM game WHERE game_id = ?;"
+save_game_sql = """
+  INSERT INTO game (game_id, state, status, league, created_at, finished_at, winners) VALUES (?, ?, ?, ?, ?, ?, ?)
+  ON CONFLICT (game_id) DO UPDATE SET state = excluded.state, status = excluded.status, league = excluded.league,
+    created_at = excluded.created_at, finished_at = excluded.finished_at, winners = excluded.winners
+"""
+delete_players_sql = "DELETE FROM game_player WHERE game_id = ?;"
+insert_player_sql = "INSERT INTO game_player (game_id, player, seat, label, bet, folded, won) VALUES (?, ?, ?, ?, ?, ?, ?);"
+state_format_sql = "SELECT value FROM setting WHERE key = 'state_format';"
+load_actions_sql = "SELECT seq, action, player, name FROM game_action WHERE game_id = ? AND seq > ? ORDER BY seq;"
+append_action_sql = "INSERT INTO game_action (game_id, seq, action, player, name, created_at) VALUES (?, ?, ?, ?, ?, ?);"
+game_version_sql = "SELECT (SELECT MAX(seq) FROM game_action WHERE game_id = ?1) FROM game WHERE game_id = ?1;"
+
+# Each database's state format, read once per process. convert_states()
+# forgets it, other processes pick the new format up when they restart,
+# rows in either are read the same.
+_state_formats = {}
+
+class Connection():
+    def __init__(self, write=True, fn=None, archive=False):
+        # Read only users (stats) skip the write lock entirely
+        self.write = write
+        self.fn = fn or db_url
+        # History reads include archived games, see poker.archive
+        self.archive = archive
 
     def __enter__(self):
-        self.conn = sqlite3.connect(db_url, timeout=30.0)
-        # Enable WAL mode for better concurrency
-        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn = connect(self.fn, archive_db_url if self.archive else None)
+
+        if self.conn.in_transaction:
+            raise RuntimeError("Connection is already in a transaction on this thread")
+
+        start = time.perf_counter()
         # Begin immediate transaction to lock the database
-        self.conn.execute('BEGIN IMMEDIATE;')
+        self.conn.execute('BEGIN IMMEDIATE;' if self.write else 'BEGIN;')
+        self.began = time.perf_counter()
+        self.begin_ms = (self.began - start) * 1000
         return self
 
     def __exit__(self, type, value, traceback):
-        if type is None:
-            # No exception occurred, commit the transaction
-            self.conn.commit()
-        else:
-            # Exception occurred, rollback the transaction
-            self.conn.rollback()
-        self.conn.close()
+        committed = False
+
+        try:
+            if type is None:
+                # No exception occurred, commit the transaction
+                self.conn.execute('COMMIT;')
+                committed = True
+        finally:
+            if self.conn.in_transaction:
+                # Exception occurred, rollback the transaction
+                self.conn.execute('ROLLBACK;')
+
+            db_stats.finished(self.begin_ms, (time.perf_counter() - self.began) * 1000, committed)
 
     def load_game(self, game_id):
-        query = "SELECT state FROM game WHERE game_id = ?;"
-        cur = self.conn.cursor()
-        cur.execute(query, (game_id,))
-        rows = cur.fetchall()
+        rows = self.conn.execute(load_game_sql, (game_id,)).fetchall()
 
         if len(rows) == 0:
             return None
 
-        return json.loads(rows[0][0])
+        # Either format, whatever the database's current setting
+        return decode_state(rows[0][0])
+
+    def state_format(self):
+        fmt = _state_formats.get(self.fn)
+
+        if fmt is None:
+            row = self.conn.execute(state_format_sql).fetchone()
+            fmt = _state_formats[self.fn] = row[0] if row else 'json'
+
+        return fmt
 
     def save_game(self, game_id, state):
-        state = json.dumps(state)
-        stmt = "INSERT INTO game (game_id, state) VALUES (?, ?) ON CONFLICT (game_id) DO UPDATE SET state = ?"
+        blob = encode_state(state, self.state_format())
+        self.conn.execute(save_game_sql, (game_id, blob) + game_row(state))
+
+        self.save_players(game_id, state)
+
+    def load_actions(self, game_id, after_seq=0):
+        """(seq, action, player, name) of the game's actions after after_seq, in order"""
+        return self.conn.execute(load_actions_sql, (game_id, after_seq)).fetchall()
+
+    def append_action(self, game_id, seq, action, player, name):
+        self.conn.execute(append_action_sql, (game_id, seq, action, player, name, time.time()))
+
+    def game_version(self, game_id):
+        """seq of the game's last action, 0 before the first, None if there's no such game"""
+        row = self.conn.execute(game_version_sql, (game_id,)).fetchone()
+        return None if row is None else row[0] or 0
+
+    def save_players(self, game_id, state):
+        self.conn.execute(delete_players_sql, (game_id,))
+        self.conn.executemany(insert_player_sql, player_rows(game_id, state))
+
+    def recent_games(self, league, limit, offset=0):
+        """(game_id, created_at) of completed games, newest first. league '*' is every league."""
+        query, args = recent_games_query(league, limit, offset)
+        return self.conn.execute(query + ";", args).fetchall()
+
+    def recent_results(self, last_n, league='*'):
+        """(game_id, player, label, won, bet) for the last N completed games, oldest first.
+
+        Reads the (status, created_at) index and game_player, never the state blob.
+        """
+        # LIMIT -1 is no limit, as with the old complete[-0:]
+        recent, args = recent_games_query(league, last_n or -1, archived=self.archive)
+
+        if self.archive:
+            # Archived games' players are in the archive, each game's in one place
+            query = f"""
+              WITH g AS ({recent})
+              SELECT g.game_id, p.player, p.label, p.won, p.bet, g.created_at, p.seat FROM g JOIN main.game_player p ON p.game_id = g.game_id
+              UNION ALL
+              SELECT g.game_id, p.player, p.label, p.won, p.bet, g.created_at, p.seat FROM g JOIN archive.game_player p ON p.game_id = g.game_id
+              ORDER BY 6, 1, 7;
+            """
+        else:
+            query = f"""
+              SELECT g.game_id, p.player, p.label, p.won, p.bet
+              FROM ({recent}) g JOIN game_player p ON p.game_id = g.game_id
+              ORDER BY g.created_at, g.game_id, p.seat;
+            """
+
+        return [(row[0], row[1], row[2], bool(row[3]), row[4] or 0) for row in self.conn.execute(query, args)]
+
+    def game_results(self, game_id):
+        query = "SELECT game_id, player, label, won, bet FROM game_player WHERE game_id = ? ORDER BY seat;"
+        return [(game_id, player, label, bool(won), bet or 0) for game_id, player, label, won, bet in self.conn.execute(query, (game_id,))]
+
+    def player_stats(self, last_n, league='*'):
+        """(player, label, games, wins, reps_owed) over the last N completed games, 0 for all of them"""
+        if last_n == 0 or last_n in stats_windows:
+            query = "SELECT player, label, games, wins, reps_owed FROM player_stats WHERE league = ? AND last_n = ? AND games > 0;"
+            return self.conn.execute(query, (league, last_n)).fetchall()
+
+        return tally_results(self.recent_results(last_n, league))
+
+    def add_stats(self, league, last_n, results, sign):
+        stmt = """
+          INSERT INTO player_stats (player, league, last_n, label, games, wins, reps_owed) VALUES (?, ?, ?, ?, ?, ?, ?)
+          ON CONFLICT (league, last_n, player) DO UPDATE SET label = COALESCE(excluded.label, label),
+            games = games + excluded.games, wins = wins + excluded.wins, reps_owed = reps_owed + excluded.reps_owed
+        """
+        # Games leaving a window keep the label of the newer games still in it
+        self.conn.executemany(stmt, [(player, league, last_n, label if sign > 0 else None, sign, sign * won, 0 if won else sign * bet)
+                                     for game_id, player, label, won, bet in results])
+
+    def complete_game(self, game_id, state):
+        """Folds a newly completed game into player_stats.
+
+        Called from finish_game, inside the same transaction and before
+        save_game marks the row complete. Each window takes the game in and
+        drops its oldest one only if the game is among the last N created.
+        """
+        row = self.conn.execute("SELECT status FROM game WHERE game_id = ?;", (game_id,)).fetchone()
+        if row is not None and row[0] == 'complete':
+            return
+
+        results = [(game_id, player, label or player, won, bet or 0) for game_id, player, seat, label, bet, folded, won in player_rows(game_id, state)]
+        position = (state.get('created_at') or 0, game_id)
+
+        for league in ['*', state['league']]:
+            self.add_stats(league, 0, results, 1)
+
+            for last_n in stats_windows:
+                oldest = self.recent_games(league, 1, last_n - 1)
+
+                if not oldest:
+                    self.add_stats(league, last_n, results, 1)
+                elif position > (oldest[0][1] or 0, oldest[0][0]):
+                    self.add_stats(league, last_n, results, 1)
+                    self.add_stats(league, last_n, self.game_results(oldest[0][0]), -1)
+
+    def rebuild_stats(self):
+        """Recomputes player_stats from game_player, returns the number of rows written.
+
+        Open the connection with archive=True to count archived games too.
+        """
+        self.conn.execute("DELETE FROM player_stats;")
+
+        source = all_games if self.archive else "game"
+        leagues = ['*'] + [row[0] for row in self.conn.execute(f"SELECT DISTINCT league FROM {source} WHERE status = 'complete';")]
+        stmt = "INSERT INTO player_stats (player, league, last_n, label, games, wins, reps_owed) VALUES (?, ?, ?, ?, ?, ?, ?);"
+        written = 0
+
+        for league in leagues:
+            for last_n in [0] + stats_windows:
+                rows = tally_results(self.recent_results(last_n, league))
+                self.conn.executemany(stmt, [(row[0], league, last_n) + row[1:] for row in rows])
+                written += len(rows)
+
+        return written
+
+    def enqueue_message(self, thread, method, kwargs, not_before):
+        stmt = "INSERT INTO outbox (thread, method, kwargs, created_at, not_before) VALUES (?, ?, ?, ?, ?);"
+        return self.conn.execute(stmt, (thread, method, json.dumps(kwargs), time.time(), not_before)).lastrowid
+
+    def claim_messages(self, now, lease, limit, due=None, quotas=None, held=None):
+        """Claims the oldest pending message of up to `limit` threads, if it is due by `due` (default now).
+
+        A thread's next message is never claimable until the one before it
+        is sent or given up on, so each thread is delivered in order.
+        quotas caps how many are claimed per method, e.g. {'chat_postMessage': 2}.
+        The methods whose due messages a quota kept back are added to held.
+        """
+        quotas = quotas or {}
+        query = """
+          SELECT o.id, o.method, o.kwargs, o.attempts, o.not_before FROM outbox o
+          WHERE o.status = 'pending' AND o.not_before <= ? AND (o.claimed_until IS NULL OR o.claimed_until < ?)
+            AND o.id = (SELECT MIN(id) FROM outbox WHERE thread = o.thread AND status = 'pending')
+          ORDER BY o.id;
+        """
+        rows = []
+        counts = {}
+
+        for row in self.conn.execute(query, (now if due is None else due, now)):
+            if len(rows) >= limit:
+                break
+
+            if counts.get(row[1], 0) < quotas.get(row[1], limit):
+                counts[row[1]] = counts.get(row[1], 0) + 1
+                rows.append(row)
+            elif held is not None:
+                held.add(row[1])
 
-        cur = self.conn.cursor()
-        cur.execute(stmt, (game_id, state, state))
+        self.conn.executemany("UPDATE outbox SET claimed_until = ? WHERE id = ?;", [(now + lease, row[0]) for row in rows])
+        return [(id, method, json.loads(kwargs), attempts, not_before) for id, method, kwargs, attempts, not_before in rows]
+
+    def message_sent(self, id, now):
+        self.conn.execute("UPDATE outbox SET status = 'sent', sent_at = ?, claimed_until = NULL, attempts = attempts + 1 WHERE id = ?;", (now, id))
+
+    def defer_message(self, id, not_before):
+        """Puts a claimed message back until not_before, without counting an attempt"""
+        self.conn.execute("UPDATE outbox SET not_before = ?, claimed_until = NULL WHERE id = ?;", (not_before, id))
+
+    def message_failed(self, id, error, retry_at):
+        """Schedules a retry at retry_at, or gives up on the message if that is None"""
+        if retry_at is None:
+            stmt = "UPDATE outbox SET status = 'failed', error = ?, claimed_until = NULL, attempts = attempts + 1 WHERE id = ?;"
+            self.conn.execute(stmt, (error, id))
+        else:
+            stmt = "UPDATE outbox SET not_before = ?, error = ?, claimed_until = NULL, attempts = attempts + 1 WHERE id = ?;"
+            self.conn.execute(stmt, (retry_at, error, id))
+
+    def pending_messages(self):
+        return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending';").fetchone()[0]
+
+    def prune_messages(self, before):
+        """Deletes messages sent before the given time, returns how many"""
+        return self.conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?;", (before,)).rowcount
 
     def commit(self):
         # Commit is now handled automatically in __exit__
         pass
 
+def migrate(fn, archive=False):
+    """Brings a database of any age up to the current schema, online.
+
+    Schema changes are additive, and rows are backfilled from their state blob
+    a batch per transaction so running games are never blocked for long.
+    Safe to run from several workers at once. An archive database (see
+    poker.archive) only gets the game, game_player and game_action tables.
+    """
+    conn = sqlite3.connect(fn, timeout=30.0)
+    conn.execute('PRAGMA journal_mode=WAL;')
+
+    conn.execute('BEGIN IMMEDIATE;')
+    conn.execute(game_table_ddl)
+    conn.execute(game_player_table_ddl)
+    conn.execute(game_action_table_ddl)
+
+    has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'player_stats';").fetchone()
+
+    if not archive:
+        conn.execute(setting_table_ddl)
+        conn.execute("INSERT OR IGNORE INTO setting (key, value) VALUES ('state_format', ?);", (default_state_format,))
+        conn.execute(player_stats_table_ddl)
+        conn.execute(outbox_table_ddl)
+
+    existing = [row[1] for row in conn.execute("PRAGMA table_info(game);")]
+    for name, type in game_columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE game ADD COLUMN {name} {type};")
+
+    for ddl in game_index_ddl if archive else index_ddl:
+        conn.execute(ddl)
+    conn.commit()
+
+    # Rows written before the migration have no status column yet
+    migrated = 0
+
+    while True:
+        conn.execute('BEGIN IMMEDIATE;')
+        rows = conn.execute("SELECT game_id, state FROM game WHERE status IS NULL LIMIT ?;", (migrate_batch_size,)).fetchall()
+
+        for game_id, state in rows:
+            state = decode_state(state)
+            # Keeps the row out of the next batch even if the state has no status
+            columns = (state.get('status') or 'unknown',) + game_row(state)[1:]
+            conn.execute("UPDATE game SET status = ?, league = ?, created_at = ?, finished_at = ?, winners = ? WHERE game_id = ?;",
+                         columns + (game_id,))
+            conn.execute(delete_players_sql, (game_id,))
+            conn.executemany(insert_player_sql, player_rows(game_id, state))
+
+        conn.commit()
+        migrated += len(rows)
+
+        if len(rows) < migrate_batch_size:
+            break
+
+    conn.close()
+
+    # First run with player_stats, fill it from the games backfilled above
+    if not has_stats and not archive:
+        with Connection(fn=fn) as stats:
+            stats.rebuild_stats()
+
+    return migrated
+
+def convert_states(fn, fmt):
+    """Rewrites every game state in fmt, a batch per transaction, and makes
+    it the database's format for new writes. Returns the number converted.
+    """
+    if fmt not in formats:
+        raise ValueError(f"state format must be one of {formats}")
+
+    # sqlite's own type for each format's rows
+    stored_type = 'blob' if fmt == 'binary' else 'text'
+    converted = 0
+
+    with Connection(fn=fn) as conn:
+        conn.conn.execute("INSERT OR REPLACE INTO setting (key, value) VALUES ('state_format', ?);", (fmt,))
+
+    _state_formats.pop(fn, None)
+
+    while True:
+        with Connection(fn=fn) as conn:
+            query = "SELECT game_id, state FROM game WHERE typeof(state) != ? LIMIT ?;"
+            rows = conn.conn.execute(query, (stored_type, migrate_batch_size)).fetchall()
+
+            conn.conn.executemany("UPDATE game SET state = ? WHERE game_id = ?;",
+                                  [(encode_state(decode_state(state), fmt), game_id) for game_id, state in rows])
+
+        converted += len(rows)
+
+        if len(rows) < migrate_batch_size:
+            return converted
+
 def bootstrap(fn):
     conn = sqlite3.connect(fn)
     print(f'Connected to {fn}')
@@ -64,5 +638,24 @@ def bootstrap(fn):
     conn.commit()
     conn.close()
 
+    print(f'Migrated {migrate(fn)} existing games')
+
+def rebuild_stats(fn):
+    with Connection(fn=fn, archive=True) as conn:
+        print(f'Wrote {conn.rebuild_stats()} player_stats rows for windows {[0] + stats_windows}')
+
 if __name__=='__main__':
-    bootstrap(db_url)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', default='bootstrap', choices=['bootstrap', 'rebuild-stats', 'convert-state'])
+    parser.add_argument('format', nargs='?', choices=formats, help="for convert-state")
+    parser.add_argument('--db', default=db_url, help="database path (default DATABASE_URL or poker.db)")
+    args = parser.parse_args()
+
+    if args.command == 'rebuild-stats':
+        rebuild_stats(args.db)
+    elif args.command == 'convert-state':
+        if args.format is None:
+            parser.error("convert-state needs a format")
+        print(f'Converted {convert_states(args.db, args.format)} game states to {args.format}')
+    else:
+        bootstrap(args.db)
@@ -0,0 +1,399 @@
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import poker.ratelimit as ratelimit
+import poker.storage as storage
+from poker.scheduler import scheduler
+from poker.timing import Timing
+
+# A claimed message is retried by any worker once its lease runs out, which is
+# how messages claimed by a worker that crashed mid-send get delivered
+lease = float(os.environ.get("OUTBOX_LEASE") or 30.0)
+max_attempts = int(os.environ.get("OUTBOX_MAX_ATTEMPTS") or 8)
+max_backoff = float(os.environ.get("OUTBOX_MAX_BACKOFF") or 300.0)
+# Messages are sent when they're due by the worker that queued them, this is
+# how long ones left by another worker or a previous run can wait
+poll_interval = float(os.environ.get("OUTBOX_POLL_INTERVAL") or 5.0)
+# Sent messages are kept this long for debugging
+keep_sent = float(os.environ.get("OUTBOX_KEEP_SENT") or 86400.0)
+# Messages sent at once, each from a different chain (see Recorder.record),
+# 1 sends them one by one on the dispatcher's thread
+concurrency = int(os.environ.get("OUTBOX_CONCURRENCY") or 8)
+
+# Longest call() waits for rate limits and retries in all, it holds up the
+# request it was made for
+call_max_wait = float(os.environ.get("SLACK_CALL_MAX_WAIT") or 5.0)
+
+batch_size = 50
+
+class Recorder():
+    """Stands in for the Slack WebClient inside a transaction.
+
+    Calls are written to the outbox with the game's state changes and only
+    sent once the transaction commits. sleep() delays the messages recorded
+    after it instead of holding the write lock, pass `due` to wake() so the
+    dispatcher is woken for them.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.delay = 0.0
+        self.due = []
+
+    def sleep(self, seconds):
+        self.delay += seconds
+
+    def record(self, method, kwargs, own_chain=False):
+        # Messages are sent in order within a chain, a thread's messages by
+        # default, and chains independently of each other. A player's hand
+        # only has to follow the ones before it to them, so dealing sends
+        # every hand at once.
+        thread = kwargs.get('thread_ts') or kwargs.get('channel')
+        if own_chain:
+            thread = f"{thread}:{kwargs.get('user')}"
+
+        not_before = time.time() + self.delay
+        id = self.conn.enqueue_message(thread, method, kwargs, not_before)
+
+        if self.delay > 0:
+            self.due.append(not_before)
+
+        return {'ok': True, 'outbox_id': id}
+
+    def chat_postMessage(self, **kwargs):
+        return self.record('chat_postMessage', kwargs)
+
+    def chat_postEphemeral(self, own_chain=False, **kwargs):
+        return self.record('chat_postEphemeral', kwargs, own_chain)
+
+class Discard():
+    """Recorder that drops every message"""
+
+    def sleep(self, seconds):
+        pass
+
+    def chat_postMessage(self, **kwargs):
+        return {'ok': True}
+
+    def chat_postEphemeral(self, own_chain=False, **kwargs):
+        return {'ok': True}
+
+class OutboxStats():
+    """Deliveries by this worker's dispatcher, and calls through call()"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.failed = 0
+        self.lag_ms = Timing()
+        self.send_ms = Timing()
+        # method: {'send_ms': Timing, 'throttled', 'rate_limited'}
+        self.methods = {}
+
+    def _method(self, method):
+        if method not in self.methods:
+            self.methods[method] = {'send_ms': Timing(), 'throttled': 0, 'rate_limited': 0}
+        return self.methods[method]
+
+    def called(self, method, send_ms):
+        with self.lock:
+            self._method(method)['send_ms'].add(send_ms)
+
+    def delivered(self, method, lag_ms, send_ms):
+        self.called(method, send_ms)
+
+        with self.lock:
+            self.lag_ms.add(lag_ms)
+            self.send_ms.add(send_ms)
+
+    def errored(self, gave_up):
+        with self.lock:
+            if gave_up:
+                self.failed += 1
+            else:
+                self.retries += 1
+
+    def throttled(self, method):
+        with self.lock:
+            self._method(method)['throttled'] += 1
+
+    def rate_limited(self, method):
+        with self.lock:
+            self._method(method)['rate_limited'] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sent': self.lag_ms.count,
+                'retries': self.retries,
+                'failed': self.failed,
+                # From when a message was due to when Slack accepted it
+                **self.lag_ms.stats('lag_ms'),
+                'send_ms_avg': self.send_ms.avg,
+                # throttled: times this worker's rate limit ran out, holding
+                # the method's messages back, rate_limited: 429s from Slack
+                'methods': {method: {
+                    'sent': counts['send_ms'].count,
+                    **counts['send_ms'].stats('send_ms'),
+                    'throttled': counts['throttled'],
+                    'rate_limited': counts['rate_limited'],
+                } for method, counts in self.methods.items()},
+            }
+
+outbox_stats = OutboxStats()
+
+def backoff(attempts):
+    return min(max_backoff, 2.0 ** attempts)
+
+class Busy(Exception):
+    """Slack couldn't take a call() within call_max_wait"""
+
+def call(slack, method, **kwargs):
+    """Calls Slack right away, for responses the caller needs such as a new message's ts.
+
+    Waits for the method's rate limit, and retries a 429 after its
+    Retry-After and other errors that may go away with backoff. Raises Busy
+    rather than wait past call_max_wait, or when out of attempts.
+    """
+    bucket = ratelimit.buckets.get(method)
+    deadline = time.monotonic() + call_max_wait
+
+    for attempts in range(max_attempts):
+        if bucket is not None:
+            while bucket.available() < 1:
+                wait = bucket.wait()
+                if time.monotonic() + wait > deadline:
+                    raise Busy(f"Slack {method} rate limited for another {wait:.1f}s")
+                time.sleep(wait)
+            bucket.take()
+
+        start = time.time()
+
+        try:
+            response = getattr(slack, method)(**kwargs)
+        except Exception as e:
+            wait = ratelimit.retry_after(e)
+
+            if wait is not None:
+                outbox_stats.rate_limited(method)
+                if bucket is not None:
+                    bucket.pause(wait)
+            elif not ratelimit.retryable(e):
+                raise
+            else:
+                wait = min(backoff(attempts), 10.0)
+
+            # No sleeping for a retry that won't be made
+            if attempts + 1 >= max_attempts or time.monotonic() + wait > deadline:
+                raise Busy(f"Slack {method} failed after {attempts + 1} attempts: {e!r}") from e
+
+            logging.warning(f"Slack {method} failed, retrying in {wait:.1f}s: {e!r}")
+            time.sleep(wait)
+            continue
+
+        outbox_stats.called(method, (time.time() - start) * 1000)
+        return response
+
+def send(slack, message):
+    """Sends one claimed message, returns it with the error if any and when it was sent"""
+    id, method, kwargs, attempts, not_before = message
+    start = time.time()
+
+    try:
+        getattr(slack, method)(**kwargs)
+    except Exception as e:
+        return message, e, start, time.time()
+
+    return message, None, start, time.time()
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def sender_pool():
+    global _pool, _pool_key
+
+    # Made again after a fork, the threads don't survive it
+    with _pool_lock:
+        if _pool is None or _pool_key != (os.getpid(), concurrency):
+            if _pool is not None:
+                # Lets a changed concurrency's old threads exit once idle
+                _pool.shutdown(wait=False)
+
+            _pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='slack-send')
+            _pool_key = (os.getpid(), concurrency)
+
+    return _pool
+
+def deliver(slack, now=None):
+    """Sends every message due by `now` (default the time), in order per chain. Returns how many were sent.
+
+    Up to `concurrency` messages are in flight at once, each the next of a
+    different chain. A chain's next message is claimed as soon as the one
+    before it is sent, without waiting for the others.
+    """
+    sent = 0
+    in_flight = set()
+    # Set as each send finishes
+    progress = threading.Event()
+
+    while True:
+        progress.clear()
+        done = {future for future in in_flight if future.done()}
+        in_flight -= done
+
+        if done:
+            sent += finished([future.result() for future in done])
+
+        # Inline, a batch at a time
+        room = batch_size if concurrency <= 1 else concurrency - len(in_flight)
+
+        claimed = []
+        if room > 0:
+            # Methods whose bucket is empty wait for it, the others go ahead
+            quotas = {method: bucket.available() for method, bucket in ratelimit.buckets.items()}
+            # Only methods with due messages left waiting count as throttled
+            held = set()
+
+            with storage.transaction() as conn:
+                claimed = conn.claim_messages(time.time(), lease, room, due=now, quotas=quotas, held=held)
+
+            for message in claimed:
+                if message[1] in ratelimit.buckets:
+                    ratelimit.buckets[message[1]].take()
+
+            for method in held:
+                throttled(method)
+
+        for message in claimed:
+            if concurrency <= 1:
+                sent += finished([send(slack, message)])
+                continue
+
+            future = sender_pool().submit(send, slack, message)
+            future.add_done_callback(lambda future: progress.set())
+            in_flight.add(future)
+
+        if not in_flight and not claimed:
+            return sent
+
+        # Messages falling due meanwhile wait for the next send to finish
+        if in_flight and not done and not claimed:
+            progress.wait(poll_interval)
+
+_refills = {}
+_refills_lock = threading.Lock()
+
+def throttled(method):
+    """Wakes the dispatcher when the method's bucket has a call again, once per time it runs dry"""
+    with _refills_lock:
+        if _refills.get(method, 0.0) > time.time():
+            return
+
+        _refills[method] = time.time() + ratelimit.buckets[method].wait()
+        scheduler.call_at(_refills[method], _wakeup.set)
+
+    outbox_stats.throttled(method)
+
+def finished(results):
+    """Records the outcome of sends, returns how many succeeded"""
+    # When failed messages are retried, None if they're given up on
+    retry_at = {}
+    # Rate limited messages go back without counting an attempt
+    retry_after = {}
+    sent = 0
+
+    with storage.transaction() as conn:
+        for (id, method, kwargs, attempts, not_before), error, start, end in results:
+            if error is None:
+                conn.message_sent(id, end)
+                continue
+
+            wait = ratelimit.retry_after(error)
+
+            if wait is not None:
+                retry_after[id] = wait
+                conn.defer_message(id, time.time() + wait)
+            else:
+                gave_up = attempts + 1 >= max_attempts or not ratelimit.retryable(error)
+                retry_at[id] = None if gave_up else time.time() + backoff(attempts)
+                conn.message_failed(id, repr(error), retry_at[id])
+
+    for (id, method, kwargs, attempts, not_before), error, start, end in results:
+        if error is None:
+            outbox_stats.delivered(method, (end - not_before) * 1000, (end - start) * 1000)
+            sent += 1
+            continue
+
+        if id in retry_after:
+            logging.warning(f"Outbox message {id} rate limited, retrying in {retry_after[id]:.1f}s")
+            outbox_stats.rate_limited(method)
+
+            if method in ratelimit.buckets:
+                ratelimit.buckets[method].pause(retry_after[id])
+
+            scheduler.call_later(retry_after[id], _wakeup.set)
+            continue
+
+        gave_up = retry_at[id] is None
+        logging.error(f"Outbox message {id} failed" + (", giving up" if gave_up else ""), exc_info=error)
+        outbox_stats.errored(gave_up)
+
+        if not gave_up:
+            scheduler.call_at(retry_at[id], _wakeup.set)
+
+    return sent
+
+_wakeup = threading.Event()
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+def _dispatch_loop(slack):
+    last_prune = 0.0
+
+    while True:
+        _wakeup.clear()
+
+        try:
+            deliver(slack)
+
+            if time.time() - last_prune > 3600:
+                with storage.transaction() as conn:
+                    conn.prune_messages(time.time() - keep_sent)
+                last_prune = time.time()
+        except Exception:
+            logging.exception("Outbox dispatch failed")
+
+        # Woken by wake() and the scheduler when this worker's messages are due
+        _wakeup.wait(poll_interval)
+
+def wake(slack, due=()):
+    """Has this worker's dispatcher send what was just committed, starting it if needed.
+
+    due is when messages recorded for later become due, Recorder.due.
+    """
+    global _dispatcher, _dispatcher_pid
+
+    # Started lazily, and again after a fork, so the thread belongs to the
+    # gunicorn worker
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            _dispatcher = threading.Thread(target=_dispatch_loop, args=(slack,), name='slack-outbox', daemon=True)
+            _dispatcher_pid = os.getpid()
+            _dispatcher.start()
+
+    for when in due:
+        scheduler.call_at(when, _wakeup.set)
+
+    _wakeup.set()
+
+def stats():
+    with storage.transaction(write=False) as conn:
+        pending = conn.pending_messages()
+
+    return dict(outbox_stats.stats(), pending=pending)
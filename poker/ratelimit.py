@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+
+# Slack's limits per method, as calls per second with bursts. chat.postMessage
+# allows about one message per second per channel with short bursts,
+# chat.postEphemeral is Tier 4 (100+ per minute). The games share a channel,
+# so per method is per channel here. Each worker has its own buckets, with
+# several workers a 429 can still happen and is honored (see Retry-After).
+post_message_rate = float(os.environ.get("SLACK_POST_MESSAGE_RATE") or 1.0)
+post_message_burst = int(os.environ.get("SLACK_POST_MESSAGE_BURST") or 5)
+post_ephemeral_rate = float(os.environ.get("SLACK_POST_EPHEMERAL_RATE") or 2.0)
+post_ephemeral_burst = int(os.environ.get("SLACK_POST_EPHEMERAL_BURST") or 20)
+
+# Errors that sending the same call again can't fix
+permanent_errors = {
+  'channel_not_found', 'not_in_channel', 'is_archived', 'user_not_in_channel', 'user_not_found',
+  'msg_too_long', 'no_text', 'invalid_blocks', 'invalid_arguments', 'too_many_attachments',
+  'invalid_auth', 'not_authed', 'account_inactive', 'token_revoked', 'missing_scope',
+}
+
+class TokenBucket():
+    """Up to `burst` calls at once, refilled at `rate` a second"""
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # Set from a 429's Retry-After
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """Whole calls that can be made now"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return 0
+
+            self._refill(now)
+            return int(self.tokens)
+
+    def take(self, n=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+
+    def wait(self):
+        """Seconds until the next call can be made"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            refill = max(0.0, (1 - self.tokens) / self.rate)
+            return max(refill, self.paused_until - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+buckets = {
+  'chat_postMessage': TokenBucket(post_message_rate, post_message_burst),
+  'chat_postEphemeral': TokenBucket(post_ephemeral_rate, post_ephemeral_burst),
+}
+
+def retry_after(error):
+    """Seconds a 429 said to wait, None if the error isn't a rate limit"""
+    response = getattr(error, 'response', None)
+
+    if response is None or getattr(response, 'status_code', None) != 429:
+        return None
+
+    headers = {name.lower(): value for name, value in (getattr(response, 'headers', None) or {}).items()}
+
+    try:
+        return float(headers.get('retry-after') or 1)
+    except ValueError:
+        return 1.0
+
+def retryable(error):
+    """False for errors Slack will give again however many times it's asked"""
+    data = getattr(getattr(error, 'response', None), 'data', None)
+
+    # Timeouts, dropped connections and 5xx have no error code
+    if not isinstance(data, dict):
+        return True
+
+    return data.get('error') not in permanent_errors
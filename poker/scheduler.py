@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from poker.timing import Timing
+
+# Calls functions at given times from one background thread per worker, a
+# heap of timers ordered by when they're due. Callbacks run on that thread
+# and must be quick, e.g. waking the thread that does the real work.
+
+class Timer():
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class SchedulerStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        self.cancelled = 0
+        self.late_ms = Timing()
+
+    def added(self):
+        with self.lock:
+            self.scheduled += 1
+
+    def fired(self, late_ms, cancelled):
+        with self.lock:
+            if cancelled:
+                self.cancelled += 1
+                return
+
+            self.late_ms.add(late_ms)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'scheduled': self.scheduled,
+                'ran': self.late_ms.count,
+                'cancelled': self.cancelled,
+                # From when a timer was due to when its callback started
+                **self.late_ms.stats('late_ms'),
+            }
+
+class Scheduler():
+    def __init__(self, name):
+        self.name = name
+        self.cond = threading.Condition()
+        self.heap = []
+        # Ties go in the order they were scheduled
+        self.counter = itertools.count()
+        self.thread = None
+        self.pid = None
+        self.scheduler_stats = SchedulerStats()
+
+    def call_at(self, when, fn, *args):
+        """Calls fn(*args) at time.time() `when`, or as soon as possible if that's past"""
+        timer = Timer(when, fn, args)
+
+        with self.cond:
+            # Started lazily, and again after a fork, so the thread belongs to
+            # the gunicorn worker. Timers set before the fork are the master's.
+            if self.thread is None or self.pid != os.getpid():
+                self.heap = []
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.pid = os.getpid()
+                self.thread.start()
+
+            heapq.heappush(self.heap, (when, next(self.counter), timer))
+
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+
+        self.scheduler_stats.added()
+        return timer
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(time.time() + delay, fn, *args)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+
+                when, _, timer = heapq.heappop(self.heap)
+
+            self.scheduler_stats.fired((time.time() - when) * 1000, timer.cancelled)
+
+            if timer.cancelled:
+                continue
+
+            try:
+                timer.fn(*timer.args)
+            except Exception:
+                logging.exception(f"Scheduled call to {timer.fn} failed")
+
+    def stats(self):
+        with self.cond:
+            pending = len(self.heap)
+
+        return dict(self.scheduler_stats.stats(), pending=pending)
+
+scheduler = Scheduler('scheduler')
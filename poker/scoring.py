@@ -1,42 +1,45 @@
 import itertools
+import math
+import mmap
+import os
+import random
+import struct
 
-from collections import defaultdict
-
-from poker.structures import cards
+from poker.structures import cards, card_ordinals, card_suits, card_masks, card_suit_counters
+from poker.structures import rank_mask, rank_counts, suit_counts, suit_lane, count_of
 
 ####################### Helpers #######################
 
-def is_flush(hand):
-  if len(set([cards[c]['suit'] for c in hand])) == 1:
-     return True
+# Rank masks, bit (ordinal - 2) is set when that ordinal is present
+_ROYAL = 0b1111100000000
+_WHEEL = 0b1000000001111
 
-  return False
+def is_flush(hand):
+  return suit_counts(hand) == len(hand) << (4 * card_suits[hand[0]])
 
 def is_straight(hand):
-  ords = sorted([cards[c]['ordinal'] for c in hand])
-  if ords == [2, 3, 4, 5, 14]:
+  mask = rank_mask(hand)
+  if mask == _WHEEL and len(hand) == 5:
     # special case - the "wheel" straight where Ace is low
     return True
 
-  return ords == list(range(min(ords), max(ords) + 1))
+  # Distinct, consecutive ordinals fill a run of len(hand) bits
+  return mask // (mask & -mask) == (1 << len(hand)) - 1
 
 def is_x_of_a_kind(hand, x):
-  ord_counts = defaultdict(lambda: 0)
+  counts = rank_counts(hand)
 
-  for card in [cards[c] for c in hand]:
-    ord_counts[card['ordinal']] += 1
-
-  for ord, count in ord_counts.items():
-    if count == x:
+  for ord in range(14, 1, -1):
+    if count_of(counts, ord) == x:
       return (True, ord)
 
   return (False, None)
 
 def max_ordinal(hand):
-    return max([cards[c]['ordinal'] for c in hand])
+    return max([card_ordinals[c] for c in hand])
 
 def to_ords(hand):
-    return [cards[c]['ordinal'] for c in hand]
+    return [card_ordinals[c] for c in hand]
 
 ####################### Hand Checks #######################
 
@@ -45,7 +48,7 @@ def royal_flush(hand):
   if not is_flush(hand):
     return(False, [])
 
-  if set([cards[c]['ordinal'] for c in hand]) != set([10, 11, 12, 13, 14]):
+  if rank_mask(hand) != _ROYAL:
     return (False, [])
 
   # Holy shit nuggets
@@ -61,7 +64,7 @@ def four_of_a_kind(hand):
   result = is_x_of_a_kind(hand, 4)
 
   if result[0]:
-    last_card = [c for c in hand if cards[c]['ordinal'] != result[1]]
+    last_card = [c for c in hand if card_ordinals[c] != result[1]]
     assert len(last_card) == 1
     last_card = to_ords(last_card)[0]
     return (True, [result[1], last_card])
@@ -73,7 +76,7 @@ def full_house(hand):
   three = is_x_of_a_kind(hand, 3)
 
   if three[0]:
-    remaining = [c for c in hand if cards[c]['ordinal'] != three[1]]
+    remaining = [c for c in hand if card_ordinals[c] != three[1]]
     assert len(remaining) == 2
 
     two = is_x_of_a_kind(remaining, 2)
@@ -107,7 +110,7 @@ def three_of_a_kind(hand):
   three = is_x_of_a_kind(hand, 3)
 
   if three[0]:
-    remaining = [c for c in hand if cards[c]['ordinal'] != three[1]]
+    remaining = [c for c in hand if card_ordinals[c] != three[1]]
     assert len(remaining) == 2
     remaining = to_ords(remaining)
     return (True, [three[1], max(remaining), min(remaining)])
@@ -120,14 +123,14 @@ def two_pair(hand):
 
   if pair1[0]:
     
-    remaining = [c for c in hand if cards[c]['ordinal'] != pair1[1]]
+    remaining = [c for c in hand if card_ordinals[c] != pair1[1]]
     assert len(remaining) == 3
 
     pair2 = is_x_of_a_kind(remaining, 2)
 
     if pair2[0]:
       both = [pair1[1], pair2[1]]
-      last_card = [c for c in remaining if cards[c]['ordinal'] != pair2[1]]
+      last_card = [c for c in remaining if card_ordinals[c] != pair2[1]]
       assert len(last_card) == 1
       last_card = to_ords(last_card)[0]
       return (True, [max(both), min(both), last_card])
@@ -139,14 +142,14 @@ def pair(hand):
   pair = is_x_of_a_kind(hand, 2)
 
   if pair[0]:
-    remaining = [c for c in hand if cards[c]['ordinal'] != pair[1]]
+    remaining = [c for c in hand if card_ordinals[c] != pair[1]]
     assert len(remaining) == 3
     return (True, [pair[1]] +  list(reversed(sorted(to_ords(remaining)))))
 
   return (False, [])
 
 def high_card(hand):
-  return (True, list(reversed(sorted([cards[c]['ordinal'] for c in hand]))))
+  return (True, list(reversed(sorted(to_ords(hand)))))
   
 # The order in which hands are evaluated is super important yo. Don't reorder this list
 
@@ -194,43 +197,317 @@ ord_lexico = {
     14:  'E'
 }
 
+####################### Table Driven Evaluation #######################
 
-# This literally takes a minute
-def test():
-  hand_count   = defaultdict(lambda: 0)
-  hands_actual = defaultdict(lambda: [])
+# A hand's strength is packed into a single int: the index into `hands` sits
+# above five 4 bit ordinal fields, most significant first. Comparing two
+# strengths is the same as comparing the lists returned by best(), so the max
+# over a player's 5 card subsets can be looked up instead of searched for.
+
+CATEGORY_SHIFT = 20
+KICKER_BITS = 4
+
+def _pack(hand_rank, ords):
+  strength = hand_rank
+  for i in range(5):
+    strength = (strength << KICKER_BITS) | (ords[i] if i < len(ords) else 0)
+  return strength
+
+def strength(result):
+  """Packs a best() result into an int strength"""
+  return _pack(result[0], result[1:])
+
+def category(strength):
+  return strength >> CATEGORY_SHIFT
+
+def hand_name(strength):
+  return hands[category(strength)]['name']
+
+def kickers(strength):
+  """The ordinals best() would have returned after the category"""
+  rank_len = hands[category(strength)]['rank_len']
+  shifts = range(CATEGORY_SHIFT - KICKER_BITS, -1, -KICKER_BITS)
+  return [(strength >> shift) & 0xF for shift in shifts][:rank_len]
+
+def unpack(strength):
+  """Inverse of strength(), gives back the best() result"""
+  return [category(strength)] + kickers(strength)
+
+_STRAIGHTS = [(0b11111 << (high - 6), high) for high in range(14, 5, -1)]
+
+def _mask_ords(mask):
+  return [o for o in range(14, 1, -1) if mask & (1 << (o - 2))]
+
+def _flush_strength(mask):
+  if mask & _ROYAL == _ROYAL:
+    return _pack(9, [])
+
+  # straight_flush() scores by max_ordinal, so a suited wheel counts as ace
+  # high and beats every other straight flush. Keep that so winners don't change.
+  if mask & _WHEEL == _WHEEL:
+    return _pack(8, [14])
+
+  for straight, high in _STRAIGHTS:
+    if mask & straight == straight:
+      return _pack(8, [high])
+
+  return _pack(5, _mask_ords(mask)[:5])
+
+def _rank_strength(counts):
+  desc  = []
+  quads = []
+  trips = []
+  pairs = []
+  mask  = 0
+
+  for o in range(14, 1, -1):
+    n = counts[o - 2]
+    if n:
+      desc.append(o)
+      mask |= 1 << (o - 2)
+      if n == 4:
+        quads.append(o)
+      elif n == 3:
+        trips.append(o)
+      elif n == 2:
+        pairs.append(o)
+
+  if quads:
+    return _pack(7, [quads[0]] + [o for o in desc if o != quads[0]][:1])
+
+  if trips and len(trips) + len(pairs) > 1:
+    return _pack(6, [trips[0], max(trips[1:] + pairs)])
+
+  for straight, high in _STRAIGHTS:
+    if mask & straight == straight:
+      return _pack(4, [high])
+
+  if mask & _WHEEL == _WHEEL:
+    return _pack(4, [5])
+
+  if trips:
+    return _pack(3, [trips[0]] + [o for o in desc if o != trips[0]][:2])
+
+  if len(pairs) > 1:
+    return _pack(2, pairs[:2] + [o for o in desc if o not in pairs[:2]][:1])
+
+  if pairs:
+    return _pack(1, pairs[:1] + [o for o in desc if o != pairs[0]][:3])
+
+  return _pack(0, desc[:5])
+
+# Per card id digit of the base 5 rank multiset key used by _rank_table
+_card_rank_key = [5 ** (o - 2) for o in card_ordinals]
+
+# Indexed by the rank mask of the suited cards. Only consulted when 5+ cards
+# share a suit, so masks with fewer bits are left at 0.
+_flush_table = [_flush_strength(m) if bin(m).count('1') >= 5 else 0 for m in range(1 << 13)]
+
+# Keyed by the base 5 rank multiset of any 5, 6 or 7 cards, flushes ignored
+
+def _rank_multisets(n, rank=0):
+  # Yields (counts, key) for every way of spreading n cards over ranks >= rank
+  if rank == 12:
+    if n <= 4:
+      yield (n,), n * 5 ** 12
+    return
+
+  for k in range(min(n, 4) + 1):
+    for counts, key in _rank_multisets(n - k, rank + 1):
+      yield (k,) + counts, key + k * 5 ** rank
+
+# Building this takes most of a second, so it happens on first use rather than
+# at import time
+_rank_table = None
+
+def _build_rank_table():
+  global _rank_table
+
+  table = {}
+  for n in (5, 6, 7):
+    for counts, key in _rank_multisets(n):
+      table[key] = _rank_strength(counts)
+
+  _rank_table = table
+  return table
+
+def evaluate7(hand):
+  """Strength of the best 5 card hand within 5-7 card ids, as a packed int.
+
+  Agrees with the max over itertools.combinations(hand, 5) of best().
+  """
+  rank_key = 0
+  suit_key = 0
+  mask = 0
+
+  for c in hand:
+    rank_key += _card_rank_key[c]
+    suit_key += card_suit_counters[c]
+    mask |= card_masks[c]
 
-  counter = 0
+  strength = (_rank_table or _build_rank_table())[rank_key]
 
-  for hand in itertools.combinations(range(0, 52), 5):
+  # A suit's 4 bit counter only reaches its top bit once it holds 5+ cards
+  flushed = (suit_key + 0x3333) & 0x8888
 
-      result = best(hand)
+  if flushed:
+    suit = flushed.bit_length() // 4 - 1
+    strength = max(strength, _flush_table[suit_lane(mask, suit)])
 
-      counter += 1
-      hand_count[result[0]] += 1
+  return strength
 
-      s = " ".join([str(cards[c]['ordinal']) + cards[c]['suit'][0] for c in hand])
-      hands_actual[result[0]].append((s, ":".join([ord_lexico[i] for i in result[1:]])))
+####################### Batch Evaluation #######################
 
-  for idx, defn in enumerate(hands):
-    print(defn['name'] + ': ' + str(hand_count[idx]))
+# numpy is only needed for offline analysis, so the game server never imports it
 
-  print(counter)
+_batch_tables = None
 
-  assert hand_count[9] == 4
-  assert hand_count[8] == 36
-  assert hand_count[7] == 624
-  assert hand_count[6] == 3744
-  assert hand_count[5] == 5108
-  assert hand_count[4] == 10200
-  assert hand_count[3] == 54912
-  assert hand_count[2] == 123552
-  assert hand_count[1] == 1098240
-  assert hand_count[0] == 1302540
+def _build_batch_tables():
+  global _batch_tables
 
-  for hand, actuals in hands_actual.items():
-    actuals.sort(key=lambda x: x[1])
-    with open(hands[hand]['name'] + ".txt", 'w') as f:
-      for line in actuals:
-        f.write("  ".join(line))
-        f.write('\n')
+  import numpy as np
+
+  rank_table = _rank_table or _build_rank_table()
+  rank_keys = np.array(sorted(rank_table), dtype=np.int64)
+
+  _batch_tables = {
+    'rank_keys':      rank_keys,
+    'rank_strengths': np.array([rank_table[k] for k in rank_keys.tolist()], dtype=np.int64),
+    'flush':          np.array(_flush_table, dtype=np.int64),
+    'card_rank_key':  np.array(_card_rank_key, dtype=np.int64),
+    'card_suit_key':  np.array(card_suit_counters, dtype=np.int64),
+    'card_mask':      np.array(card_masks, dtype=np.uint64),
+    'flush_bits':     np.array([0x8 << (4 * s) for s in range(4)], dtype=np.int64),
+  }
+  return _batch_tables
+
+def best_batch(hands, chunk_size=1 << 18):
+  """evaluate7() for an (N, 5..7) array of card ids, as an (N,) int64 array.
+
+  Each row gets the same packed strength best() (or the best of its 5 card
+  subsets) would, but the lookups are done for a chunk of rows at a time.
+  Raises ValueError for a row with a card twice or whose ranks no hand
+  has, e.g. five aces.
+  """
+  import numpy as np
+
+  t = _batch_tables or _build_batch_tables()
+
+  hands = np.asarray(hands, dtype=np.intp)
+  assert hands.ndim == 2 and 5 <= hands.shape[1] <= 7
+
+  out = np.empty(len(hands), dtype=np.int64)
+
+  for start in range(0, len(hands), chunk_size):
+    chunk = hands[start:start + chunk_size]
+
+    # One bit per card, so they only add up to their union if none repeats
+    masks = t['card_mask'][chunk]
+    mask = np.bitwise_or.reduce(masks, axis=1)
+    repeated = np.nonzero(masks.sum(axis=1, dtype=np.uint64) != mask)[0]
+    if len(repeated):
+      raise ValueError(f"not a hand: {chunk[repeated[0]].tolist()}")
+
+    rank_key = t['card_rank_key'][chunk].sum(axis=1)
+    idx = np.minimum(np.searchsorted(t['rank_keys'], rank_key), len(t['rank_keys']) - 1)
+
+    # searchsorted gives a neighbour for keys no hand has, e.g. five aces
+    missing = np.nonzero(t['rank_keys'][idx] != rank_key)[0]
+    if len(missing):
+      raise ValueError(f"not a hand: {chunk[missing[0]].tolist()}")
+
+    strengths = t['rank_strengths'][idx]
+
+    # Same suit counter trick as evaluate7, on every row at once
+    flushed = (t['card_suit_key'][chunk].sum(axis=1) + 0x3333) & 0x8888
+    rows = np.nonzero(flushed)[0]
+
+    if len(rows):
+      suit = np.searchsorted(t['flush_bits'], flushed[rows]).astype(np.uint64)
+      lane = ((mask[rows] >> (np.uint64(13) * suit)) & np.uint64(0x1FFF)).astype(np.intp)
+      strengths[rows] = np.maximum(strengths[rows], t['flush'][lane])
+
+    out[start:start + chunk_size] = strengths
+
+  return out
+
+def all_hands(n=5):
+  """Every n card combination of the deck as an (N, n) int8 array"""
+  import numpy as np
+
+  combos = itertools.combinations(range(len(cards)), n)
+  flat = np.fromiter(itertools.chain.from_iterable(combos), dtype=np.int8)
+  return flat.reshape(-1, n)
+
+
+####################### Precomputed 5 Card Table #######################
+
+# poker/verify.py writes the strength of every 5 card hand to a flat file of
+# uint32s indexed by hand_index(). Bump the version whenever the strength
+# format or best() changes so stale tables get rebuilt instead of trusted.
+
+HAND_TABLE_MAGIC = b'PKHT'
+HAND_TABLE_VERSION = 1
+HAND_TABLE_HEADER = struct.Struct('<4sII')
+HAND_TABLE_SIZE = math.comb(52, 5)
+# Hands of a mapped table compared against best() before it's used
+HAND_TABLE_SPOT_CHECKS = 256
+
+hand_table_path = os.environ.get("HAND_TABLE_PATH") or 'hand_table.bin'
+
+def hand_index(hand):
+  """Colex position of a 5 card hand among all 2,598,960"""
+  idx = 0
+  for k, c in enumerate(sorted(hand), 1):
+    idx += math.comb(c, k)
+  return idx
+
+def sample_hands(n, seed=0):
+  """n random 5 card hands, the same ones for the same seed"""
+  rng = random.Random(seed)
+  return [rng.sample(range(len(cards)), 5) for _ in range(n)]
+
+def load_hand_table(path=None):
+  """Memory maps a table written by poker/verify.py, None if missing, stale or wrong"""
+  path = path or hand_table_path
+
+  try:
+    with open(path, 'rb') as f:
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (FileNotFoundError, ValueError):
+    return None
+
+  if len(mapped) != HAND_TABLE_HEADER.size + 4 * HAND_TABLE_SIZE:
+    return None
+
+  if HAND_TABLE_HEADER.unpack_from(mapped) != (HAND_TABLE_MAGIC, HAND_TABLE_VERSION, HAND_TABLE_SIZE):
+    return None
+
+  table = memoryview(mapped)[HAND_TABLE_HEADER.size:].cast('I')
+
+  # The header can't vouch for the strengths, e.g. a table left half written
+  # or built by a broken evaluator, so a sample is checked against best()
+  for hand in sample_hands(HAND_TABLE_SPOT_CHECKS):
+    if table[hand_index(hand)] != strength(best(hand)):
+      return None
+
+  return table
+
+_hand_table = None
+
+def evaluate5(hand):
+  """Strength of exactly 5 cards, read from the mapped table when there is one"""
+  global _hand_table
+
+  if _hand_table is None:
+    _hand_table = load_hand_table() or False
+
+  if _hand_table:
+    return _hand_table[hand_index(hand)]
+
+  return evaluate7(hand)
+
+def test():
+  """Checks every 5 card hand's category counts and a sample against best(), see poker/verify.py"""
+  from poker.verify import verify
+  verify()
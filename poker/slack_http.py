@@ -0,0 +1,198 @@
+import http.client
+import io
+import os
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+from slack_sdk import WebClient
+
+from poker.timing import Timing
+
+# The SDK opens a new HTTPS connection, TLS handshake included, for every
+# call. PooledWebClient keeps them open between calls instead, shared by the
+# threads of a worker. Connections are made again after `connection_ttl`, and
+# a request that couldn't be sent on one the server closed while idle is sent
+# again on a new connection.
+#
+# Idle connections kept per host, the dispatcher sends up to OUTBOX_CONCURRENCY at once
+pool_size = int(os.environ.get("SLACK_POOL_SIZE") or 8)
+connection_ttl = float(os.environ.get("SLACK_CONNECTION_TTL") or 60.0)
+connect_timeout = float(os.environ.get("SLACK_CONNECT_TIMEOUT") or 5.0)
+read_timeout = float(os.environ.get("SLACK_READ_TIMEOUT") or 30.0)
+
+class PoolStats():
+    """Slack API connections of this worker"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reused = 0
+        self.expired = 0
+        self.stale = 0
+        self.connect_ms = Timing()
+        self.request_ms = Timing()
+
+    def connected(self, connect_ms):
+        with self.lock:
+            self.connect_ms.add(connect_ms)
+
+    def requested(self, reused, request_ms):
+        with self.lock:
+            self.reused += reused
+            self.request_ms.add(request_ms)
+
+    def dropped(self, stale):
+        with self.lock:
+            if stale:
+                self.stale += 1
+            else:
+                self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.request_ms.count,
+                'opened': self.connect_ms.count,
+                'reused': self.reused,
+                # Past connection_ttl, and closed by Slack while idle
+                'expired': self.expired,
+                'stale': self.stale,
+                # TCP and TLS handshakes
+                **self.connect_ms.stats('connect_ms'),
+                'request_ms_avg': self.request_ms.avg,
+            }
+
+class ConnectionPool():
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (scheme, host, port): [(connection, when it was opened)], most recently used last
+        self.idle = {}
+        self.pid = None
+        self.context = None
+        self.pool_stats = PoolStats()
+
+    def _checkout(self, key, context):
+        """An open connection to key, and whether it was reused"""
+        with self.lock:
+            # The master's connections aren't the worker's to use after a fork
+            if self.pid != os.getpid():
+                self.idle = {}
+                self.pid = os.getpid()
+
+            idle = self.idle.get(key, [])
+
+            while idle:
+                conn, opened = idle.pop()
+
+                if time.monotonic() - opened < self.ttl:
+                    return conn, opened, True
+
+                conn.close()
+                self.pool_stats.dropped(False)
+
+            if context is None:
+                if self.context is None:
+                    self.context = ssl.create_default_context()
+                context = self.context
+
+        scheme, host, port = key
+        start = time.perf_counter()
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=connect_timeout, context=context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=connect_timeout)
+
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        self.pool_stats.connected((time.perf_counter() - start) * 1000)
+        return conn, time.monotonic(), False
+
+    def _checkin(self, key, conn, opened):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+
+            if self.pid == os.getpid() and len(idle) < self.size:
+                idle.append((conn, opened))
+                return
+
+        conn.close()
+
+    def request(self, url, req, context=None):
+        """Sends a urllib Request, returns its response's status, headers and body"""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path + (f"?{parts.query}" if parts.query else '')
+        start = time.perf_counter()
+
+        while True:
+            conn, opened, reused = self._checkout(key, context)
+
+            # Only a reused connection that Slack had closed while idle, found
+            # while sending, is retried on a new one. Once the request is
+            # sent Slack may have acted on it, so nothing after is retried.
+            try:
+                conn.request(req.get_method(), path, body=req.data, headers=dict(req.header_items()))
+            except (BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if reused:
+                    self.pool_stats.dropped(True)
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            try:
+                response = conn.getresponse()
+                body = response.read()
+            except Exception:
+                conn.close()
+                raise
+
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn, opened)
+
+        self.pool_stats.requested(reused, (time.perf_counter() - start) * 1000)
+
+        # As urlopen, which the SDK handles 429s and other errors from
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(body))
+
+        if response.msg.get_content_type() == 'application/gzip':
+            return {'status': response.status, 'headers': response.msg, 'body': body}
+
+        return {'status': response.status, 'headers': response.msg, 'body': body.decode(response.msg.get_content_charset() or 'utf-8')}
+
+    def stats(self):
+        with self.lock:
+            idle = sum(len(conns) for conns in self.idle.values())
+
+        return dict(self.pool_stats.stats(), idle=idle)
+
+pool = ConnectionPool(pool_size, connection_ttl)
+
+class PooledWebClient(WebClient):
+    """WebClient sending its calls over this worker's pooled connections"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('timeout', int(read_timeout))
+        super().__init__(*args, **kwargs)
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        # Proxies still go through urllib
+        if self.proxy or not url.lower().startswith(('https://', 'http://')):
+            return super()._perform_urllib_http_request_internal(url, req)
+
+        return pool.request(url, req, self.ssl)
+
+def stats():
+    return pool.stats()
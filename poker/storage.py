@@ -0,0 +1,408 @@
+import json
+import os
+import threading
+
+from typing import Protocol, runtime_checkable
+
+import poker.local_db as local_db
+
+# Where games, actions, stats and the outbox live. Both backends implement
+# Storage, and hand out transactions implementing Transaction:
+#
+#   with storage.transaction() as conn:
+#       state = conn.load_game(game_id)
+#
+# STORAGE_BACKEND=memory keeps everything in this process, for tests,
+# simulations and benchmarks. It isn't shared between gunicorn workers and is
+# gone on restart, never use it for the app proper.
+
+@runtime_checkable
+class Transaction(Protocol):
+    """What callers may do inside `with storage.transaction() as conn`.
+
+    local_db.Connection and MemoryTransaction implement it. Everything is
+    committed when the block exits and rolled back if it raises.
+    """
+
+    def __enter__(self): ...
+    def __exit__(self, type, value, traceback): ...
+
+    def load_game(self, game_id):
+        """The game's state, None if there's no such game"""
+
+    def save_game(self, game_id, state): ...
+
+    def load_actions(self, game_id, after_seq=0):
+        """(seq, action, player, name) of the game's actions after after_seq, in order"""
+
+    def append_action(self, game_id, seq, action, player, name): ...
+
+    def game_version(self, game_id):
+        """seq of the game's last action, 0 before the first, None if there's no such game"""
+
+    def complete_game(self, game_id, state):
+        """Folds a newly completed game into the player stats, before save_game marks it complete"""
+
+    def recent_games(self, league, limit, offset=0):
+        """(game_id, created_at) of completed games, newest first. league '*' is every league."""
+
+    def recent_results(self, last_n, league='*'):
+        """(game_id, player, label, won, bet) for the last N completed games, oldest first"""
+
+    def game_results(self, game_id): ...
+
+    def player_stats(self, last_n, league='*'):
+        """(player, label, games, wins, reps_owed) over the last N completed games, 0 for all of them"""
+
+    def rebuild_stats(self):
+        """Recomputes the player stats from the games, returns the number of rows written"""
+
+    def enqueue_message(self, thread, method, kwargs, not_before):
+        """Queues a Slack call in the outbox, returns its id"""
+
+    def claim_messages(self, now, lease, limit, due=None, quotas=None, held=None):
+        """(id, method, kwargs, attempts, not_before) of the next message of up to `limit` threads.
+
+        Adds the methods whose due messages a quota kept back to held.
+        """
+
+    def message_sent(self, id, now): ...
+
+    def defer_message(self, id, not_before):
+        """Puts a claimed message back until not_before, without counting an attempt"""
+
+    def message_failed(self, id, error, retry_at):
+        """Schedules a retry at retry_at, or gives up on the message if that is None"""
+
+    def pending_messages(self): ...
+
+    def prune_messages(self, before):
+        """Deletes messages sent before the given time, returns how many"""
+
+@runtime_checkable
+class Storage(Protocol):
+    """A backend, what storage.use() takes"""
+
+    def transaction(self, write=True, archive=False):
+        """A Transaction. Read only ones may run alongside writes, archive=True includes archived games."""
+
+    def migrate(self): ...
+
+    def start(self):
+        """Starts background upkeep, if the backend has any"""
+
+    def stats(self): ...
+
+class SqliteStorage(Storage):
+    def __init__(self, fn=None):
+        # None follows local_db.db_url, which the CLIs and tests may change
+        self.fn = fn
+
+    def transaction(self, write=True, archive=False):
+        return local_db.Connection(write=write, fn=self.fn, archive=archive)
+
+    def migrate(self):
+        local_db.migrate(self.fn or local_db.db_url)
+
+    def start(self):
+        """Background upkeep of the database files"""
+        # Imported here, the archive job is only for SQLite and imports this
+        import poker.archive as archive
+        archive.start()
+
+    def stats(self):
+        return local_db.db_stats.stats()
+
+_missing = object()
+
+class MemoryTransaction(Transaction):
+    """One transaction on a MemoryStorage.
+
+    Holds the store's lock throughout, like BEGIN IMMEDIATE, and undoes its
+    writes if the block raises.
+    """
+
+    def __init__(self, store, write=True, archive=False):
+        # Everything is serialized, so neither matters here
+        self.store = store
+        self.write = write
+        self.archive = archive
+
+    def __enter__(self):
+        if getattr(self.store.local, 'active', False):
+            raise RuntimeError("Storage is already in a transaction on this thread")
+
+        self.store.lock.acquire()
+        self.store.local.active = True
+        self.undo = []
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is not None:
+                for fn in reversed(self.undo):
+                    fn()
+        finally:
+            self.store.local.active = False
+            self.store.lock.release()
+
+    def _set(self, mapping, key, value):
+        old = mapping.get(key, _missing)
+        mapping[key] = value
+        self.undo.append(lambda: mapping.pop(key) if old is _missing else mapping.__setitem__(key, old))
+
+    def _pop(self, mapping, key):
+        old = mapping.pop(key)
+        self.undo.append(lambda: mapping.__setitem__(key, old))
+
+    def load_game(self, game_id):
+        game = self.store.games.get(game_id)
+
+        # Stored as JSON so callers always get their own copy to change
+        return None if game is None else json.loads(game[0])
+
+    def save_game(self, game_id, state):
+        row = local_db.game_row(state)
+        players = local_db.player_rows(game_id, state)
+        self._set(self.store.games, game_id, (json.dumps(state), row, players))
+
+    def load_actions(self, game_id, after_seq=0):
+        return [action for action in self.store.actions.get(game_id, []) if action[0] > after_seq]
+
+    def append_action(self, game_id, seq, action, player, name):
+        actions = self.store.actions.get(game_id)
+
+        if actions is None:
+            actions = []
+            self._set(self.store.actions, game_id, actions)
+
+        if actions and actions[-1][0] >= seq:
+            raise ValueError(f"action {seq} of {game_id} already recorded")
+
+        actions.append((seq, action, player, name))
+        self.undo.append(actions.pop)
+
+    def game_version(self, game_id):
+        if game_id not in self.store.games:
+            return None
+
+        actions = self.store.actions.get(game_id)
+        return actions[-1][0] if actions else 0
+
+    def recent_games(self, league, limit, offset=0):
+        games = []
+
+        for game_id, (blob, (status, game_league, created_at, finished_at, winners), players) in self.store.games.items():
+            if status == 'complete' and (league == '*' or league == game_league):
+                games.append((game_id, created_at))
+
+        # As ORDER BY created_at DESC, game_id DESC, where NULLs come last
+        games.sort(key=lambda g: (g[1] is not None, g[1] or 0, g[0]), reverse=True)
+        return games[offset:offset + limit] if limit >= 0 else games[offset:]
+
+    def recent_results(self, last_n, league='*'):
+        results = []
+
+        for game_id, created_at in reversed(self.recent_games(league, last_n or -1)):
+            results.extend(self.game_results(game_id))
+
+        return results
+
+    def game_results(self, game_id):
+        players = self.store.games[game_id][2]
+        return [(game_id, player, label, bool(won), bet or 0) for game_id, player, seat, label, bet, folded, won in players]
+
+    def player_stats(self, last_n, league='*'):
+        if last_n == 0 or last_n in local_db.stats_windows:
+            return [(player, label, games, wins, reps_owed) for (stats_league, stats_n, player), (label, games, wins, reps_owed)
+                    in self.store.player_stats.items() if stats_league == league and stats_n == last_n and games > 0]
+
+        return local_db.tally_results(self.recent_results(last_n, league))
+
+    def add_stats(self, league, last_n, results, sign):
+        for game_id, player, label, won, bet in results:
+            key = (league, last_n, player)
+            old_label, games, wins, reps_owed = self.store.player_stats.get(key, (None, 0, 0, 0))
+            # Games leaving a window keep the label of the newer games still in it
+            label = label if sign > 0 else old_label
+            self._set(self.store.player_stats, key, (label, games + sign, wins + sign * won, reps_owed + (0 if won else sign * bet)))
+
+    def complete_game(self, game_id, state):
+        """As local_db.Connection.complete_game"""
+        game = self.store.games.get(game_id)
+        if game is not None and game[1][0] == 'complete':
+            return
+
+        results = [(game_id, player, label or player, won, bet or 0) for game_id, player, seat, label, bet, folded, won in local_db.player_rows(game_id, state)]
+        position = (state.get('created_at') or 0, game_id)
+
+        for league in ['*', state['league']]:
+            self.add_stats(league, 0, results, 1)
+
+            for last_n in local_db.stats_windows:
+                oldest = self.recent_games(league, 1, last_n - 1)
+
+                if not oldest:
+                    self.add_stats(league, last_n, results, 1)
+                elif position > (oldest[0][1] or 0, oldest[0][0]):
+                    self.add_stats(league, last_n, results, 1)
+                    self.add_stats(league, last_n, self.game_results(oldest[0][0]), -1)
+
+    def rebuild_stats(self):
+        for key in list(self.store.player_stats):
+            self._pop(self.store.player_stats, key)
+
+        leagues = {'*'} | {row[1] for blob, row, players in self.store.games.values() if row[0] == 'complete'}
+        written = 0
+
+        for league in leagues:
+            for last_n in [0] + local_db.stats_windows:
+                for player, label, games, wins, reps_owed in local_db.tally_results(self.recent_results(last_n, league)):
+                    self._set(self.store.player_stats, (league, last_n, player), (label, games, wins, reps_owed))
+                    written += 1
+
+        return written
+
+    def enqueue_message(self, thread, method, kwargs, not_before):
+        self.store.next_message_id += 1
+        id = self.store.next_message_id
+        self._set(self.store.pending, id, {
+          'thread': thread,
+          'method': method,
+          'kwargs': json.dumps(kwargs),
+          'not_before': not_before,
+          'claimed_until': None,
+          'attempts': 0,
+        })
+        return id
+
+    def claim_messages(self, now, lease, limit, due=None, quotas=None, held=None):
+        """Claims the oldest pending message of up to `limit` threads, if it is due by `due` (default now)"""
+        due = now if due is None else due
+        quotas = quotas or {}
+        # A rolled back pop puts a message back at the end, so compare ids
+        heads = {}
+        for id, message in self.store.pending.items():
+            head = heads.get(message['thread'])
+            if head is None or id < head[0]:
+                heads[message['thread']] = (id, message)
+
+        claimed = []
+        counts = {}
+        for id, message in sorted(heads.values(), key=lambda head: head[0]):
+            if len(claimed) >= limit:
+                break
+
+            if message['not_before'] > due or (message['claimed_until'] is not None and message['claimed_until'] >= now):
+                continue
+
+            method = message['method']
+            if counts.get(method, 0) >= quotas.get(method, limit):
+                if held is not None:
+                    held.add(method)
+                continue
+
+            counts[method] = counts.get(method, 0) + 1
+            self._set(self.store.pending, id, dict(message, claimed_until=now + lease))
+            claimed.append((id, method, json.loads(message['kwargs']), message['attempts'], message['not_before']))
+
+        return claimed
+
+    def message_sent(self, id, now):
+        message = self.store.pending[id]
+        self._pop(self.store.pending, id)
+        self._set(self.store.sent, id, dict(message, claimed_until=None, attempts=message['attempts'] + 1, sent_at=now))
+
+    def defer_message(self, id, not_before):
+        self._set(self.store.pending, id, dict(self.store.pending[id], not_before=not_before, claimed_until=None))
+
+    def message_failed(self, id, error, retry_at):
+        """Schedules a retry at retry_at, or gives up on the message if that is None"""
+        message = dict(self.store.pending[id], claimed_until=None, error=error)
+        message['attempts'] += 1
+
+        if retry_at is None:
+            self._pop(self.store.pending, id)
+            self._set(self.store.failed, id, message)
+        else:
+            self._set(self.store.pending, id, dict(message, not_before=retry_at))
+
+    def pending_messages(self):
+        return len(self.store.pending)
+
+    def prune_messages(self, before):
+        pruned = [id for id, message in self.store.sent.items() if message['sent_at'] < before]
+
+        for id in pruned:
+            self._pop(self.store.sent, id)
+
+        return len(pruned)
+
+    def commit(self):
+        pass
+
+class MemoryStorage(Storage):
+    """Games, actions and the outbox in dicts, for this process only"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # game_id: (state JSON, local_db.game_row(), local_db.player_rows())
+        self.games = {}
+        # game_id: [(seq, action, player, name)]
+        self.actions = {}
+        # Outbox messages by id
+        self.pending = {}
+        self.sent = {}
+        self.failed = {}
+        self.next_message_id = 0
+        # (league, last_n, player): (label, games, wins, reps_owed), as the player_stats table
+        self.player_stats = {}
+
+    def transaction(self, write=True, archive=False):
+        return MemoryTransaction(self, write, archive)
+
+    def migrate(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stats(self):
+        with self.transaction(write=False):
+            return {
+                'backend': 'memory',
+                'games': len(self.games),
+                'actions': sum(len(actions) for actions in self.actions.values()),
+                'messages': len(self.pending) + len(self.sent) + len(self.failed),
+            }
+
+backends = {'sqlite': SqliteStorage, 'memory': MemoryStorage}
+
+backend = backends[os.environ.get("STORAGE_BACKEND") or 'sqlite']()
+
+def use(new):
+    """Switches every caller to another backend, returns it"""
+    if not isinstance(new, Storage):
+        raise TypeError(f"{type(new).__name__} isn't a storage backend")
+
+    global backend
+    backend = new
+    return new
+
+def transaction(write=True, archive=False):
+    """A transaction on the current backend, use it as a context manager.
+
+    Read only (write=False) ones may run alongside writes on SQLite.
+    archive=True includes archived games in history queries.
+    """
+    return backend.transaction(write, archive)
+
+def migrate():
+    backend.migrate()
+
+def start():
+    backend.start()
+
+def stats():
+    return backend.stats()
@@ -1,3 +1,6 @@
+import hashlib
+import os
+
 # Position in this list is the card's identity. Don't reorder this list.
 
 cards = [
@@ -55,11 +58,51 @@ cards = [
   {"suit": "Clubs",    "name": "Ace",   "ordinal": 14},
 ]
 
-def card_image_name(card):
+static_dir = os.environ.get("STATIC_DIR") or './static'
+
+# Card images are published under content hashed names (e.g.
+# ace_of_spades.1a2b3c4d5e6f.png) so they can be cached forever
+hashed_image_names = (os.environ.get("STATIC_HASHED_NAMES") or "true").lower() == "true"
+
+def card_file_name(card):
     defn = cards[card]
 
     return defn['name'].lower() + "_of_" + defn['suit'].lower() + ".png"
 
+_card_digests = None
+
+def card_digest(card):
+    """Short content hash of a card's image, None if the file isn't there"""
+    global _card_digests
+
+    if _card_digests is None:
+        digests = []
+        for c in range(len(cards)):
+            try:
+                with open(os.path.join(static_dir, card_file_name(c)), 'rb') as f:
+                    digests.append(hashlib.sha1(f.read()).hexdigest()[:12])
+            except FileNotFoundError:
+                digests.append(None)
+        _card_digests = digests
+
+    return _card_digests[card]
+
+def card_image_name(card):
+    digest = card_digest(card) if hashed_image_names else None
+
+    if digest is None:
+        return card_file_name(card)
+
+    return card_file_name(card)[:-len(".png")] + "." + digest + ".png"
+
+def card_for_image_name(name):
+    """Card id for a name from card_image_name() or card_file_name(), else None"""
+    for card in range(len(cards)):
+        if name == card_image_name(card) or name == card_file_name(card):
+            return card
+
+    return None
+
 def card_textual_rep(card):
     defn = cards[card]
 
@@ -93,6 +136,60 @@ for c in cards:
 for key, value in ord_counts.items():
   assert value == 4
 
+# Compact representation for the hot paths in scoring. Card ids are suit major
+# (13 per suit, 2 through Ace), so bit `id` of a hand mask puts each suit's
+# ranks in their own 13 bit lane, with bit (ordinal - 2) set per rank.
+
+suits = ['Spades', 'Diamonds', 'Hearts', 'Clubs']
+
+for idx, c in enumerate(cards):
+  assert suits.index(c['suit']) == idx // 13
+  assert c['ordinal'] == idx % 13 + 2
+
+RANK_LANE = 0x1FFF
+
+card_ordinals  = tuple(c['ordinal'] for c in cards)
+card_suits     = tuple(suits.index(c['suit']) for c in cards)
+card_masks     = tuple(1 << idx for idx in range(len(cards)))
+card_rank_bits = tuple(1 << (o - 2) for o in card_ordinals)
+
+# Adding these up gives a 4 bit count per ordinal (or per suit) in one int
+card_rank_counters = tuple(1 << (4 * o) for o in card_ordinals)
+card_suit_counters = tuple(1 << (4 * s) for s in card_suits)
+
+def hand_mask(hand):
+    mask = 0
+    for c in hand:
+        mask |= card_masks[c]
+    return mask
+
+def suit_lane(mask, suit):
+    """Rank mask of the cards in a hand mask that have the given suit index"""
+    return (mask >> (13 * suit)) & RANK_LANE
+
+def rank_mask(hand):
+    mask = 0
+    for c in hand:
+        mask |= card_rank_bits[c]
+    return mask
+
+def rank_counts(hand):
+    """Packed counts, read one back with count_of(counts, ordinal)"""
+    counts = 0
+    for c in hand:
+        counts += card_rank_counters[c]
+    return counts
+
+def suit_counts(hand):
+    """Packed counts, read one back with count_of(counts, suit index)"""
+    counts = 0
+    for c in hand:
+        counts += card_suit_counters[c]
+    return counts
+
+def count_of(counts, idx):
+    return (counts >> (4 * idx)) & 0xF
+
 leagues = {
   "push-up": {
     "fitness": True,
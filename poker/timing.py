@@ -0,0 +1,26 @@
+# The durations behind the *_avg and *_max figures of each module's stats()
+
+class Timing():
+    """How many durations in ms were added, their total and the longest.
+
+    Not locked itself, the stats object it belongs to adds to it under its
+    own lock along with its other counters.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else 0.0
+
+    def stats(self, name):
+        """{name}_avg and {name}_max, e.g. held_ms_avg and held_ms_max"""
+        return {f'{name}_avg': self.avg, f'{name}_max': self.max}
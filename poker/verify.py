@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Exhaustive check of the hand evaluator over all 2,598,960 five card hands.
+#
+#   python -m poker.verify [--workers N] [--rebuild] [--check-best] [--sample N] [--table PATH]
+#
+# The enumeration is split into one shard per highest card and spread over a
+# process pool. Each shard scores its hands with best_batch() and writes the
+# strengths straight into the hand table file, so nothing per hand is held in
+# the parent. Later runs find the table, map it and only recount categories.
+# Either way a sample of hands is scored by the reference best() and compared
+# with best_batch(), evaluate7() and the table; --check-best compares them all.
+
+import argparse
+import itertools
+import os
+import resource
+import sys
+import time
+
+from math import comb
+from multiprocessing import Pool
+
+import numpy as np
+
+import poker.scoring as scoring
+
+expected_counts = {
+  'Royal Flush':     4,
+  'Straight Flush':  36,
+  'Four of a Kind':  624,
+  'Full House':      3744,
+  'Flush':           5108,
+  'Straight':        10200,
+  'Three of a Kind': 54912,
+  'Two Pair':        123552,
+  'Pair':            1098240,
+  'High Card':       1302540,
+}
+
+def shard_hands(top):
+    """Every 5 card hand whose highest card id is `top`"""
+    rest = itertools.combinations(range(top), 4)
+    flat = np.fromiter(itertools.chain.from_iterable(rest), dtype=np.int8)
+    hands = flat.reshape(-1, 4)
+    return np.hstack([hands, np.full((len(hands), 1), top, dtype=np.int8)])
+
+def colex_indexes(hands):
+    """scoring.hand_index() for every row of a sorted (N, 5) array"""
+    binom = np.array([[comb(c, k) for k in range(6)] for c in range(52)], dtype=np.int64)
+    idx = np.zeros(len(hands), dtype=np.int64)
+    for k in range(5):
+        idx += binom[hands[:, k].astype(np.intp), k + 1]
+    return idx
+
+def open_table(path, mode):
+    return np.memmap(path, dtype='<u4', mode=mode, offset=scoring.HAND_TABLE_HEADER.size, shape=(scoring.HAND_TABLE_SIZE,))
+
+def run_shard(args):
+    top, path, check_best = args
+
+    hands = shard_hands(top)
+    strengths = scoring.best_batch(hands)
+
+    mismatches = 0
+    if check_best:
+        for hand, strength in zip(hands.tolist(), strengths.tolist()):
+            if scoring.strength(scoring.best(hand)) != strength:
+                mismatches += 1
+
+    table = open_table(path, 'r+')
+    table[colex_indexes(hands)] = strengths
+    table.flush()
+    del table
+
+    counts = np.bincount(strengths >> scoring.CATEGORY_SHIFT, minlength=len(scoring.hands))
+    return top, counts, mismatches
+
+def build_table(path, workers, check_best):
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(scoring.HAND_TABLE_HEADER.pack(scoring.HAND_TABLE_MAGIC, scoring.HAND_TABLE_VERSION, scoring.HAND_TABLE_SIZE))
+        f.truncate(scoring.HAND_TABLE_HEADER.size + 4 * scoring.HAND_TABLE_SIZE)
+
+    # Biggest shards first so the pool doesn't finish on a long straggler
+    shards = [(top, tmp_path, check_best) for top in range(51, 3, -1)]
+
+    counts = np.zeros(len(scoring.hands), dtype=np.int64)
+    mismatches = 0
+    done = 0
+
+    with Pool(processes=workers) as pool:
+        for top, shard_counts, shard_mismatches in pool.imap_unordered(run_shard, shards):
+            counts += shard_counts
+            mismatches += shard_mismatches
+            done += 1
+            print(f"\rshards: {done}/{len(shards)}", end='', file=sys.stderr, flush=True)
+
+    print(file=sys.stderr)
+
+    if mismatches:
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+    return counts, mismatches
+
+def check_sample(table, n):
+    """Hands of a random sample whose best() strength best_batch(), evaluate7() or the table disagree with"""
+    if n <= 0:
+        return 0
+
+    hands = scoring.sample_hands(n, seed=n)
+    batch = scoring.best_batch(hands).tolist()
+    mismatches = 0
+
+    for hand, batch_strength in zip(hands, batch):
+        expected = scoring.strength(scoring.best(hand))
+
+        if not expected == batch_strength == scoring.evaluate7(hand) == table[scoring.hand_index(hand)]:
+            mismatches += 1
+
+    return mismatches
+
+def count_table(table):
+    return np.bincount(np.asarray(table) >> scoring.CATEGORY_SHIFT, minlength=len(scoring.hands))
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+def verify(path=None, workers=None, rebuild=False, check_best=False, sample=20000):
+    path = path or scoring.hand_table_path
+    start = time.perf_counter()
+
+    cached = None if rebuild or check_best else scoring.load_hand_table(path)
+    mismatches = 0
+
+    if cached is not None:
+        source = f"cached table {path}"
+        counts = count_table(cached)
+    else:
+        source = f"rebuilt {path} with {workers or os.cpu_count()} workers"
+        counts, mismatches = build_table(path, workers, check_best)
+        cached = open_table(path, 'r') if mismatches == 0 else None
+
+    if cached is not None:
+        mismatches += check_sample(cached, sample)
+
+    elapsed = time.perf_counter() - start
+    own_mb, children_mb = peak_rss_mb()
+
+    for idx, defn in enumerate(scoring.hands):
+        print(defn['name'] + ': ' + str(counts[idx]))
+
+    print(counts.sum())
+    print(f"{source}: {elapsed:.2f}s wall, peak RSS {own_mb:.1f} MB (largest worker {children_mb:.1f} MB)")
+
+    print(f"best() mismatches: {mismatches}" + ("" if check_best else f" in a sample of {sample}"))
+
+    assert mismatches == 0
+
+    for idx, defn in enumerate(scoring.hands):
+        assert counts[idx] == expected_counts[defn['name']], defn['name']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', help="hand table path (default HAND_TABLE_PATH or hand_table.bin)")
+    parser.add_argument('--workers', type=int, help="process pool size (default: CPU count)")
+    parser.add_argument('--rebuild', action='store_true', help="ignore an existing table")
+    parser.add_argument('--check-best', action='store_true', help="also compare every hand against best() (slow, implies --rebuild)")
+    parser.add_argument('--sample', type=int, default=20000, help="random hands compared against best() (default 20000, 0 = none)")
+    args = parser.parse_args()
+
+    verify(args.table, args.workers, args.rebuild, args.check_best, args.sample)
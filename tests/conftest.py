@@ -0,0 +1,29 @@
+import pytest
+
+import poker.game_cache as game_cache
+import poker.local_db as local_db
+import poker.storage as storage
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """A migrated SQLite database in tmp_path, local_db's default for the test"""
+    path = str(tmp_path / 'poker.db')
+    monkeypatch.setattr(local_db, 'db_url', path)
+    monkeypatch.setattr(local_db, 'archive_db_url', str(tmp_path / 'poker-archive.db'))
+    local_db.migrate(path)
+
+    yield path
+
+    local_db.close()
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, monkeypatch):
+    """Each storage backend in turn as storage.backend, with an empty game cache"""
+    if request.param == 'memory':
+        new = storage.MemoryStorage()
+    else:
+        new = storage.SqliteStorage(request.getfixturevalue('db_path'))
+
+    monkeypatch.setattr(storage, 'backend', new)
+    monkeypatch.setattr(game_cache, 'cache', game_cache.GameCache(game_cache.size))
+    return new
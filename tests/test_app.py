@@ -0,0 +1,140 @@
+import hashlib
+import importlib
+import os
+import sys
+
+import pytest
+import slack_sdk
+
+import poker.images as images
+import poker.outbox as outbox
+import poker.storage as storage
+
+from poker.structures import static_dir, card_digest, card_file_name, card_image_name
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """app.py imported without reaching Slack, starting the outbox or writing a database"""
+    monkeypatch.setenv('SLACK_BOT_TOKEN', 'xoxb-test')
+    monkeypatch.setenv('SLACK_BOT_SECRET', 'secret')
+    monkeypatch.setattr(slack_sdk.WebClient, 'auth_test', lambda self, **kwargs: {})
+    monkeypatch.setattr(outbox, 'wake', lambda slack, due=(): None)
+    monkeypatch.setattr(storage, 'backend', storage.MemoryStorage())
+    monkeypatch.setattr(images, 'render_cache_dir', str(tmp_path))
+    monkeypatch.setattr(images, 'cache', images.RenderCache(16))
+    monkeypatch.setattr(images, 'render_workers', 0)
+
+    module = sys.modules.get('app') or importlib.import_module('app')
+    return module
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
+
+def test_combined_cards_headers(client):
+    resp = client.get('/combined-cards.png?cards=0,1,2')
+
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'image/png'
+    assert resp.headers['Vary'] == 'Accept'
+    assert resp.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+
+    # Strong, and the hash of what was sent
+    etag, weak = resp.get_etag()
+    assert not weak
+    assert etag == hashlib.sha1(resp.data).hexdigest()
+
+    again = client.get('/combined-cards.png?cards=0,1,2', headers={'If-None-Match': f'"{etag}"'})
+    assert again.status_code == 304
+    assert again.data == b''
+
+def test_combined_cards_format_and_scale_are_their_own_variants(client):
+    full = client.get('/combined-cards.png?cards=0,1')
+    half = client.get('/combined-cards.png?cards=0,1&scale=0.5')
+
+    assert half.status_code == 200
+    assert half.get_etag() != full.get_etag()
+
+    # The full size ETag doesn't match the half size image
+    assert client.get('/combined-cards.png?cards=0,1&scale=0.5', headers={'If-None-Match': f'"{full.get_etag()[0]}"'}).status_code == 200
+
+    if 'webp' in images.formats:
+        webp = client.get('/combined-cards.png?cards=0,1', headers={'Accept': 'image/webp,*/*'})
+        assert webp.headers['Content-Type'] == 'image/webp'
+        assert webp.get_etag() != full.get_etag()
+
+@pytest.mark.parametrize('query', [
+    '',
+    'cards=',
+    'cards=52',
+    'cards=a,b',
+    'cards=0,1&scale=0',
+    'cards=0,1&scale=2',
+    'cards=0,1&scale=nan',
+    'cards=0,1&scale=half',
+])
+def test_combined_cards_rejects_malformed_queries(client, query):
+    assert client.get(f'/combined-cards.png?{query}').status_code == 400
+
+def test_combined_cards_answers_503_on_render_timeout(client, monkeypatch):
+    def timeout(card_ids, fmt, scale):
+        raise images.RenderTimeout((card_ids, fmt, scale))
+
+    monkeypatch.setattr(images, 'render', timeout)
+    resp = client.get('/combined-cards.png?cards=0,1')
+
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '1'
+
+def test_hashed_card_names_are_cached_forever(client):
+    name = card_image_name(0)
+    assert name != card_file_name(0)
+
+    resp = client.get(f'/cards/{name}')
+
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'image/png'
+    assert resp.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+
+    with open(os.path.join(static_dir, card_file_name(0)), 'rb') as f:
+        assert resp.data == f.read()
+
+    # Strong, the digest in the name
+    assert resp.get_etag() == (card_digest(0), False)
+    assert client.get(f'/cards/{name}', headers={'If-None-Match': f'"{card_digest(0)}"'}).status_code == 304
+
+def test_plain_card_names_are_revalidated(client):
+    resp = client.get(f'/cards/{card_file_name(0)}')
+
+    assert resp.status_code == 200
+    assert resp.cache_control.max_age == 300
+    assert not resp.cache_control.immutable
+    assert resp.get_etag() == (card_digest(0), False)
+    assert client.get(f'/cards/{card_file_name(0)}', headers={'If-None-Match': f'"{card_digest(0)}"'}).status_code == 304
+
+@pytest.mark.parametrize('name', [
+    'joker.png',
+    'ace_of_spades.000000000000.png',
+    '..%2Fapp.py',
+    '..%2F..%2Fetc%2Fpasswd',
+    '..',
+    'app.py',
+])
+def test_unknown_card_names_are_not_found(client, name):
+    assert client.get(f'/cards/{name}').status_code == 404
+
+def test_cards_sent_by_nginx(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'static_accel_prefix', '/internal-static/')
+    resp = client.get(f'/cards/{card_image_name(0)}')
+
+    assert resp.status_code == 200
+    assert resp.data == b''
+    assert resp.headers['X-Accel-Redirect'] == '/internal-static/' + card_file_name(0)
+    assert resp.headers['Content-Type'] == 'image/png'
+    assert resp.headers['Cache-Control'] == 'max-age=31536000, public, immutable'
+    assert resp.get_etag() == (card_digest(0), False)
+
+    plain = client.get(f'/cards/{card_file_name(0)}')
+    assert plain.headers['X-Accel-Redirect'] == '/internal-static/' + card_file_name(0)
+    assert plain.cache_control.max_age == 300
+    assert not plain.cache_control.immutable
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import poker.archive as archive
+import poker.local_db as local_db
+
+day = 86400
+
+def game(created_at, winner='U1', status='complete'):
+    return {
+        'host': 'U1',
+        'league': 'push-up',
+        'buyin': 5,
+        'status': status,
+        'players': ['U1', 'U2'],
+        'created_at': created_at,
+        'finished_at': created_at + 60,
+        'bets': {'U1': 5, 'U2': 10},
+        'winners': [winner],
+        'folded': [],
+    }
+
+def tables(path):
+    conn = sqlite3.connect(path)
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    conn.close()
+    return names
+
+def test_old_games_move_and_history_stays_whole(db_path, monkeypatch):
+    monkeypatch.setattr(local_db, 'stats_windows', [2])
+    now = time.time()
+
+    with local_db.Connection() as conn:
+        for n in range(5):
+            state = game(now - (60 - n) * day, winner='U1' if n % 2 else 'U2')
+            conn.complete_game(f'C-{n}', state)
+            conn.save_game(f'C-{n}', state)
+
+        conn.save_game('C-abandoned', game(now - 3 * day, status='pending'))
+        conn.save_game('C-pending', game(now - 3600, status='pending'))
+
+    with local_db.Connection(write=False, archive=True) as conn:
+        history = sorted(conn.player_stats(0))
+        recent = sorted(conn.player_stats(2))
+
+    # The 2 newest games stay live for the window, however old
+    assert archive.archive_games(now) == 4
+
+    with local_db.Connection(write=False) as conn:
+        assert [game_id for game_id, created_at in conn.recent_games('*', 10)] == ['C-4', 'C-3']
+        assert conn.load_game('C-pending') is not None
+        assert conn.load_game('C-abandoned') is None
+
+    with local_db.Connection(write=False, archive=True) as conn:
+        assert sorted(conn.player_stats(0)) == history
+        assert sorted(conn.player_stats(2)) == recent
+        assert len(conn.recent_results(0)) == 5 * 2
+
+    with local_db.Connection(archive=True) as conn:
+        conn.rebuild_stats()
+        assert sorted(conn.player_stats(0)) == history
+
+def test_archive_has_only_the_game_tables(db_path):
+    with local_db.Connection(write=False, archive=True) as conn:
+        conn.recent_games('*', 1)
+
+    assert tables(local_db.archive_db_url) == {'game', 'game_player', 'game_action'}
+    assert {'setting', 'player_stats', 'outbox'} <= tables(db_path)
+
+def archived_ids(path):
+    conn = sqlite3.connect(path)
+    ids = {table: {row[0] for row in conn.execute(f"SELECT game_id FROM {table};")} for table in archive.tables}
+    conn.close()
+    return ids
+
+def abandoned(conn, game_id, now):
+    conn.save_game(game_id, game(now - 3 * day, status='pending'))
+    conn.append_action(game_id, 1, 'join', 'U2', 'u2')
+
+def test_a_game_played_on_after_being_picked_stays_live(db_path, monkeypatch):
+    now = time.time() + 3 * day
+
+    with local_db.Connection() as conn:
+        abandoned(conn, 'C-revived', now)
+        abandoned(conn, 'C-abandoned', now)
+
+    picked = archive.archivable_games
+
+    def play_on(conn, now):
+        game_ids = picked(conn, now)
+
+        # Someone acts on the game while the run holds its picks
+        def act():
+            with local_db.Connection() as writer:
+                writer.conn.execute(local_db.append_action_sql, ('C-revived', 2, 'bet', 'U1', 'u1', now))
+
+        thread = threading.Thread(target=act)
+        thread.start()
+        thread.join()
+
+        return game_ids
+
+    monkeypatch.setattr(archive, 'archivable_games', play_on)
+
+    assert archive.archive_games(now) == 1
+
+    with local_db.Connection(write=False) as conn:
+        assert conn.load_game('C-revived') is not None
+        assert conn.load_game('C-abandoned') is None
+
+    assert archived_ids(local_db.archive_db_url)['game'] == {'C-abandoned'}
+
+def test_a_run_cut_short_between_the_databases_loses_nothing(db_path, monkeypatch):
+    now = time.time() + 3 * day
+
+    with local_db.Connection() as conn:
+        abandoned(conn, 'C-1', now)
+        abandoned(conn, 'C-2', now)
+
+    def crash(conn, game_ids):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(archive, 'delete_games', crash)
+
+        with pytest.raises(sqlite3.OperationalError):
+            archive.archive_games(now)
+
+    # Copied and still live
+    assert archived_ids(local_db.archive_db_url)['game'] == {'C-1', 'C-2'}
+
+    with local_db.Connection() as conn:
+        assert conn.load_game('C-1') is not None
+        conn.conn.execute(local_db.append_action_sql, ('C-2', 2, 'bet', 'U1', 'u1', now))
+
+    # The rerun moves the game still abandoned and drops the other's copy
+    assert archive.archive_games(now) == 1
+
+    with local_db.Connection(write=False) as conn:
+        assert conn.load_game('C-1') is None
+        assert conn.load_game('C-2') is not None
+
+    assert archived_ids(local_db.archive_db_url) == {'game': {'C-1'}, 'game_player': {'C-1'}, 'game_action': {'C-1'}}
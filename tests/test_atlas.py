@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from PIL import Image
+
+import poker.images as images
+from poker.structures import card_file_name, static_dir
+
+@pytest.fixture
+def atlas_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, 'atlas_dir', str(tmp_path))
+    monkeypatch.setattr(images, '_atlas', None)
+    return tmp_path
+
+def test_compose_matches_the_card_images(atlas_dir):
+    card_ids = (0, 13, 51)
+
+    with Image.open(os.path.join(static_dir, card_file_name(0))) as first:
+        width, height = first.size
+
+    expected = Image.new('RGB', (width * len(card_ids), height))
+    for idx, card in enumerate(card_ids):
+        with Image.open(os.path.join(static_dir, card_file_name(card))) as img:
+            expected.paste(img.convert('RGB'), (idx * width, 0))
+
+    assert images.compose(card_ids).tobytes() == expected.tobytes()
+    assert (atlas_dir / 'cards.rgb').exists()
+
+def test_changed_card_files_rebuild_the_atlas(atlas_dir, monkeypatch):
+    path = images.build_atlas()
+    assert images._map_atlas(path) is not None
+
+    monkeypatch.setattr(images, 'source_digest', lambda: b'\x01' * 20)
+    assert images._map_atlas(path) is None
+
+def test_truncated_atlas_is_rejected(atlas_dir):
+    path = images.build_atlas()
+
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    assert images._map_atlas(path) is None
+    assert images._map_atlas(str(atlas_dir / 'missing.rgb')) is None
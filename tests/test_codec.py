@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import poker.codec as codec
+import poker.local_db as local_db
+
+state = {
+    'host': 'U01',
+    'league': 'push-up',
+    'buyin': 5,
+    'status': 'in-progress',
+    'players': ['U01', 'U02', 'U03'],
+    'handles': {'U01': 'U01', 'U02': 'U02', 'U03': 'U03'},
+    'created_at': 1700000000.123456,
+    'finished_at': None,
+    'dev_mode': False,
+    'flop': [0, 13, 51],
+    'turn': 7,
+    'river': 40,
+    'hands': {'U01': [1, 2], 'U02': [3, 4], 'U03': [5, 6]},
+    'bets': {'U01': 10, 'U02': 5, 'U03': 0},
+    'player_labels': {'U01': 'Ann ☕', 'U02': 'Bo'},
+    'folded': ['U03'],
+    'opening-bets-complete': True,
+    'opening-bets-idx': -1,
+    'flop-bets-round-trip': False,
+    'strengths': [1 << 24, 300000000000, -7],
+    'notes': {'': '', 'nested': [[], {}, [None, True, 0.5, -0.0]]},
+}
+
+def test_binary_round_trip():
+    blob = codec.encode_binary(state)
+
+    assert blob.startswith(codec.MAGIC)
+    assert codec.decode_binary(blob) == state
+    assert len(blob) < len(json.dumps(state))
+
+@pytest.mark.parametrize('fmt', codec.formats)
+def test_decode_state_reads_either_format(fmt):
+    stored = codec.encode_state(state, fmt)
+
+    assert isinstance(stored, bytes if fmt == 'binary' else str)
+    assert codec.decode_state(stored) == state
+
+@pytest.mark.parametrize('value', [0, 127, 128, 16383, 16384, 1 << 62, -1, -128, -(1 << 40)])
+def test_varint_edges(value):
+    assert codec.decode_binary(codec.encode_binary({'n': value})) == {'n': value}
+
+def test_unencodable_values():
+    with pytest.raises(TypeError):
+        codec.encode_binary({'when': object()})
+
+    with pytest.raises(TypeError):
+        codec.encode_binary({1: 'int key'})
+
+def test_bad_blobs():
+    with pytest.raises(ValueError):
+        codec.decode_binary(b'{"not": "binary"}')
+
+    with pytest.raises(ValueError):
+        codec.decode_binary(codec.MAGIC + bytes([99]) + b'\x00')
+
+def test_convert_states_both_ways(db_path):
+    with local_db.Connection() as conn:
+        conn.save_game('C-1', state)
+        assert conn.state_format() == 'json'
+
+    assert local_db.convert_states(db_path, 'binary') == 1
+
+    with local_db.Connection() as conn:
+        # The cached format was dropped by the conversion
+        assert conn.state_format() == 'binary'
+        assert isinstance(conn.conn.execute("SELECT state FROM game;").fetchone()[0], bytes)
+        assert conn.load_game('C-1') == state
+
+        conn.save_game('C-2', dict(state, host='U02'))
+
+    assert local_db.convert_states(db_path, 'json') == 2
+
+    with local_db.Connection() as conn:
+        assert conn.load_game('C-2') == dict(state, host='U02')
@@ -0,0 +1,133 @@
+import logging
+import random
+
+import pytest
+
+import poker.engine as engine
+import poker.equity as equity
+import poker.game_cache as game_cache
+import poker.images as images
+import poker.outbox as outbox
+import poker.ratelimit as ratelimit
+import poker.storage as storage
+
+class FakeSlack():
+    def __init__(self):
+        self.calls = []
+
+    def chat_postMessage(self, **kwargs):
+        self.calls.append(('chat_postMessage', kwargs))
+        return {'ok': True}
+
+    def chat_postEphemeral(self, **kwargs):
+        self.calls.append(('chat_postEphemeral', kwargs))
+        return {'ok': True}
+
+@pytest.fixture
+def stubbed(monkeypatch):
+    """No rendering or odds, and everything recorded is sent as soon as it commits, delays included"""
+    monkeypatch.setattr(images, 'prerender', lambda *card_id_lists: None)
+    monkeypatch.setattr(ratelimit, 'buckets', {})
+    monkeypatch.setattr(outbox, 'concurrency', 1)
+    monkeypatch.setattr(outbox, 'wake', lambda slack, due=(): outbox.deliver(slack, now=float('inf')))
+    monkeypatch.setattr(engine, 'show_equity', False)
+
+@pytest.fixture
+def slack(stubbed, backend):
+    return FakeSlack()
+
+def play(slack, seed, game_no=0):
+    """Deals a game to 4 players and takes random actions until it ends"""
+    rng = random.Random(seed)
+    random.seed(seed)
+    thread_ts = f"{1700000000 + game_no}.000100"
+    game_id = f"C-{thread_ts}"
+    log = logging.getLogger('test')
+
+    with storage.transaction() as conn:
+        conn.save_game(game_id, {'host': 'U0', 'league': 'push-up', 'buyin': 5, 'status': 'pending', 'players': ['U0'], 'created_at': 1700000000.0 + game_no})
+
+    for user in ['U1', 'U2', 'U3']:
+        engine.maybe_add_player(slack, game_id, user, log)
+
+    for _ in range(100):
+        with storage.transaction(write=False) as conn:
+            state = engine.load_state(conn, game_id)
+
+        if state['status'] != 'in-progress':
+            break
+
+        # The snapshot with the actions since replayed is what the cache kept
+        cached = game_cache.cache.games.get(game_id)
+        if cached is not None and cached.state is not None:
+            assert state == cached.state
+
+        player = state['current_player']
+        payload = {'player': player, 'thread_ts': thread_ts, 'game_id': game_id}
+        action = rng.choice(['check'] * 6 + ['fold', 'single', 'double'])
+
+        if action == 'check':
+            engine.check(slack, player, f"{player}name", payload, log)
+        else:
+            getattr(engine, action)(slack, player, f"{player}name", payload)
+
+    return game_id
+
+def test_games_finish_and_replay_to_the_same_state(slack):
+    for n in range(5):
+        game_id = play(slack, n, n)
+
+        with storage.transaction(write=False) as conn:
+            state = conn.load_game(game_id)
+            assert state['status'] == 'complete'
+            assert engine.load_state(conn, game_id) == state
+
+    with storage.transaction(write=False) as conn:
+        assert conn.pending_messages() == 0
+        assert sum(row[2] for row in conn.player_stats(0)) == 5 * 4
+
+@pytest.mark.parametrize('size', [0, 1])
+def test_the_game_cache_changes_nothing(stubbed, monkeypatch, size):
+    runs = []
+
+    for cache_size in [game_cache.size, size]:
+        monkeypatch.setattr(storage, 'backend', storage.MemoryStorage())
+        monkeypatch.setattr(game_cache, 'cache', game_cache.GameCache(cache_size))
+        slack = FakeSlack()
+
+        for n in range(3):
+            play(slack, n, n)
+
+        with storage.transaction(write=False) as conn:
+            states = [conn.load_game(f"C-{1700000000 + n}.000100") for n in range(3)]
+
+        # The only wall clock time in a state
+        for state in states:
+            state.pop('finished_at')
+
+        runs.append((slack.calls, states))
+
+    assert runs[0] == runs[1]
+
+def test_showdown_odds_are_posted_once_after_the_result(slack, monkeypatch):
+    monkeypatch.setattr(engine, 'show_equity', True)
+    monkeypatch.setattr(equity, 'workers', 1)
+    monkeypatch.setattr(equity, 'samples', 500)
+
+    showdowns = 0
+
+    for n in range(6):
+        game_id = play(slack, n, n)
+        thread_ts = game_id.split('-')[1]
+        texts = [kwargs.get('text') or '' for method, kwargs in slack.calls if kwargs.get('thread_ts') == thread_ts]
+        odds = [idx for idx, text in enumerate(texts) if text.startswith("Odds by street")]
+
+        with storage.transaction(write=False) as conn:
+            showdown = 'strengths' in conn.load_game(game_id)
+
+        assert len(odds) == (1 if showdown else 0)
+        if showdown:
+            assert odds == [len(texts) - 1]
+            showdowns += 1
+
+    assert showdowns > 0
@@ -0,0 +1,53 @@
+import pytest
+
+import poker.equity as equity
+
+# Card ids are suit * 13 + rank, rank 0 the two and 12 the ace
+aces = [12, 25]
+kings = [11, 24]
+
+def test_river_is_decided():
+    board = [0, 14, 28, 6, 33]
+    odds = equity.equity({'U1': aces, 'U2': kings}, board)
+
+    assert odds == {'U1': (1.0, 0.0), 'U2': (0.0, 0.0)}
+
+def test_split_pot_is_a_tie():
+    # Both play the board's straight
+    board = [0, 14, 28, 42, 4]
+    odds = equity.equity({'U1': [50, 36], 'U2': [49, 35]}, board)
+
+    assert odds == {'U1': (0.0, 1.0), 'U2': (0.0, 1.0)}
+
+def test_sampled_preflop_is_close_and_repeatable(monkeypatch):
+    monkeypatch.setattr(equity, 'workers', 1)
+
+    odds = equity.equity({'U1': aces, 'U2': kings}, [], budget=20000, seed=1)
+
+    # Aces win about 82% of the time against kings
+    assert 0.79 < odds['U1'][0] < 0.85
+    assert odds == equity.equity({'U1': aces, 'U2': kings}, [], budget=20000, seed=1)
+
+def test_pool_shards_add_up_to_the_same_odds(monkeypatch):
+    board = [0, 14, 30]
+    hands = {'U1': aces, 'U2': kings, 'U3': [5, 18]}
+
+    monkeypatch.setattr(equity, 'workers', 1)
+    inline = equity.equity(hands, board)
+
+    monkeypatch.setattr(equity, 'workers', 2)
+    monkeypatch.setattr(equity, '_pool', None)
+
+    try:
+        pooled = equity.equity(hands, board)
+    finally:
+        equity._pool.shutdown()
+
+    assert pooled == pytest.approx(inline)
+
+def test_by_street_skips_the_river():
+    state = {'hands': {'U1': aces, 'U2': kings}, 'flop': [0, 14, 30], 'turn': 6, 'river': 33}
+
+    labels = [label for label, odds in equity.by_street(state, ['U1', 'U2'], budget=2000)]
+
+    assert labels == ['Pre-flop', 'Flop', 'Turn']
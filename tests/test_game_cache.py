@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+import poker.game_cache as game_cache
+import poker.storage as storage
+
+@pytest.fixture
+def stats(monkeypatch):
+    new = game_cache.CacheStats()
+    monkeypatch.setattr(game_cache, 'cache_stats', new)
+    return new
+
+class Loader():
+    """Reads the game from storage, counting the reads"""
+
+    def __init__(self):
+        self.loads = 0
+
+    def __call__(self, conn, game_id):
+        self.loads += 1
+        state = conn.load_game(game_id)
+        state['action_seq'] = conn.game_version(game_id)
+        return state
+
+def take_action(cache, loader, seq):
+    with cache.hold('C-1') as game, storage.transaction() as conn:
+        state = game.load(conn, loader)
+        conn.append_action('C-1', seq, 'check', 'U1', 'u1')
+        state['action_seq'] = seq
+        return state
+
+def test_cached_until_another_worker_acts(backend, stats):
+    cache = game_cache.GameCache(8)
+    loader = Loader()
+
+    with storage.transaction() as conn:
+        conn.save_game('C-1', {'status': 'in-progress', 'league': 'push-up'})
+
+    take_action(cache, loader, 1)
+    take_action(cache, loader, 2)
+    assert loader.loads == 1
+
+    # Another worker's action, this cache never saw it
+    with storage.transaction() as conn:
+        conn.append_action('C-1', 3, 'fold', 'U2', 'u2')
+
+    assert take_action(cache, loader, 4)['action_seq'] == 4
+    assert loader.loads == 2
+    assert stats.stats()['hits'] == 1
+    assert stats.stats()['misses'] == 2
+    assert stats.stats()['stale'] == 1
+
+def test_failed_actions_and_finished_games_are_dropped(backend, stats):
+    cache = game_cache.GameCache(8)
+    loader = Loader()
+
+    with storage.transaction() as conn:
+        conn.save_game('C-1', {'status': 'in-progress', 'league': 'push-up'})
+
+    with pytest.raises(KeyError):
+        with cache.hold('C-1') as game, storage.transaction() as conn:
+            game.load(conn, loader)['status'] = 'changed'
+            raise KeyError
+
+    with cache.hold('C-1') as game, storage.transaction() as conn:
+        assert game.load(conn, loader)['status'] == 'in-progress'
+        game.state['status'] = 'complete'
+
+    assert 'C-1' not in cache.games
+    assert loader.loads == 2
+
+def test_least_recently_used_games_are_evicted(backend, stats):
+    cache = game_cache.GameCache(2)
+
+    with storage.transaction() as conn:
+        for n in range(3):
+            conn.save_game(f'C-{n}', {'status': 'in-progress', 'league': 'push-up'})
+
+    for n in [0, 1, 0, 2]:
+        with cache.hold(f'C-{n}') as game, storage.transaction() as conn:
+            game.load(conn, Loader())
+
+    assert list(cache.games) == ['C-0', 'C-2']
+
+def test_one_thread_per_game(stats):
+    cache = game_cache.GameCache(8)
+    inside = []
+    overlaps = []
+
+    def hold():
+        for _ in range(200):
+            with cache.hold('C-1'):
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                inside.pop()
+
+    threads = [threading.Thread(target=hold) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == []
+    assert cache.games == {}
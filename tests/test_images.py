@@ -0,0 +1,44 @@
+import pytest
+
+import poker.images as images
+
+@pytest.mark.parametrize('arg, scale', [
+    (None, 1.0),
+    ('1', 1.0),
+    ('0.5', 0.5),
+    ('0.52', 0.5),
+    ('1.01', 1.0),
+    ('0.1', 0.1),
+    ('0.05', None),
+    ('1.1', None),
+    ('-0.5', None),
+    ('', None),
+    ('half', None),
+    ('inf', None),
+    ('-inf', None),
+    ('nan', None),
+    ('1e400', None),
+])
+def test_parse_scale(arg, scale):
+    assert images.parse_scale(arg) == scale
+
+@pytest.mark.parametrize('arg, card_ids', [
+    ('0,51', (0, 51)),
+    ('1,2,3,4,5,6,7,8', (1, 2, 3, 4, 5, 6, 7)),
+    ('52', None),
+    ('-1', None),
+    ('a,b', None),
+    ('', None),
+    (None, None),
+])
+def test_parse_card_ids(arg, card_ids):
+    assert images.parse_card_ids(arg) == card_ids
+
+def test_negotiate_format():
+    assert images.negotiate_format(set()) == 'png'
+    # Wildcards don't count
+    assert images.negotiate_format({'*/*', 'image/*'}) == 'png'
+    assert images.negotiate_format({'image/png'}) == 'png'
+
+    if 'webp' in images.formats:
+        assert images.negotiate_format({'image/webp', 'image/png'}) == 'webp'
@@ -0,0 +1,204 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+
+import pytest
+
+import poker.local_db as local_db
+
+def legacy_state(n):
+    players = ['U1', 'U2', 'U3', 'U4'][:2 + n % 3]
+    state = {
+        'host': players[0],
+        'league': ['push-up', 'squat'][n % 2],
+        'buyin': 5,
+        'status': 'complete',
+        'players': players,
+        'created_at': 1700000000.0 + n,
+        'bets': {p: 5 + n % 4 for p in players},
+        'winners': [players[n % len(players)]],
+        'folded': [],
+        'player_labels': {p: p.lower() for p in players},
+    }
+
+    if n % 7 == 3:
+        # Historical all-fold games didn't record their winner
+        state['winners'] = []
+        state['folded'] = players[1:]
+    if n % 11 == 5:
+        state['status'] = 'pending'
+    if n % 13 == 4:
+        del state['player_labels']
+
+    return state
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """A database with only the original (game_id, state) table"""
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE game (game_id TEXT PRIMARY KEY, state TEXT);")
+    conn.executemany("INSERT INTO game (game_id, state) VALUES (?, ?);",
+                     [(f'C-{n}', json.dumps(legacy_state(n))) for n in range(45)])
+    # A row whose state predates the status field
+    conn.execute("INSERT INTO game (game_id, state) VALUES (?, ?);", ('C-old', json.dumps({'players': ['U1']})))
+    conn.commit()
+    conn.close()
+
+    yield path
+
+    local_db.close()
+
+def full_scan_stats(path, last_n):
+    """What /game stats computed before the migration, reading every state"""
+    con = sqlite3.connect(path)
+    rows = con.execute("SELECT state FROM game ORDER BY rowid").fetchall()
+    con.close()
+
+    complete = [json.loads(r[0]) for r in rows if json.loads(r[0]).get('status') == 'complete']
+    complete = complete[-last_n:]
+
+    stats = defaultdict(lambda: {'name': '', 'games': 0, 'wins': 0})
+
+    for state in complete:
+        players = state.get('players', [])
+        winners = state.get('winners', [])
+        labels = state.get('player_labels', {})
+        folded = state.get('folded', [])
+
+        if not winners:
+            remaining = [p for p in players if p not in folded]
+            if remaining:
+                winners = remaining
+
+        for p in players:
+            stats[p]['name'] = labels.get(p, p) or p
+            stats[p]['games'] += 1
+            if p in winners:
+                stats[p]['wins'] += 1
+
+    return sorted((p, s['name'], s['games'], s['wins']) for p, s in stats.items())
+
+def migrated_stats(path, last_n):
+    with local_db.Connection(write=False, fn=path) as conn:
+        return sorted((player, label or player, games, wins) for player, label, games, wins, reps_owed in conn.player_stats(last_n))
+
+def dump(path):
+    conn = sqlite3.connect(path)
+    tables = {table: sorted(conn.execute(f"SELECT * FROM {table};").fetchall()) for table in ['game', 'game_player', 'player_stats', 'setting']}
+    conn.close()
+    return tables
+
+def test_migrate_backfills_a_legacy_database(legacy_db, monkeypatch):
+    monkeypatch.setattr(local_db, 'migrate_batch_size', 10)
+    monkeypatch.setattr(local_db, 'stats_windows', [5, 20])
+
+    # Taken before the migration, from the states alone
+    expected = {last_n: full_scan_stats(legacy_db, last_n or 100) for last_n in [0, 5, 20, 12]}
+
+    # 46 rows, in 5 batches
+    assert local_db.migrate(legacy_db) == 46
+
+    conn = sqlite3.connect(legacy_db)
+    assert conn.execute("SELECT COUNT(*) FROM game WHERE status IS NULL;").fetchone()[0] == 0
+
+    for game_id, state, status, league, created_at, finished_at, winners in conn.execute("SELECT * FROM game WHERE game_id != 'C-old';"):
+        state = json.loads(state)
+        assert (status, league, created_at) == (state['status'], state['league'], state['created_at'])
+        assert (json.loads(winners) if winners else []) == local_db.game_winners(state)
+
+        players = conn.execute("SELECT player, seat, label, bet, folded, won FROM game_player WHERE game_id = ? ORDER BY seat;", (game_id,)).fetchall()
+        assert players == [(p, seat, state.get('player_labels', {}).get(p), state['bets'][p], p in state['folded'], p in local_db.game_winners(state))
+                           for seat, p in enumerate(state['players'])]
+
+    assert conn.execute("SELECT status FROM game WHERE game_id = 'C-old';").fetchone() == ('unknown',)
+    conn.close()
+
+    # Kept windows from player_stats, the others added up from game_player
+    for last_n, stats in expected.items():
+        assert migrated_stats(legacy_db, last_n) == stats
+
+def test_migrating_again_changes_nothing(legacy_db, monkeypatch):
+    monkeypatch.setattr(local_db, 'migrate_batch_size', 10)
+    local_db.migrate(legacy_db)
+    before = dump(legacy_db)
+
+    assert local_db.migrate(legacy_db) == 0
+    assert dump(legacy_db) == before
+
+class CountingConnection(sqlite3.Connection):
+    """Records the PRAGMAs run on it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pragmas = []
+
+    def execute(self, sql, *args):
+        if sql.startswith('PRAGMA'):
+            self.pragmas.append(sql)
+        return super().execute(sql, *args)
+
+def test_connection_is_kept_per_thread(db_path):
+    with local_db.Connection() as first:
+        pass
+    with local_db.Connection(write=False) as second:
+        pass
+
+    assert second.conn is first.conn
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(local_db.connect(db_path)))
+    thread.start()
+    thread.join()
+
+    assert other[0] is not first.conn
+
+def test_connection_is_reopened_after_a_fork(db_path, monkeypatch):
+    with local_db.Connection() as parent:
+        pass
+
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+
+    with local_db.Connection() as child:
+        pass
+
+    assert child.conn is not parent.conn
+
+def test_pragmas_are_applied_once(db_path, monkeypatch):
+    connect = sqlite3.connect
+    monkeypatch.setattr(sqlite3, 'connect', lambda *args, **kwargs: connect(*args, factory=CountingConnection, **kwargs))
+    local_db.close()
+
+    for n in range(3):
+        with local_db.Connection() as conn:
+            conn.load_game('C-1')
+
+    assert [sql.split('=')[0] for sql in conn.conn.pragmas] == ['PRAGMA journal_mode', 'PRAGMA synchronous', 'PRAGMA cache_size', 'PRAGMA mmap_size', 'PRAGMA busy_timeout']
+    assert conn.conn.execute('PRAGMA journal_mode;').fetchone() == ('wal',)
+    assert conn.conn.execute('PRAGMA busy_timeout;').fetchone() == (local_db.busy_timeout_ms,)
+
+def test_nested_connection_raises(db_path):
+    with local_db.Connection() as conn:
+        with pytest.raises(RuntimeError):
+            with local_db.Connection(write=False):
+                pass
+
+        # The outer transaction carries on
+        conn.save_game('C-1', {'status': 'pending', 'players': ['U1']})
+
+    with local_db.Connection(write=False) as conn:
+        assert conn.load_game('C-1') is not None
+
+def test_exception_rolls_back(db_path):
+    with pytest.raises(ValueError):
+        with local_db.Connection() as conn:
+            conn.save_game('C-1', {'status': 'pending', 'players': ['U1']})
+            raise ValueError()
+
+    assert not conn.conn.in_transaction
+
+    with local_db.Connection(write=False) as conn:
+        assert conn.load_game('C-1') is None
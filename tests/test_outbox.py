@@ -0,0 +1,246 @@
+import threading
+import time
+
+import pytest
+
+import poker.outbox as outbox
+import poker.ratelimit as ratelimit
+import poker.storage as storage
+
+class Response():
+    def __init__(self, status_code, data, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+
+class SlackError(Exception):
+    def __init__(self, response):
+        self.response = response
+
+def rate_limited(seconds):
+    return SlackError(Response(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(seconds)}))
+
+# Kept from before tests replace time.sleep to see outbox's sleeps
+sleep = time.sleep
+
+class FakeSlack():
+    """Records calls, raising the errors queued for a message's `n` first"""
+
+    def __init__(self, errors=None):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.errors = errors or {}
+
+    def chat_postMessage(self, **kwargs):
+        with self.lock:
+            errors = self.errors.get(kwargs['n'])
+            if errors:
+                raise errors.pop(0)
+
+            self.calls.append(kwargs)
+
+        # Long enough for sends on other chains to overlap
+        sleep(0.002)
+        return {'ok': True}
+
+    chat_postEphemeral = chat_postMessage
+
+@pytest.fixture
+def unlimited(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'buckets', {})
+
+def record(calls):
+    """Records (method, kwargs) calls in one transaction"""
+    with storage.transaction() as conn:
+        messages = outbox.Recorder(conn)
+
+        for method, kwargs in calls:
+            getattr(messages, method)(**kwargs)
+
+    return messages
+
+def pending(backend):
+    with storage.transaction(write=False) as conn:
+        return conn.pending_messages()
+
+@pytest.mark.parametrize('concurrency', [1, 8])
+def test_each_chain_is_delivered_in_order(backend, unlimited, monkeypatch, concurrency):
+    monkeypatch.setattr(outbox, 'concurrency', concurrency)
+    slack = FakeSlack()
+
+    calls = []
+    for n in range(60):
+        thread = f"{n % 4}.0"
+        if n % 5 == 0:
+            calls.append(('chat_postEphemeral', {'channel': 'C', 'thread_ts': thread, 'user': f"U{n % 3}", 'n': n}))
+        else:
+            calls.append(('chat_postMessage', {'channel': 'C', 'thread_ts': thread, 'n': n}))
+
+    record(calls)
+
+    assert outbox.deliver(slack) == 60
+    assert pending(backend) == 0
+
+    # Ephemerals, turn prompts included, keep their place in the thread
+    for thread in range(4):
+        sent = [call['n'] for call in slack.calls if call['thread_ts'] == f"{thread}.0"]
+        assert sent == [n for n in range(60) if n % 4 == thread]
+
+def test_dealt_hands_have_chains_of_their_own(backend, unlimited):
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 0})]
+           + [('chat_postEphemeral', {'channel': 'C', 'thread_ts': '1.0', 'user': f"U{n}", 'n': n, 'own_chain': True}) for n in range(1, 5)])
+
+    with storage.transaction() as conn:
+        claimed = conn.claim_messages(time.time(), outbox.lease, 10)
+
+    # The announcement and every hand at once, not one after the other
+    assert sorted(message[2]['n'] for message in claimed) == [0, 1, 2, 3, 4]
+
+def test_sleep_delays_what_follows(backend, unlimited):
+    with storage.transaction() as conn:
+        messages = outbox.Recorder(conn)
+        messages.chat_postMessage(channel='C', thread_ts='1.0', n=0)
+        messages.sleep(60)
+        messages.chat_postMessage(channel='C', thread_ts='2.0', n=1)
+
+    slack = FakeSlack()
+    assert len(messages.due) == 1 and messages.due[0] > time.time() + 50
+    assert outbox.deliver(slack) == 1
+    assert outbox.deliver(slack, now=messages.due[0]) == 1
+    assert [call['n'] for call in slack.calls] == [0, 1]
+
+def test_a_claimed_message_waits_for_its_lease(backend, unlimited):
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 0})])
+    now = time.time()
+
+    with storage.transaction() as conn:
+        assert len(conn.claim_messages(now, 30.0, 10)) == 1
+        # Claimed by a worker that may still be sending it
+        assert conn.claim_messages(now + 1, 30.0, 10) == []
+        # That worker died, the lease ran out
+        assert len(conn.claim_messages(now + 31, 30.0, 10)) == 1
+
+def test_rate_limited_messages_are_deferred_without_an_attempt(backend, monkeypatch):
+    bucket = ratelimit.TokenBucket(100.0, 10)
+    monkeypatch.setattr(ratelimit, 'buckets', {'chat_postMessage': bucket})
+    monkeypatch.setattr(outbox, 'max_attempts', 1)
+    slack = FakeSlack({0: [rate_limited(30)]})
+
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 0}),
+            ('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 1})])
+
+    assert outbox.deliver(slack) == 0
+    assert pending(backend) == 2
+    # The method waits for Retry-After, and the thread behind its first message
+    assert bucket.available() == 0
+
+    # Once due, it's sent though max_attempts is 1, the 429 didn't count
+    bucket.paused_until = 0.0
+    assert outbox.deliver(slack, now=time.time() + 31) == 2
+    assert [call['n'] for call in slack.calls] == [0, 1]
+
+def test_failures_back_off_and_permanent_ones_give_up(backend, unlimited):
+    timeout = SlackError(Response(500, None))
+    not_found = SlackError(Response(200, {'ok': False, 'error': 'channel_not_found'}))
+    slack = FakeSlack({0: [timeout], 1: [not_found]})
+
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 0}),
+            ('chat_postMessage', {'channel': 'C', 'thread_ts': '2.0', 'n': 1}),
+            ('chat_postMessage', {'channel': 'C', 'thread_ts': '2.0', 'n': 2})])
+
+    # The thread behind a given up message carries on
+    assert outbox.deliver(slack) == 1
+    assert [call['n'] for call in slack.calls] == [2]
+    assert pending(backend) == 1
+
+    # Retried after backoff(0), 1s
+    assert outbox.deliver(slack, now=time.time() + outbox.backoff(0) + 1) == 1
+    assert pending(backend) == 0
+
+def test_quotas_cap_claims_per_method(backend, unlimited):
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': f"{n}.0", 'n': n}) for n in range(5)]
+           + [('chat_postEphemeral', {'channel': 'C', 'thread_ts': f"{n}.0", 'user': 'U1', 'n': n, 'own_chain': True}) for n in range(5, 8)])
+
+    held = set()
+
+    with storage.transaction() as conn:
+        claimed = conn.claim_messages(time.time(), outbox.lease, 10, quotas={'chat_postMessage': 2, 'chat_postEphemeral': 0}, held=held)
+
+    assert [message[1] for message in claimed] == ['chat_postMessage'] * 2
+    assert held == {'chat_postMessage', 'chat_postEphemeral'}
+
+def test_only_methods_with_due_messages_are_held(backend, unlimited):
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 0})])
+    held = set()
+
+    with storage.transaction() as conn:
+        claimed = conn.claim_messages(time.time(), outbox.lease, 10, quotas={'chat_postEphemeral': 0}, held=held)
+
+    assert len(claimed) == 1
+    assert held == set()
+
+def test_throttled_counts_messages_held_back(backend, monkeypatch):
+    bucket = ratelimit.TokenBucket(0.001, 1)
+    bucket.take()
+    monkeypatch.setattr(ratelimit, 'buckets', {'chat_postEphemeral': bucket})
+    monkeypatch.setattr(outbox, 'outbox_stats', outbox.OutboxStats())
+    monkeypatch.setattr(outbox, '_refills', {})
+    slack = FakeSlack()
+
+    # A dry bucket with nothing of its method to send isn't throttling anything
+    record([('chat_postMessage', {'channel': 'C', 'thread_ts': '1.0', 'n': 0})])
+    assert outbox.deliver(slack) == 1
+    assert outbox.outbox_stats.methods['chat_postMessage']['throttled'] == 0
+    assert 'chat_postEphemeral' not in outbox.outbox_stats.methods
+    assert outbox._refills == {}
+
+    record([('chat_postEphemeral', {'channel': 'C', 'thread_ts': '1.0', 'user': 'U1', 'n': 1})])
+    assert outbox.deliver(slack) == 0
+    assert outbox.outbox_stats.methods['chat_postEphemeral']['throttled'] == 1
+    assert 'chat_postEphemeral' in outbox._refills
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(time, 'sleep', slept.append)
+    return slept
+
+def test_call_retries_and_returns_the_response(unlimited, sleeps):
+    slack = FakeSlack({0: [SlackError(Response(500, None))]})
+
+    assert outbox.call(slack, 'chat_postMessage', channel='C', n=0) == {'ok': True}
+    assert sleeps == [outbox.backoff(0)]
+
+def test_call_gives_up_without_a_last_sleep(unlimited, sleeps, monkeypatch):
+    monkeypatch.setattr(outbox, 'max_attempts', 3)
+    monkeypatch.setattr(outbox, 'call_max_wait', 100.0)
+    slack = FakeSlack({0: [SlackError(Response(500, None)) for _ in range(3)]})
+
+    with pytest.raises(outbox.Busy):
+        outbox.call(slack, 'chat_postMessage', channel='C', n=0)
+
+    assert sleeps == [outbox.backoff(0), outbox.backoff(1)]
+
+def test_call_fails_fast_past_its_wait(sleeps, monkeypatch):
+    bucket = ratelimit.TokenBucket(1.0, 1)
+    monkeypatch.setattr(ratelimit, 'buckets', {'chat_postMessage': bucket})
+    monkeypatch.setattr(outbox, 'call_max_wait', 5.0)
+    slack = FakeSlack({0: [rate_limited(30)]})
+
+    with pytest.raises(outbox.Busy):
+        outbox.call(slack, 'chat_postMessage', channel='C', n=0)
+
+    # The method is paused for Retry-After, so the next call doesn't even try
+    with pytest.raises(outbox.Busy):
+        outbox.call(slack, 'chat_postMessage', channel='C', n=1)
+
+    assert sleeps == []
+    assert slack.calls == []
+
+def test_call_raises_permanent_errors_as_they_are(unlimited, sleeps):
+    not_found = SlackError(Response(200, {'ok': False, 'error': 'channel_not_found'}))
+
+    with pytest.raises(SlackError):
+        outbox.call(FakeSlack({0: [not_found]}), 'chat_postMessage', channel='C', n=0)
+
+    assert sleeps == []
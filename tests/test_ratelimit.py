@@ -0,0 +1,76 @@
+import pytest
+
+import poker.ratelimit as ratelimit
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+def test_bucket_bursts_then_refills(clock):
+    bucket = ratelimit.TokenBucket(2.0, 5)
+
+    assert bucket.available() == 5
+    bucket.take(5)
+    assert bucket.available() == 0
+    assert bucket.wait() == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.available() == 1
+
+    # Never more than the burst however long it sits
+    clock.now += 3600
+    assert bucket.available() == 5
+
+def test_pause_holds_every_call(clock):
+    bucket = ratelimit.TokenBucket(2.0, 5)
+    bucket.pause(30)
+
+    assert bucket.available() == 0
+    assert bucket.wait() == pytest.approx(30)
+
+    # A shorter Retry-After doesn't cut a longer pause short
+    bucket.pause(5)
+    clock.now += 29
+    assert bucket.available() == 0
+
+    clock.now += 1
+    assert bucket.available() == 5
+
+class Response():
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers
+
+class SlackError(Exception):
+    def __init__(self, response):
+        self.response = response
+
+@pytest.mark.parametrize('headers, seconds', [
+    ({'Retry-After': '7'}, 7.0),
+    ({'retry-after': '0.5'}, 0.5),
+    ({}, 1.0),
+    (None, 1.0),
+    ({'Retry-After': 'soon'}, 1.0),
+])
+def test_retry_after(headers, seconds):
+    assert ratelimit.retry_after(SlackError(Response(429, headers=headers))) == seconds
+
+def test_only_429s_have_a_retry_after():
+    assert ratelimit.retry_after(SlackError(Response(500, headers={'Retry-After': '7'}))) is None
+    assert ratelimit.retry_after(TimeoutError()) is None
+
+def test_retryable():
+    assert ratelimit.retryable(TimeoutError())
+    assert ratelimit.retryable(SlackError(Response(500)))
+    assert ratelimit.retryable(SlackError(Response(200, {'ok': False, 'error': 'internal_error'})))
+    assert not ratelimit.retryable(SlackError(Response(200, {'ok': False, 'error': 'channel_not_found'})))
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import signal
+
+import pytest
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import poker.images as images
+
+PNG = b'\x89PNG'
+
+@pytest.fixture
+def renderer(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, 'render_cache_dir', str(tmp_path))
+    monkeypatch.setattr(images, 'cache', images.RenderCache(16))
+    monkeypatch.setattr(images, 'render_workers', 1)
+    # Room for spawning the process and mapping the atlas
+    monkeypatch.setattr(images, 'render_timeout', 60.0)
+    monkeypatch.setattr(images, '_pool', None)
+
+    yield images
+
+    if images._pool is not None:
+        images._pool.shutdown()
+
+def test_render_in_the_pool_matches_inline(renderer):
+    data, etag = renderer.render((0, 1))
+
+    assert data.startswith(PNG)
+    assert etag == hashlib.sha1(data).hexdigest()
+    assert data == renderer.encode(renderer.compose((0, 1)), 'png')
+
+    # Then from the LRU, and from disk once that's forgotten
+    assert renderer.render((0, 1)) == (data, etag)
+    renderer.cache = renderer.RenderCache(16)
+    assert renderer.render((0, 1)) == (data, etag)
+
+def test_render_recovers_from_a_killed_process(renderer):
+    renderer.render((2, 3))
+
+    for process in list(renderer._pool._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+
+    # The render in flight when the pool broke may time out, the next one goes to a new pool
+    try:
+        assert renderer.render((4, 5))[0].startswith(PNG)
+    except renderer.RenderTimeout:
+        pass
+
+    assert renderer.render((6, 7))[0].startswith(PNG)
+
+class BrokenPool():
+    """A pool whose process died with the render in flight"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+def test_render_crash_answers_render_timeout(renderer):
+    pool = BrokenPool()
+    renderer._pool = pool
+
+    with pytest.raises(renderer.RenderTimeout):
+        renderer.render((8, 9))
+
+    # Not left in flight, and the broken pool is dropped for the next render
+    assert ((8, 9), 'png', 1.0) not in renderer._inflight
+    assert renderer._pool is None
+    assert pool.shut_down
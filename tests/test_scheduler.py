@@ -0,0 +1,52 @@
+import threading
+import time
+
+from poker.scheduler import Scheduler
+
+def test_timers_fire_in_order_of_when_they_are_due():
+    scheduler = Scheduler('test-scheduler')
+    fired = []
+    done = threading.Event()
+    now = time.time()
+
+    # Scheduled out of order, and ties in the order they were scheduled
+    scheduler.call_at(now + 0.06, fired.append, 'c')
+    scheduler.call_at(now + 0.02, fired.append, 'a')
+    scheduler.call_at(now + 0.04, fired.append, 'b1')
+    scheduler.call_at(now + 0.04, fired.append, 'b2')
+    scheduler.call_later(0.08, done.set)
+
+    assert done.wait(5)
+    assert fired == ['a', 'b1', 'b2', 'c']
+
+    stats = scheduler.stats()
+    assert stats['scheduled'] == 5
+    assert stats['ran'] == 5
+    assert stats['pending'] == 0
+
+def test_cancelled_timers_and_failing_callbacks():
+    scheduler = Scheduler('test-scheduler')
+    fired = []
+    done = threading.Event()
+
+    timer = scheduler.call_later(0.01, fired.append, 'cancelled')
+    timer.cancel()
+    scheduler.call_later(0.02, lambda: 1 / 0)
+    scheduler.call_later(0.03, done.set)
+
+    # The thread carries on past a callback that raised
+    assert done.wait(5)
+    assert fired == []
+    assert scheduler.stats()['cancelled'] == 1
+
+def test_an_earlier_timer_wakes_the_thread():
+    scheduler = Scheduler('test-scheduler')
+    done = threading.Event()
+
+    scheduler.call_later(3600, done.set)
+    start = time.time()
+    scheduler.call_later(0.01, done.set)
+
+    assert done.wait(5)
+    assert time.time() - start < 1
+    assert scheduler.stats()['pending'] == 1
@@ -0,0 +1,93 @@
+import itertools
+import random
+
+import pytest
+
+import poker.scoring as scoring
+
+def reference(hand):
+    return max(scoring.strength(scoring.best(list(five))) for five in itertools.combinations(hand, 5))
+
+@pytest.mark.parametrize('n', [5, 6, 7])
+def test_evaluate7_matches_best(n):
+    rng = random.Random(n)
+
+    for _ in range(2000):
+        hand = rng.sample(range(52), n)
+        assert scoring.evaluate7(hand) == reference(hand), hand
+
+def test_evaluate7_every_category():
+    # Royal flush down to high card, all in spades (0-12) unless noted
+    hands = {
+        'Royal Flush':     [8, 9, 10, 11, 12, 13, 26],
+        'Straight Flush':  [0, 1, 2, 3, 12, 25, 38],
+        'Four of a Kind':  [5, 18, 31, 44, 0, 14, 28],
+        'Full House':      [5, 18, 31, 6, 19, 1, 15],
+        'Flush':           [0, 2, 4, 6, 9, 14, 27],
+        'Straight':        [0, 14, 28, 42, 4, 20, 37],
+        'Three of a Kind': [5, 18, 31, 0, 15, 29, 48],
+        'Two Pair':        [5, 18, 6, 19, 0, 28, 48],
+        'Pair':            [5, 18, 0, 15, 29, 46, 49],
+        'High Card':       [0, 14, 28, 43, 9, 24, 38],
+    }
+
+    for name, hand in hands.items():
+        assert scoring.hand_name(scoring.evaluate7(hand)) == name
+        assert scoring.evaluate7(hand) == reference(hand)
+
+def test_sample_hands_is_repeatable():
+    assert scoring.sample_hands(10, seed=3) == scoring.sample_hands(10, seed=3)
+    assert all(len(set(hand)) == 5 for hand in scoring.sample_hands(100))
+
+def test_load_hand_table_rejects_wrong_strengths(tmp_path):
+    path = tmp_path / 'hand_table.bin'
+
+    # The right header and size, but every strength zero
+    with open(path, 'wb') as f:
+        f.write(scoring.HAND_TABLE_HEADER.pack(scoring.HAND_TABLE_MAGIC, scoring.HAND_TABLE_VERSION, scoring.HAND_TABLE_SIZE))
+        f.truncate(scoring.HAND_TABLE_HEADER.size + 4 * scoring.HAND_TABLE_SIZE)
+
+    assert scoring.load_hand_table(str(path)) is None
+
+def test_load_hand_table_rejects_stale_header(tmp_path):
+    path = tmp_path / 'hand_table.bin'
+
+    with open(path, 'wb') as f:
+        f.write(scoring.HAND_TABLE_HEADER.pack(scoring.HAND_TABLE_MAGIC, scoring.HAND_TABLE_VERSION - 1, scoring.HAND_TABLE_SIZE))
+        f.truncate(scoring.HAND_TABLE_HEADER.size + 4 * scoring.HAND_TABLE_SIZE)
+
+    assert scoring.load_hand_table(str(path)) is None
+    assert scoring.load_hand_table(str(tmp_path / 'missing.bin')) is None
+
+@pytest.mark.parametrize('n', [5, 7])
+def test_best_batch_matches_evaluate7(n):
+    np = pytest.importorskip('numpy')
+    rng = random.Random(n)
+    hands = np.array([rng.sample(range(52), n) for _ in range(5000)])
+
+    # A small chunk_size so the rows span several chunks
+    strengths = scoring.best_batch(hands, chunk_size=1024)
+
+    assert strengths.tolist() == [scoring.evaluate7(hand) for hand in hands.tolist()]
+
+def test_best_batch_rejects_impossible_ranks():
+    np = pytest.importorskip('numpy')
+
+    # Five aces have no rank key in the table
+    with pytest.raises(ValueError):
+        scoring.best_batch(np.array([[0, 1, 2, 3, 4], [12, 25, 38, 51, 51]]))
+
+    with pytest.raises(ValueError):
+        scoring.best_batch(np.array([[0, 0, 0, 0, 0]]))
+
+@pytest.mark.parametrize('hand', [
+    [0, 0, 1, 2, 3],
+    [0, 13, 26, 5, 5, 7, 8],
+    [12, 11, 10, 9, 12, 8, 0],
+])
+def test_best_batch_rejects_repeated_cards(hand):
+    np = pytest.importorskip('numpy')
+
+    # Their ranks make a real hand, a pair or a straight
+    with pytest.raises(ValueError):
+        scoring.best_batch(np.array([[0, 1, 2, 3, 4, 5, 6][:len(hand)], hand]))
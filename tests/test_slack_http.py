@@ -0,0 +1,117 @@
+import http.client
+import json
+import socket
+import threading
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from slack_sdk.errors import SlackApiError
+
+import poker.ratelimit as ratelimit
+import poker.slack_http as slack_http
+
+class FakeSlack(BaseHTTPRequestHandler):
+    # Keeps connections open like Slack does
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.posts += 1
+
+        if self.server.mode == 'drop':
+            # Read the request, then hang up without answering
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        if self.server.mode == '429':
+            body = b'{"ok": false, "error": "ratelimited"}'
+            self.send_response(429)
+            self.send_header('Retry-After', '7')
+        else:
+            body = json.dumps({'ok': True, 'channel': 'C0', 'ts': '1700000000.000100'}).encode()
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlack)
+    server.daemon_threads = True
+    server.posts = 0
+    server.mode = 'ok'
+    # A short poll so shutdown() doesn't wait half a second
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = slack_http.ConnectionPool(2, 60.0)
+    monkeypatch.setattr(slack_http, 'pool', pool)
+    return pool
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/api/"
+
+def post(pool, server):
+    req = urllib.request.Request(f"{url(server)}chat.postMessage", data=b'{"channel": "C0"}', method='POST',
+                                 headers={'Content-Type': 'application/json'})
+    return pool.request(req.full_url, req)
+
+def test_calls_reuse_one_connection(server, pool):
+    client = slack_http.PooledWebClient(token='xoxb-test', base_url=url(server))
+
+    for _ in range(3):
+        assert client.chat_postMessage(channel='C0', text='hi')['ts'] == '1700000000.000100'
+
+    stats = slack_http.stats()
+    assert (stats['requests'], stats['opened'], stats['reused'], stats['idle']) == (3, 1, 2, 1)
+
+def test_429_reaches_the_rate_limiter(server, pool):
+    client = slack_http.PooledWebClient(token='xoxb-test', base_url=url(server))
+    server.mode = '429'
+
+    with pytest.raises(SlackApiError) as error:
+        client.chat_postMessage(channel='C0', text='hi')
+
+    assert ratelimit.retry_after(error.value) == 7.0
+
+def test_a_connection_closed_while_idle_is_replaced(server, pool):
+    post(pool, server)
+
+    # Slack closed it meanwhile, so sending on it fails
+    key = next(iter(pool.idle))
+    conn, opened = pool.idle[key][-1]
+    ours, theirs = socket.socketpair()
+    theirs.close()
+    conn.sock.close()
+    conn.sock = ours
+
+    assert post(pool, server)['status'] == 200
+    assert server.posts == 2
+    assert pool.stats()['stale'] == 1
+
+def test_a_sent_request_is_never_sent_again(server, pool):
+    post(pool, server)
+    server.mode = 'drop'
+
+    # Slack may have acted on it, so the error goes back to the caller
+    with pytest.raises(http.client.RemoteDisconnected):
+        post(pool, server)
+
+    assert server.posts == 2
+    assert pool.stats()['stale'] == 0
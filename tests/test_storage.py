@@ -0,0 +1,97 @@
+import sqlite3
+
+import pytest
+
+import poker.local_db as local_db
+import poker.storage as storage
+
+def game(n, league='push-up', winner='U1', players=('U1', 'U2', 'U3')):
+    return {
+        'host': players[0],
+        'league': league,
+        'buyin': 5,
+        'status': 'complete',
+        'players': list(players),
+        'created_at': 1700000000.0 + n,
+        'bets': {p: 5 + n % 3 for p in players},
+        'winners': [winner],
+        'folded': [],
+        'player_labels': {p: p.lower() for p in players},
+    }
+
+def complete(conn, game_id, state):
+    conn.save_game(game_id, dict(state, status='in-progress'))
+    conn.complete_game(game_id, state)
+    conn.save_game(game_id, state)
+
+def test_backends_implement_the_protocols(backend):
+    assert isinstance(backend, storage.Storage)
+
+    with storage.transaction() as conn:
+        assert isinstance(conn, storage.Transaction)
+
+    with pytest.raises(TypeError):
+        storage.use(object())
+
+def test_rollback_undoes_everything(backend):
+    with storage.transaction() as conn:
+        conn.save_game('C-1', game(1))
+
+    with pytest.raises(KeyError):
+        with storage.transaction() as conn:
+            conn.save_game('C-1', game(1, winner='U2'))
+            conn.append_action('C-1', 1, 'check', 'U1', 'U1')
+            complete(conn, 'C-2', game(2))
+            conn.enqueue_message('t', 'chat_postMessage', {'text': 'hi'}, 0.0)
+            raise KeyError
+
+    with storage.transaction(write=False) as conn:
+        assert conn.load_game('C-1') == game(1)
+        assert conn.load_game('C-2') is None
+        assert conn.game_version('C-1') == 0
+        assert conn.player_stats(0) == []
+        assert conn.pending_messages() == 0
+
+def test_actions_are_append_only(backend):
+    with storage.transaction() as conn:
+        conn.save_game('C-1', game(1))
+        conn.append_action('C-1', 1, 'check', 'U1', 'u1')
+        conn.append_action('C-1', 2, 'fold', 'U2', 'u2')
+
+        assert conn.game_version('C-1') == 2
+        assert conn.game_version('C-9') is None
+        assert conn.load_actions('C-1', after_seq=1) == [(2, 'fold', 'U2', 'u2')]
+
+    with pytest.raises((ValueError, sqlite3.IntegrityError)):
+        with storage.transaction() as conn:
+            conn.append_action('C-1', 2, 'check', 'U2', 'u2')
+
+def test_stats_windows(backend, monkeypatch):
+    monkeypatch.setattr(local_db, 'stats_windows', [2])
+
+    with storage.transaction() as conn:
+        # Completed out of order, the oldest game is the one a window drops
+        for n in [3, 1, 4, 2]:
+            complete(conn, f'C-{n}', game(n, winner='U1' if n % 2 else 'U2'))
+        complete(conn, 'C-5', game(5, league='squat', players=('U1', 'U4')))
+
+    with storage.transaction(write=False) as conn:
+        every = {row[0]: row for row in conn.player_stats(0)}
+        assert every['U1'][1:4] == ('u1', 5, 3)
+        assert every['U4'][2:4] == (1, 0)
+
+        # The last 2 games: C-5 (squat, U1 won) and C-4 (U2 won)
+        last_two = {row[0]: row[2:4] for row in conn.player_stats(2)}
+        assert last_two == {'U1': (2, 1), 'U2': (1, 1), 'U3': (1, 0), 'U4': (1, 0)}
+
+        pushups = {row[0]: row[2:4] for row in conn.player_stats(2, 'push-up')}
+        assert pushups == {'U1': (2, 1), 'U2': (2, 1), 'U3': (2, 0)}
+
+        # Windows that aren't kept are summed on demand
+        assert {row[0]: row[2:4] for row in conn.player_stats(3)} == {'U1': (3, 2), 'U2': (2, 1), 'U3': (2, 0), 'U4': (1, 0)}
+
+        kept = sorted(conn.player_stats(2))
+
+    with storage.transaction() as conn:
+        assert conn.rebuild_stats() > 0
+        assert sorted(conn.player_stats(2)) == kept
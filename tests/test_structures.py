@@ -0,0 +1,52 @@
+import hashlib
+import os
+import re
+
+import pytest
+
+import poker.structures as structures
+from poker.structures import cards, card_file_name, card_image_name, card_for_image_name
+
+@pytest.fixture
+def digests(monkeypatch):
+    """Forgets the cached digests before and after the test"""
+    monkeypatch.setattr(structures, '_card_digests', None)
+    yield
+    structures._card_digests = None
+
+def test_hashed_names_carry_the_file_digest(digests):
+    for card in range(len(cards)):
+        name = card_image_name(card)
+
+        with open(os.path.join(structures.static_dir, card_file_name(card)), 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+
+        assert name == card_file_name(card)[:-len('.png')] + f'.{digest}.png'
+        assert re.fullmatch(r'[0-9a-z]+_of_[a-z]+\.[0-9a-f]{12}\.png', name)
+
+def test_names_map_back_to_their_card(digests):
+    for card in range(len(cards)):
+        assert card_for_image_name(card_image_name(card)) == card
+        assert card_for_image_name(card_file_name(card)) == card
+
+@pytest.mark.parametrize('name', [
+    'joker.png',
+    'ace_of_spades',
+    'ace_of_spades.000000000000.png',
+    '../ace_of_spades.png',
+    '',
+])
+def test_unknown_names(digests, name):
+    assert card_for_image_name(name) is None
+
+def test_plain_names_without_hashing(digests, monkeypatch):
+    monkeypatch.setattr(structures, 'hashed_image_names', False)
+
+    assert card_image_name(0) == card_file_name(0)
+    assert card_for_image_name(card_file_name(0)) == 0
+
+def test_plain_names_for_missing_files(digests, monkeypatch, tmp_path):
+    monkeypatch.setattr(structures, 'static_dir', str(tmp_path))
+
+    assert structures.card_digest(0) is None
+    assert card_image_name(0) == card_file_name(0)
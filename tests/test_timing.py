@@ -0,0 +1,12 @@
+from poker.timing import Timing
+
+def test_timing():
+    timing = Timing()
+    assert timing.stats('held_ms') == {'held_ms_avg': 0.0, 'held_ms_max': 0.0}
+
+    for ms in [4.0, 10.0, 1.0]:
+        timing.add(ms)
+
+    assert timing.count == 3
+    assert timing.avg == 5.0
+    assert timing.stats('held_ms') == {'held_ms_avg': 5.0, 'held_ms_max': 10.0}